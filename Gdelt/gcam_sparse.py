@@ -0,0 +1,266 @@
+"""
+Sparse form of the full V2GCAM field of a GKG article, and the extractor
+which turns any set of GCAM codes back into dense columns.
+
+The V2GCAM field lists every GCAM dimension (of ~2,300, across ~40
+dictionaries) which has a non-zero value for the article, eg.
+'wc:125,c1.2:4,c4.9:2,v10.1:0.25'. Rather than a wide column per code of
+interest (which means reprocessing the history to add a code), an article
+keeps the field as a pair of arrays: the codes (as ids in a dictionary of
+codes) and their values. Counts ('c' codes) and values ('v' codes) are both
+read as float32, which holds every count exactly up to 2**24.
+
+`pack_sparse` packs each article's pair into bytes for storage (the "gcam"
+column of gdelt_raw), with the ids sorted:
+    varint  number of entries, n
+    varint  number of values which aren't counts, f
+    n varints: each id's difference from the previous id, shifted left one
+        bit, with the low bit set if its value isn't a count
+    n - f varints: the counts, in the order of their ids
+    f big-endian float32: the other values, in the order of their ids
+Most differences and counts fit in one byte, so an article's ~150 entries
+take ~2 bytes each, rather than 6 (plus the array headers) as a SMALLINT[]
+of ids and a REAL[] of values. The id differences, counts and floats are
+kept apart so that `unpack_sparse` can decode many articles at once with
+NumPy, like `to_dense`.
+
+`to_dense` materialises chosen codes for many articles at once with NumPy:
+the arrays are concatenated, each id is mapped to its output column with
+one lookup array, and the values are scattered into a (articles x codes)
+array, so the cost doesn't depend on how many codes there are in total.
+
+Usage:
+    codes, values = parse_gcam(line[17])
+    packed = pack_sparse(ids_per_article, values_per_article)
+    ids_per_article, values_per_article = unpack_sparse(packed)
+    dense = to_dense(ids_per_article, values_per_article, [3, 17])
+    columns = dense_from_strings(gcam_strings, ['c4.9', 'v10.1'])
+"""
+from collections import namedtuple
+from itertools import chain
+
+import numpy as np
+
+WORD_COUNT_CODE = 'wc'  # the first entry of V2GCAM, which is also in V1.5TONE
+MAX_COUNT = 2 ** 24  # counts are packed as varints below this
+MAX_VARINT_BYTES = 5  # enough for the id differences and counts
+
+# The parser's output for the full V2GCAM field of an article. (The typename
+# must match the variable name so that rows can be pickled between processes.)
+SparseGcam = namedtuple('SparseGcam', ['codes', 'values'])
+
+
+def parse_gcam(gcam):
+    """
+    Returns the SparseGcam of a V2GCAM field: every code except 'wc', and its
+    value as a float.
+    """
+    codes, values = [], []
+    if gcam:
+        for el in gcam.split(','):
+            code, _, val = el.partition(':')
+            if val and code != WORD_COUNT_CODE:
+                codes.append(code)
+                values.append(float(val))
+    return SparseGcam(codes, values)
+
+
+def varint(n):
+    """The varint bytes of a non-negative int."""
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def read_varint(data, pos):
+    """Returns the varint at pos in data, and the position after it."""
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def encode_varints(numbers):
+    """
+    The varint bytes of an array of non-negative ints, as a uint8 array, and
+    the number of bytes of each.
+    """
+    numbers = np.asarray(numbers, dtype=np.int64)
+    sizes = np.ones(len(numbers), dtype=np.int64)
+    for i in range(1, MAX_VARINT_BYTES):
+        sizes += numbers >= 1 << (7 * i)
+    owners = np.repeat(np.arange(len(numbers)), sizes)
+    nth = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    out = (numbers[owners] >> (7 * nth)) & 0x7F
+    out |= (nth < sizes[owners] - 1) * 0x80
+    return out.astype(np.uint8), sizes
+
+
+def decode_varints(data):
+    """The ints of a uint8 array of consecutive varints."""
+    last = data < 0x80
+    owners = np.cumsum(last) - last
+    starts = np.flatnonzero(np.concatenate([[True], last[:-1]]))
+    nth = np.arange(len(data)) - starts[owners]
+    # The ints are < 2**35, so the float64 sums are exact
+    parts = (data & 0x7F).astype(np.int64) << (7 * nth)
+    return np.bincount(owners, weights=parts,
+                       minlength=len(starts)).astype(np.int64)
+
+
+def in_ranges(starts, stops, size):
+    """Boolean array of the given size, True in each [start, stop)."""
+    marks = np.zeros(size + 1, dtype=np.int64)
+    np.add.at(marks, starts, 1)
+    np.add.at(marks, stops, -1)
+    return np.cumsum(marks)[:-1] > 0
+
+
+def pack_sparse(ids, values):
+    """
+    Packs the sparse GCAM of each article (see above).
+
+    ids, values: a sequence per article of its code ids (positive, sorted)
+        and their values.
+
+    Returns a list of bytes, one per article.
+    """
+    lengths = np.fromiter((len(x) for x in ids), dtype=np.int64,
+                          count=len(ids))
+    total = lengths.sum()
+    flat_ids = np.fromiter(chain.from_iterable(ids), dtype=np.int64,
+                           count=total)
+    flat_values = np.fromiter(chain.from_iterable(values), dtype=np.float64,
+                              count=total)
+    articles = np.repeat(np.arange(len(ids)), lengths)
+    firsts = (np.cumsum(lengths) - lengths)[lengths > 0]
+    diffs = np.diff(flat_ids, prepend=0)
+    diffs[firsts] = flat_ids[firsts]
+    is_count = ((flat_values == np.floor(flat_values)) &
+                (flat_values >= 0) & (flat_values < MAX_COUNT))
+
+    diff_bytes, diff_sizes = encode_varints(diffs << 1 | ~is_count)
+    count_bytes, count_sizes = encode_varints(flat_values[is_count])
+    float_bytes = flat_values[~is_count].astype('>f4').tobytes()
+    num_floats = np.bincount(articles[~is_count], minlength=len(ids))
+    diff_ends = np.cumsum(np.bincount(articles, weights=diff_sizes,
+                                      minlength=len(ids))).astype(np.int64)
+    count_ends = np.cumsum(np.bincount(articles[is_count],
+                                       weights=count_sizes,
+                                       minlength=len(ids))).astype(np.int64)
+    float_ends = np.cumsum(num_floats) * 4
+
+    diff_bytes, count_bytes = diff_bytes.tobytes(), count_bytes.tobytes()
+    packed = []
+    diff_start = count_start = float_start = 0
+    for n, f, diff_end, count_end, float_end in zip(
+        lengths.tolist(), num_floats.tolist(), diff_ends.tolist(),
+        count_ends.tolist(), float_ends.tolist()
+    ):
+        packed.append(varint(n) + varint(f) +
+                      diff_bytes[diff_start:diff_end] +
+                      count_bytes[count_start:count_end] +
+                      float_bytes[float_start:float_end])
+        diff_start, count_start, float_start = diff_end, count_end, float_end
+    return packed
+
+
+def unpack_sparse(packed):
+    """
+    The ids (int64) and values (float32) arrays of each article from
+    `pack_sparse` (eg. the "gcam" column read back from gdelt_raw).
+    """
+    if not len(packed):
+        return [], []
+    packed = [bytes(data) for data in packed]  # eg. from psycopg2 memoryviews
+    headers = []
+    for data in packed:
+        n, pos = read_varint(data, 0)
+        f, pos = read_varint(data, pos)
+        headers.append((n, f, pos))
+    lengths, num_floats, header_sizes = np.array(
+        headers, dtype=np.int64
+    ).reshape(-1, 3).T
+    sizes = np.fromiter((len(data) for data in packed), dtype=np.int64,
+                        count=len(packed))
+    data = np.frombuffer(b''.join(packed), dtype=np.uint8)
+
+    # Each article is its header, then its varints, then its floats
+    ends = np.cumsum(sizes)
+    floats_start = ends - num_floats * 4
+    numbers = decode_varints(
+        data[in_ranges(ends - sizes + header_sizes, floats_start, len(data))]
+    )
+    floats = data[in_ranges(floats_start, ends, len(data))].view('>f4')
+
+    # The varints of each article are its n id differences, then its counts
+    num_varints = 2 * lengths - num_floats
+    nth = (np.arange(len(numbers)) -
+           np.repeat(np.cumsum(num_varints) - num_varints, num_varints))
+    is_diff = nth < np.repeat(lengths, num_varints)
+    tags = numbers[is_diff]
+    totals = np.concatenate([[0], np.cumsum(tags >> 1)])
+    ids = totals[1:] - np.repeat(totals[np.cumsum(lengths) - lengths], lengths)
+    is_float = (tags & 1).astype(bool)
+    values = np.empty(len(tags), dtype=np.float32)
+    values[is_float] = floats
+    values[~is_float] = numbers[~is_diff]
+    splits = np.cumsum(lengths)[:-1]
+    return np.split(ids, splits), np.split(values, splits)
+
+
+def to_dense(ids, values, wanted_ids, missing=np.nan):
+    """
+    Materialises the wanted codes as dense columns.
+
+    ids, values: a sequence per article of its code ids and their values
+        (eg. from `unpack_sparse`).
+    wanted_ids: the ids of the codes to extract, in the order of the columns.
+
+    Returns a float32 array of shape (number of articles, len(wanted_ids)),
+    with `missing` for the codes an article doesn't have.
+    """
+    wanted_ids = np.asarray(wanted_ids, dtype=np.int64)
+    out = np.full((len(ids), len(wanted_ids)), missing, dtype=np.float32)
+    lengths = np.fromiter((len(x) if x is not None else 0 for x in ids),
+                          dtype=np.int64, count=len(ids))
+    if not lengths.sum() or not len(wanted_ids):
+        return out
+    flat_ids = np.concatenate([x for x, n in zip(ids, lengths) if n],
+                              dtype=np.int64)
+    flat_values = np.concatenate([x for x, n in zip(values, lengths) if n],
+                                 dtype=np.float32)
+    rows = np.repeat(np.arange(len(ids)), lengths)
+
+    # Output column of every id, or -1 for the codes that weren't asked for
+    lookup = np.full(max(flat_ids.max(), wanted_ids.max()) + 1, -1,
+                     dtype=np.int64)
+    lookup[wanted_ids] = np.arange(len(wanted_ids))
+    columns = lookup[flat_ids]
+    keep = columns >= 0
+    out[rows[keep], columns[keep]] = flat_values[keep]
+    return out
+
+
+def dense_from_strings(gcam_strings, codes, missing=np.nan):
+    """
+    Materialises the codes from V2GCAM strings (eg. the "gcam" column of the
+    GKG lake, see gkg_lake.py). Returns a dict of code -> float32 array.
+    """
+    code_ids = {code: i for i, code in enumerate(codes)}
+    ids, values = [], []
+    for gcam in gcam_strings:
+        sparse = parse_gcam(gcam)
+        pairs = [(code_ids[code], value)
+                 for code, value in zip(*sparse) if code in code_ids]
+        ids.append([i for i, _ in pairs])
+        values.append([value for _, value in pairs])
+    dense = to_dense(ids, values, range(len(codes)), missing)
+    return {code: dense[:, i] for i, code in enumerate(codes)}
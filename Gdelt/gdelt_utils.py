@@ -1,3 +1,6 @@
+from collections import namedtuple
+
+
 ID_GDELT_HEADERS = [
     # Non-sentiment information about article
     'gkg_id', 'date', 'source', 'source_name', 'doc_id',
@@ -39,3 +42,34 @@ NONID_GDELT_HEADERS = [
 ]
 
 RAW_GDELT_HEADERS = ID_GDELT_HEADERS + NONID_GDELT_HEADERS
+
+# V2GCAM "DictionaryID.DimensionID" keys for the GCAM entries in
+# NONID_GDELT_HEADERS (same order). Sorted as strings, like the keys in V2GCAM.
+GCAM_CODES = [
+    'c3.1', 'c3.2',
+    *sorted(['c4.' + str(i) for i in range(1, 29)]),
+    'c41.1', 'c41.2', 'c41.3',
+    'c6.4', 'c6.5', 'c6.6',
+    'c7.1', 'c7.2',
+    'v10.1', 'v10.2', 'v11.1'
+]
+
+# Cast into the "location_item" composite type for the database. (The typename
+# must match the variable name so that rows can be pickled between processes.)
+Loc_Item = namedtuple(
+    'Loc_Item',
+    'type full_name country_code ADM1_code lat long feature_id'
+)
+
+
+def get_loc_item(loc_item_str):
+    """
+    Converts a '#'-delimited V1LOCATIONS block into a Loc_Item.
+    """
+    loc_dtypes = [int, str, str, str, float, float, str]
+    parts = loc_item_str.split('#')
+    converted_parts = [
+        new_dtype(item) if item != '' else None 
+        for item, new_dtype in zip(parts, loc_dtypes)
+    ]
+    return Loc_Item(*converted_parts)
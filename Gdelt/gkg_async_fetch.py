@@ -0,0 +1,290 @@
+"""
+Asyncio fetcher for the GKG files, with one pool of keep-alive connections
+shared by all of the downloads.
+
+A bare `requests.get` per file opens a new TCP connection to
+data.gdeltproject.org for every 15-minute file, and the thread pools fix the
+number of downloads at 5 or 35 threads. An AsyncFetcher runs the downloads
+on one event loop with an aiohttp connection pool: at most `max_connections`
+requests at once, at most `per_host` of them to any one host, and idle
+connections are kept open to be reused by the next request.
+
+- `await fetcher.download(url, size, md5)` returns the bytes of a file,
+  checked like gkg_fetch.download_gkg_zip (eg. in gkg_pipeline.py, which
+  sends them to a parse process).
+- `fetch_all(urls, handler)` is for synchronous code: for each url it calls
+  `handler(url, chunks)` in a thread, where chunks iterates over the body as
+  it is read from the connection, so it can be inflated and parsed as it
+  arrives (eg. with gkg_fetch.iter_zip_lines) rather than held in memory.
+
+Running this script compares the download throughput (and the number of
+connections opened) of threads with a bare requests.get, threads with a
+requests.Session each, and the AsyncFetcher, and of streaming the lines with
+threads and with fetch_all, on local GKG zip files served by a local
+keep-alive HTTP server:
+    python -m Gdelt.gkg_async_fetch ../data/*.gkg.csv.zip --repeat 20
+
+Usage:
+    def handler(url, chunks):
+        return parser.csv_rows(iter_zip_lines(chunks))
+    results = fetch_all(gkg_files, handler, max_connections=8)
+"""
+import os
+import asyncio
+import argparse
+import threading
+import concurrent.futures
+from contextlib import asynccontextmanager
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+import aiohttp
+import requests
+
+from Gdelt.gkg_fetch import (
+    CHUNK_SIZE, DOWNLOAD_ATTEMPTS, REQUEST_TIMEOUT, ChecksumError,
+    check_download, download_gkg_zip, iter_gkg_lines, iter_zip_lines
+)
+from adaptive_concurrency import AimdController, AsyncAimdLimiter
+
+MAX_CONNECTIONS = 16
+PER_HOST = 8
+KEEPALIVE_TIMEOUT = 60  # seconds an idle connection is kept open
+# Bytes handed to a handler thread at a time. Bigger than gkg_fetch's
+# CHUNK_SIZE, as each chunk is a round trip to the event loop.
+STREAM_CHUNK_SIZE = CHUNK_SIZE * 8
+
+
+class AsyncFetcher:
+    """
+    Downloads over a shared pool of keep-alive connections. Use as an async
+    context manager, which opens and closes the pool.
+    """
+    def __init__(self, max_connections=MAX_CONNECTIONS, per_host=PER_HOST,
+                 timeout=REQUEST_TIMEOUT):
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.timeout = timeout
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections, limit_per_host=self.per_host,
+            keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(sock_connect=self.timeout,
+                                          sock_read=self.timeout)
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    @asynccontextmanager
+    async def open(self, url):
+        """
+        The response for url, once a connection is free. Raises
+        aiohttp.ClientResponseError for an HTTP error status.
+        """
+        async with self.session.get(url) as r:
+            r.raise_for_status()
+            yield r
+
+    async def iter_chunks(self, url):
+        """Yields the body of url in chunks, as it is read."""
+        async with self.open(url) as r:
+            async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                yield chunk
+
+    async def download(self, url, size=None, md5=None,
+                       attempts=DOWNLOAD_ATTEMPTS):
+        """
+        Returns the bytes of url. If given, the size and md5 are checked and
+        the download retried like gkg_fetch.download_gkg_zip.
+        """
+        for attempt in range(1, attempts + 1):
+            async with self.open(url) as r:
+                data = await r.read()
+            problem = check_download(data, size, md5)
+            if problem is None:
+                return data
+            print(f"{url}: {problem} (attempt {attempt} of {attempts})")
+        raise ChecksumError(f"{url}: {problem} after {attempts} attempts")
+
+
+def iter_sync(content, loop):
+    """
+    Iterates over an aiohttp response body from a thread other than the
+    event loop's, reading each chunk on the loop as it is needed.
+    """
+    while True:
+        chunk = asyncio.run_coroutine_threadsafe(
+            content.read(STREAM_CHUNK_SIZE), loop
+        ).result()
+        if not chunk:
+            return
+        yield chunk
+
+
+async def fetch_all_async(urls, handler, max_connections=MAX_CONNECTIONS,
+                          per_host=PER_HOST, skip=None, controller=None):
+    loop = asyncio.get_running_loop()
+    results = [None] * len(urls)
+    todo = iter(enumerate(urls))
+    if controller is None:
+        # A fixed number of downloads at once
+        controller = AimdController(max_connections, min_limit=max_connections,
+                                    max_limit=max_connections)
+    max_connections = controller.max_limit
+    limiter = AsyncAimdLimiter(controller)
+    executor = concurrent.futures.ThreadPoolExecutor(max_connections)
+
+    async def worker(fetcher):
+        for i, url in todo:
+            try:
+                if skip is not None and await loop.run_in_executor(
+                        executor, skip, url):
+                    continue
+                async with limiter.slot(), fetcher.open(url) as r:
+                    results[i] = await loop.run_in_executor(
+                        executor, handler, url, iter_sync(r.content, loop)
+                    )
+            except Exception as e:
+                print(f"{url} FETCH EXCEPTION: {e}; {type(e)}")
+
+    try:
+        async with AsyncFetcher(max_connections, per_host) as fetcher:
+            await asyncio.gather(*[worker(fetcher)
+                                   for _ in range(max_connections)])
+    finally:
+        executor.shutdown()
+    return results
+
+
+def fetch_all(urls, handler, max_connections=MAX_CONNECTIONS,
+              per_host=PER_HOST, skip=None, controller=None):
+    """
+    Downloads the urls over one connection pool, and calls
+    `handler(url, chunks)` for each in a thread as its response arrives,
+    where chunks is an iterator over the body (so the whole file is never in
+    memory).
+
+    max_connections: downloads (and handler threads) at once.
+    per_host: downloads at once from any one host.
+    skip: optional function of the url, which is called first in a handler
+        thread; if it returns True the url isn't downloaded (eg. because its
+        output already exists).
+    controller: optional AimdController (see adaptive_concurrency.py), which
+        sets the number of downloads at once from their throughput, latency
+        and errors, instead of max_connections (its max_limit is used as
+        max_connections). per_host still caps the downloads from one host.
+
+    Returns the handler's result for each url, or None for urls which were
+    skipped or failed.
+    """
+    return asyncio.run(fetch_all_async(list(urls), handler, max_connections,
+                                       per_host, skip, controller))
+
+
+# Benchmark
+class CountingHandler(SimpleHTTPRequestHandler):
+    """Serves files over HTTP/1.1 keep-alive, counting the connections."""
+    protocol_version = 'HTTP/1.1'
+    num_connections = 0
+
+    def setup(self):
+        super().setup()
+        type(self).num_connections += 1
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(directory):
+    """Serves the directory on a free local port, in a daemon thread."""
+    server = ThreadingHTTPServer(
+        ('127.0.0.1', 0), partial(CountingHandler, directory=directory)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def download_all_threads(urls, num_threads, sessions):
+    local = threading.local()
+
+    def download(url):
+        session = None
+        if sessions:
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            session = local.session
+        return len(download_gkg_zip(url, session=session))
+
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        return sum(executor.map(download, urls))
+
+
+def count_lines_threads(urls, num_threads):
+    local = threading.local()
+
+    def count(url):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return sum(1 for _ in iter_gkg_lines(url, session=local.session))
+
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        return sum(executor.map(count, urls))
+
+
+async def download_all_async(urls, max_connections):
+    async with AsyncFetcher(max_connections, max_connections) as fetcher:
+        sizes = await asyncio.gather(*[fetcher.download(url) for url in urls])
+    return sum(map(len, sizes))
+
+
+def count_lines(url, chunks):
+    return sum(1 for _ in iter_zip_lines(chunks))
+
+
+def compare_fetchers(fpaths, repeat=10, concurrency=MAX_CONNECTIONS):
+    directory = os.path.dirname(os.path.abspath(fpaths[0]))
+    server = serve(directory)
+    base = f"http://127.0.0.1:{server.server_port}/"
+    urls = [base + os.path.basename(fpath) for fpath in fpaths] * repeat
+    methods = {
+        'threads, requests.get': partial(download_all_threads, urls,
+                                         concurrency, False),
+        'threads, Session each': partial(download_all_threads, urls,
+                                         concurrency, True),
+        'AsyncFetcher': lambda: asyncio.run(
+            download_all_async(urls, concurrency)
+        ),
+        'threads, streamed lines': partial(count_lines_threads, urls,
+                                           concurrency),
+        'fetch_all, streamed lines': lambda: sum(
+            fetch_all(urls, count_lines, concurrency, concurrency)
+        ),
+    }
+    for name, method in methods.items():
+        CountingHandler.num_connections = 0
+        start = perf_counter()
+        total = method()
+        seconds = perf_counter() - start
+        print(f"{name}: {len(urls)} files in {seconds:.2f}s "
+              f"({len(urls) / seconds:.0f} files/s, {total=}), "
+              f"{CountingHandler.num_connections} connections")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('fpaths', nargs='+',
+                            help="local GKG .csv.zip files, in one directory")
+    arg_parser.add_argument('--repeat', type=int, default=10,
+                            help="times each file is downloaded")
+    arg_parser.add_argument('--concurrency', type=int, default=MAX_CONNECTIONS)
+    args = arg_parser.parse_args()
+    compare_fetchers(args.fpaths, args.repeat, args.concurrency)
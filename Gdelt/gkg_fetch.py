@@ -0,0 +1,283 @@
+"""
+Streaming download and decompression of the GKG raw data files.
+
+Each GKG file is a zip archive holding a single tab-delimited CSV. Reading the
+whole response (`r.content`) into memory and then opening it with `zipfile`
+means a worker holds the full compressed archive plus the decoded text at the
+same time. Instead, the response is inflated as it arrives so only a few
+chunks of the file are held in memory at any time, regardless of file size.
+
+Usage:
+    for article_num, raw in enumerate(iter_gkg_lines(file_url)):
+        line = raw.split('\t')
+        ...
+"""
+import io, zipfile, zlib
+import struct
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+import requests
+
+CHUNK_SIZE = 8192 * 4  # bytes read from the HTTP response at a time
+INFLATE_LIMIT = CHUNK_SIZE * 8  # max bytes inflated per step
+SPOOL_MAX_SIZE = 1024 * 1024 * 8  # bytes kept in memory before spooling to disk
+REQUEST_TIMEOUT = 60  # seconds
+DOWNLOAD_ATTEMPTS = 3  # downloads of a file before giving up on its checksum
+
+# See section 4.3.7 of the zip APPNOTE for the local file header layout
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+LOCAL_HEADER_SIG = b'PK\x03\x04'
+DATA_DESCRIPTOR_SIG = b'PK\x07\x08'
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+
+class ChecksumError(IOError):
+    """Downloaded file doesn't match the size or md5 in the master list."""
+
+
+class ZipMemberReader(io.RawIOBase):
+    """
+    Read-only file object which inflates the first member of a zip archive
+    from an iterator of bytes chunks (eg. `requests.Response.iter_content`).
+
+    Only the local file header is used, so the central directory at the end of
+    the archive is never needed. The CRC-32 of the inflated data is checked
+    against the local header (or the data descriptor) once the member has been
+    fully read, and zipfile.BadZipFile is raised if they don't match.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b''  # compressed bytes not yet given to decompressor
+        self._out = b''      # inflated bytes not yet read
+        self._eof = False
+        self._crc = 0
+        self._decomp = None
+        self._stored_remaining = None
+        self.member_name = self._read_local_header()
+
+    def readable(self):
+        return True
+
+    def _next_chunk(self):
+        for chunk in self._chunks:
+            if chunk:
+                return chunk
+        raise zipfile.BadZipFile("Zip archive ended before end of member")
+
+    def _take(self, n):
+        """Returns the next n (compressed) bytes of the archive."""
+        while len(self._pending) < n:
+            self._pending += self._next_chunk()
+        taken, self._pending = self._pending[:n], self._pending[n:]
+        return taken
+
+    def _read_local_header(self):
+        (sig, _, flags, method, _, _, crc, comp_size, _,
+         name_len, extra_len) = LOCAL_HEADER.unpack(self._take(LOCAL_HEADER.size))
+        if sig != LOCAL_HEADER_SIG:
+            raise zipfile.BadZipFile("File is not a zip file")
+
+        name = self._take(name_len).decode('utf-8' if flags & FLAG_UTF8
+                                           else 'cp437')
+        self._take(extra_len)
+        # CRC is only in the local header if no data descriptor follows
+        self._expected_crc = None if flags & FLAG_DATA_DESCRIPTOR else crc
+
+        if method == zipfile.ZIP_DEFLATED:
+            self._decomp = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif method == zipfile.ZIP_STORED and not flags & FLAG_DATA_DESCRIPTOR:
+            self._stored_remaining = comp_size
+        else:
+            raise NotImplementedError(
+                f"Cannot stream zip member ({method=}, {flags=})"
+            )
+        return name
+
+    def _read_data_descriptor_crc(self):
+        descriptor = self._take(4)
+        if descriptor == DATA_DESCRIPTOR_SIG:
+            descriptor = self._take(4)
+        return struct.unpack('<I', descriptor)[0]
+
+    def _finish(self):
+        self._eof = True
+        expected_crc = self._expected_crc
+        if expected_crc is None:
+            expected_crc = self._read_data_descriptor_crc()
+        if self._crc != expected_crc:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for {self.member_name}")
+
+    def _inflate_next(self):
+        if self._stored_remaining is not None:
+            if self._stored_remaining == 0:
+                return self._finish()
+            data = self._pending or self._next_chunk()
+            self._out = data[:self._stored_remaining]
+            self._pending = data[self._stored_remaining:]
+            self._stored_remaining -= len(self._out)
+        else:
+            if self._decomp.unconsumed_tail:
+                data = self._decomp.unconsumed_tail
+            else:
+                data, self._pending = self._pending or self._next_chunk(), b''
+            self._out = self._decomp.decompress(data, INFLATE_LIMIT)
+            if self._decomp.eof:
+                self._pending = self._decomp.unused_data
+                self._crc = zlib.crc32(self._out, self._crc)
+                return self._finish()
+        self._crc = zlib.crc32(self._out, self._crc)
+
+    def readinto(self, b):
+        while not self._out and not self._eof:
+            self._inflate_next()
+        n = min(len(b), len(self._out))
+        b[:n] = self._out[:n]
+        self._out = self._out[n:]
+        return n
+
+
+def spool_zip_member(chunks):
+    """
+    Fallback for archives that ZipMemberReader cannot stream. Writes the
+    chunks to a temporary file, which is only held in memory while it is
+    smaller than SPOOL_MAX_SIZE, and opens the first member with `zipfile`.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    for chunk in chunks:
+        spool.write(chunk)
+    spool.seek(0)
+    zf = zipfile.ZipFile(spool)
+    return zf.open(zf.namelist()[0], 'r')
+
+
+def open_zip_member(chunks, spool=False):
+    """
+    Returns a binary file object for the first member of the zip archive given
+    as an iterator of bytes chunks.
+    """
+    chunks = iter(chunks)
+    if spool:
+        return spool_zip_member(chunks)
+    return io.BufferedReader(ZipMemberReader(chunks), CHUNK_SIZE)
+
+
+def iter_zip_lines(chunks, spool=False):
+    """
+    Yields the lines (decoded as latin-1) of the first member of the zip
+    archive given as an iterator of bytes chunks.
+    """
+    member = open_zip_member(chunks, spool=spool)
+    with io.TextIOWrapper(member, encoding='latin-1') as infile:
+        yield from infile
+
+
+@contextmanager
+def open_gkg_file(file_url, session=None, spool=False):
+    """
+    Downloads the GKG zip at file_url and returns a binary file object for the
+    CSV, which is inflated as it is read.
+
+    session: optional requests.Session, so connections can be reused.
+    spool: if True, spool the archive to a bounded temporary file and open it
+        with `zipfile` instead of inflating it on the fly.
+    """
+    getter = session if session is not None else requests
+    with getter.get(file_url, stream=True, timeout=REQUEST_TIMEOUT) as r:
+        r.raise_for_status()
+        with open_zip_member(r.iter_content(CHUNK_SIZE), spool=spool) as infile:
+            yield infile
+
+
+def iter_gkg_lines(file_url, session=None, spool=False):
+    """
+    Downloads the GKG zip at file_url and yields the lines of the CSV as they
+    are inflated. Peak memory is bounded by a few chunks, independent of file
+    size. See open_gkg_file for the arguments.
+    """
+    with open_gkg_file(file_url, session=session, spool=spool) as infile:
+        yield from io.TextIOWrapper(infile, encoding='latin-1')
+
+
+def download_gkg_zip(file_url, session=None, size=None, md5=None,
+                     attempts=DOWNLOAD_ATTEMPTS):
+    """
+    Downloads the GKG zip at file_url and returns the (compressed) bytes, eg.
+    to be inflated and parsed in another process.
+
+    size, md5: if given (eg. from the master list), the download is checked
+        against them and retried up to `attempts` times in total, before
+        raising ChecksumError.
+    """
+    getter = session if session is not None else requests
+    for attempt in range(1, attempts + 1):
+        with getter.get(file_url, stream=True, timeout=REQUEST_TIMEOUT) as r:
+            r.raise_for_status()
+            data = b''.join(r.iter_content(CHUNK_SIZE))
+        problem = check_download(data, size, md5)
+        if problem is None:
+            return data
+        print(f"{file_url}: {problem} (attempt {attempt} of {attempts})")
+    raise ChecksumError(f"{file_url}: {problem} after {attempts} attempts")
+
+
+def check_download(data, size=None, md5=None):
+    """
+    Returns what is wrong with the downloaded bytes, or None if they match
+    the size and md5 (either of which can be None to skip the check).
+    """
+    return _check_digest(len(data), lambda: hashlib.md5(data).hexdigest(),
+                         size, md5)
+
+
+def _check_digest(num_bytes, get_md5, size, md5):
+    if size is not None and num_bytes != size:
+        return f"size {num_bytes} != {size}"
+    if md5 is not None and get_md5() != md5.lower():
+        return "md5 mismatch"
+    return None
+
+
+class CheckedChunks:
+    """
+    Iterator over the bytes chunks of a download, which counts their bytes
+    and updates their md5 as they go by, so a file that is inflated and
+    parsed as it arrives can still be checked against the master list.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._md5 = hashlib.md5()
+        self.num_bytes = 0
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            self.num_bytes += len(chunk)
+            self._md5.update(chunk)
+            yield chunk
+
+    def check(self, file_url, size=None, md5=None):
+        """
+        Reads the rest of the download (the zip reader stops at the end of
+        the member, before the archive's central directory), and raises
+        ChecksumError if it doesn't match the size and md5.
+        """
+        for _ in self:
+            pass
+        problem = _check_digest(self.num_bytes, self._md5.hexdigest,
+                                size, md5)
+        if problem is not None:
+            raise ChecksumError(f"{file_url}: {problem}")
+
+
+@contextmanager
+def stream_gkg_zip(file_url, session=None):
+    """
+    Downloads the GKG zip at file_url, and returns a CheckedChunks over the
+    (compressed) body as it arrives, eg. for iter_zip_lines.
+    """
+    getter = session if session is not None else requests
+    with getter.get(file_url, stream=True, timeout=REQUEST_TIMEOUT) as r:
+        r.raise_for_status()
+        yield CheckedChunks(r.iter_content(CHUNK_SIZE))
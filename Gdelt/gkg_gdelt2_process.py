@@ -1,21 +1,21 @@
 # Quick example to process gkg
 # http://data.gdeltproject.org/documentation/GCAM-MASTER-CODEBOOK.TXT
 
-from operator import itemgetter
-import requests, zipfile, io, csv
+import io, csv
 # from pathos.pools import ProcessPool
 import random
 import os.path
-import concurrent.futures
+
+from Gdelt.gkg_async_fetch import fetch_all
+from Gdelt.gkg_fetch import iter_zip_lines
+from Gdelt.gkg_master_list import update_master_list
+from Gdelt.gkg_parser import GkgParser
+from adaptive_concurrency import AimdController
 
 io.DEFAULT_BUFFER_SIZE = 8192*4
 
-master_list = 'http://data.gdeltproject.org/gdeltv2/masterfilelist.txt'
-r = requests.get(master_list, stream=True)#, proxies=proxies)
-with open('gdelt2_master.txt', mode='wb') as localfile:
-    for line in r.iter_lines():
-        if b'gkg.csv.zip' in line:
-            localfile.write(line + b'\n')
+# Only the new tail of the master list is downloaded - see gkg_master_list.py
+update_master_list('gdelt2_master.txt')
 
 # Read through the file line-by-line
 header = ['gkg_id', 'date', 'source', 'source_name', 'doc_id', 'v1counts',
@@ -24,79 +24,27 @@ header = ['gkg_id', 'date', 'source', 'source_name', 'doc_id', 'v1counts',
           'gcam', 'image1', 'image2', 'image3', 'video1', 'allnames',
           'amounts', 'translation', 'extra']
 
-classification = ['c4.' + str(i) for i in range(1, 29)]
-classification.sort()
-codes = ['c3.1', 'c3.2', 'c41.1', 'c41.2', 'c41.3',
-         'c6.4', 'c6.5', 'c6.6',
-         'c7.1', 'c7.2', 
-         'v10.1', 'v10.2', 'v11.1']
-codes[2:2] = classification
-codes_l = len(codes)
+parser = GkgParser(['NZ'])
 
-def process_gkg(file_name):
-    processed = []
+def is_processed(file_name):
     csv_file = file_name.split('/')[-1][:-4]
-    if os.path.exists('processed_gdelt2/' + csv_file): return
-    print(csv_file)
-    r = requests.get(file_name, stream=True)
-
-    try:
-        with zipfile.ZipFile(io.BytesIO(r.content)) as zf:
-            with zf.open(csv_file, 'r') as infile:
-                for raw in io.TextIOWrapper(infile, encoding='latin-1'):
-
-                    line = raw.split('\t')
-                    if len(line) < 10: continue
-
-                    # Keep stories which reference NZ as a location
-                    locs = line[9].split(';')
-                    inc_nz = False
-                    if locs == ['']: continue
-                    for loc in locs:
-                        if loc.split('#')[3] == 'NZ':
-                            inc_nz = True
-                            break
-                    if not inc_nz: continue
-
-                    # Extract the relevant codes
-                    gcam = line[17].split(',')
-                    code_i = 0
-                    code_v = codes[code_i]
-                    code_l = len(code_v)
-                    out = []
-                    for el in gcam[1:]:
-
-                        gcode, val = el.split(':')
+    return os.path.exists('processed_gdelt2/' + csv_file)
 
-                        # print(gcode, code_v, code_v == gcode)
 
-                        while code_v < gcode:
-                            out.append('')
-                            code_i += 1
-                            if (code_i == codes_l - 1): break
-                            code_v = codes[code_i]
-
-                        if code_v == gcode:
-                            out.append(val)
-                            code_i += 1
-                            if (code_i == codes_l - 1): break
-                            code_v = codes[code_i]
-
-                    if (len(codes) == len(out) + 1): out.append('')
-
-                    # Extract the important information
-                    out[0:0] = line[15].split(',')
-                    out[0:0] = itemgetter(0, 1, 2, 3, 4, 7, 9, 11, 13)(line)
-
-                    processed.append(out)
+def process_gkg(file_name, chunks):
+    """chunks: the body of the zip file, as it's downloaded (see fetch_all)"""
+    csv_file = file_name.split('/')[-1][:-4]
+    print(csv_file)
 
-                if len(processed) > 0:
-                    with open('processed_gdelt2/' + csv_file, 'w+',
-                              encoding='latin-1') as f:
-                        csvf = csv.writer(f, lineterminator = '\n')
-                        csvf.writerows(processed)
+    try:
+        processed = parser.csv_rows(iter_zip_lines(chunks))
+        if len(processed) > 0:
+            with open('processed_gdelt2/' + csv_file, 'w+',
+                      encoding='latin-1') as f:
+                csvf = csv.writer(f, lineterminator = '\n')
+                csvf.writerows(processed)
                         
-                return(True)
+        return(True)
     except: return(False)
 
 
@@ -111,8 +59,12 @@ with open('gdelt2_master.txt') as f:
 # random.shuffle(gkg_files)
 
 if __name__ == '__main__':
-    #for f in gkg_files[::-1]: process_gkg(f)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        executor.map(process_gkg, gkg_files)#[::-1])
+    # Downloads share a pool of keep-alive connections - see gkg_async_fetch.py
+    # - and the number at once adapts to the throughput and throttling
+    # (per_host is the controller's max_limit, as all of the files are on one
+    # host, so the controller rather than the connector limits the downloads)
+    controller = AimdController(5, max_limit=32, name="GKG downloads")
+    fetch_all(gkg_files, process_gkg, per_host=controller.max_limit,
+              skip=is_processed, controller=controller)
 
 print('finished')
@@ -0,0 +1,267 @@
+"""
+A local "lake" of GKG files, converted once to compressed Parquet so that the
+processing scripts can build their extracts (for any countries, themes or
+GCAM codes) without downloading the GKG history from GDELT again.
+
+Each GKG zip becomes one Parquet file, `<lake>/day=YYYY-MM-DD/<file
+timestamp>.parquet` (zstd compressed), holding every article (not just those
+for some countries of interest) with all 27 fields of the file as strings,
+including the full V2GCAM field (LAKE_SCHEMA). Two columns are added:
+- article_num: the line number in the GKG file, which the processing scripts
+  use to build gkg_id,
+- countries: the distinct ADM1 codes of the V1LOCATIONS field (its
+  COUNTRY_FIELD, eg. '#NZ#NZE9#UK#'), which are the country code for
+  country-level mentions and the country's code plus a region code
+  otherwise. So a country filter '#NZ#' is a substring match which picks the
+  articles with a country-level mention of NZ - the same test as
+  GkgParser.iter_relevant, rather than its looser raw-line pre-filter.
+
+The reader functions take a column projection and date/country filters, which
+pyarrow pushes down to the scan: the date filter picks the day directories
+(the other days' files are never opened), and only the projected and
+filtered columns are read and decoded. `iter_lake_lines` turns each file back
+into GKG lines, so GkgParser.db_rows/csv_rows give the same rows as for the
+downloaded file.
+
+Usage:
+    python -m Gdelt.gkg_lake [--since 20210901000000] [--lake DIR]
+    table = read_lake(['source_name', 'tone'], start=date(2021, 9, 1),
+                      countries=['NZ'])
+    for filename_dt, lines in iter_lake_lines(start, end, countries=['NZ'],
+                                              fields=PARSER_FIELDS):
+        rows = parser.db_rows(lines, filename_dt)
+"""
+import os
+import re
+import argparse
+import concurrent.futures
+from datetime import datetime
+from time import perf_counter
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from Gdelt.gkg_fetch import download_gkg_zip, iter_zip_lines
+from Gdelt.gkg_master_list import MasterList, as_entry
+from Gdelt.gkg_parser import COUNTRY_FIELD
+
+LAKE_DIR = os.path.join(os.path.dirname(__file__), 'data', 'gkg_lake')
+MASTER_LIST_FPATH = os.path.join(os.path.dirname(__file__), 'data',
+                                 'gdelt2_master.txt')
+NUM_WORKERS = os.cpu_count() or 1
+# The fields of a GKG 2.1 line, named as in process_v2/gkg_vectorized.py
+GKG_FIELDS = [
+    'gkg_id', 'date', 'source', 'source_name', 'doc_id', 'v1counts',
+    'v2counts', 'v1themes', 'v2themes', 'v1locations', 'v2locations',
+    'v1persons', 'v2persons', 'v1org', 'v2org', 'tone', 'mention_dates',
+    'gcam', 'image', 'related_images', 'social_images', 'social_videos',
+    'quotations', 'allnames', 'amounts', 'translation', 'extra',
+]
+# The fields read by GkgParser, eg. for iter_lake_lines(fields=PARSER_FIELDS)
+PARSER_FIELDS = ['gkg_id', 'date', 'source', 'source_name', 'doc_id',
+                 'v1themes', 'v1locations', 'v1persons', 'v1org', 'tone',
+                 'gcam']
+LAKE_SCHEMA = pa.schema(
+    [('article_num', pa.int32()), ('countries', pa.string())]
+    + [(field, pa.string()) for field in GKG_FIELDS]
+)
+PARTITIONING = ds.partitioning(pa.schema([('day', pa.date32())]),
+                               flavor='hive')
+
+
+def get_filename_dt(path_or_url):
+    return re.search(r'(\d{14}).gkg.csv.zip$', path_or_url).group(1)
+
+
+def lake_fpath(filename_dt, lake_dir=LAKE_DIR):
+    day = datetime.strptime(filename_dt[:8], '%Y%m%d').date()
+    return os.path.join(lake_dir, f'day={day}', f'{filename_dt}.parquet')
+
+
+def line_countries(v1locations):
+    """
+    The distinct ADM1 codes (COUNTRY_FIELD) of a V1LOCATIONS field, as
+    '#NZ#NZE9#UK#'. The ADM1 code is the country code only for country-level
+    mentions, as GkgParser's relevance test expects.
+    """
+    codes = set()
+    for loc in v1locations.split(';'):
+        parts = loc.split('#')
+        if len(parts) > COUNTRY_FIELD and parts[COUNTRY_FIELD]:
+            codes.add(parts[COUNTRY_FIELD])
+    return f"#{'#'.join(sorted(codes))}#" if codes else ''
+
+
+def lines_to_table(lines):
+    """
+    Converts the lines of a GKG file to a Table of LAKE_SCHEMA. Fields beyond
+    the 27th are kept (tab-joined) in 'extra', and missing fields are null,
+    so `iter_lake_lines` gives back the same lines.
+    """
+    num_fields = len(GKG_FIELDS)
+    columns = [[] for _ in GKG_FIELDS]
+    countries = []
+    for raw in lines:
+        fields = raw.rstrip('\n').split('\t', num_fields - 1)
+        fields += [None] * (num_fields - len(fields))
+        for column, field in zip(columns, fields):
+            column.append(field)
+        countries.append(line_countries(fields[9] or ''))
+    return pa.Table.from_arrays(
+        [pa.array(range(len(countries)), pa.int32()),
+         pa.array(countries, pa.string()),
+         *(pa.array(column, pa.string()) for column in columns)],
+        schema=LAKE_SCHEMA
+    )
+
+
+def add_gkg_file(gkg_file, lake_dir=LAKE_DIR):
+    """
+    Downloads a GKG zip (MasterEntry, url, or local path) and writes it to
+    the lake. Returns the number of articles.
+    """
+    entry = as_entry(gkg_file)
+    if os.path.exists(entry.url):
+        with open(entry.url, 'rb') as f:
+            data = f.read()
+    else:
+        data = download_gkg_zip(entry.url, size=entry.size, md5=entry.md5)
+    table = lines_to_table(iter_zip_lines([data]))
+    fpath = lake_fpath(get_filename_dt(entry.url), lake_dir)
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    # Written under a temporary (hidden) name, so a partly written file is
+    # never taken for a converted one
+    tmp_fpath = os.path.join(os.path.dirname(fpath),
+                             '.' + os.path.basename(fpath))
+    pq.write_table(table, tmp_fpath, compression='zstd')
+    os.replace(tmp_fpath, fpath)
+    return table.num_rows
+
+
+def build_lake(gkg_files, lake_dir=LAKE_DIR, num_workers=NUM_WORKERS):
+    """
+    Adds the GKG files (MasterEntry, urls or local paths) which aren't
+    already in the lake, in a process pool. Returns the number added.
+    """
+    todo = [
+        gkg_file for gkg_file in gkg_files
+        if not os.path.exists(lake_fpath(
+            get_filename_dt(as_entry(gkg_file).url), lake_dir
+        ))
+    ]
+    print(f"Adding {len(todo)} files to {lake_dir}")
+    num_added = 0
+    with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+        futures = {executor.submit(add_gkg_file, gkg_file, lake_dir): gkg_file
+                   for gkg_file in todo}
+        for future in concurrent.futures.as_completed(futures):
+            url = as_entry(futures[future]).url
+            try:
+                num_rows = future.result()
+            except Exception as e:
+                print(f"{url} EXCEPTION: {e}; {type(e)}")
+                continue
+            num_added += 1
+            print(f"{get_filename_dt(url)}: {num_rows} articles")
+    return num_added
+
+
+# Reading
+def lake_dataset(lake_dir=LAKE_DIR):
+    return ds.dataset(lake_dir, format='parquet', partitioning=PARTITIONING)
+
+
+def lake_filter(start=None, end=None, countries=None):
+    """
+    Filter expression for the articles published from start to end
+    (inclusive dates), with a country-level mention of any of the countries
+    (see `line_countries`).
+    """
+    conditions = []
+    if start is not None:
+        conditions.append(ds.field('day') >= pa.scalar(start, pa.date32()))
+    if end is not None:
+        conditions.append(ds.field('day') <= pa.scalar(end, pa.date32()))
+    if countries:
+        mentions = [pc.match_substring(ds.field('countries'), f'#{country}#')
+                    for country in countries]
+        any_country = mentions[0]
+        for mention in mentions[1:]:
+            any_country = any_country | mention
+        conditions.append(any_country)
+    if not conditions:
+        return None
+    expression = conditions[0]
+    for condition in conditions[1:]:
+        expression = expression & condition
+    return expression
+
+
+def read_lake(columns=None, start=None, end=None, countries=None,
+              lake_dir=LAKE_DIR):
+    """
+    Returns a Table of the given columns (default: all) of the articles from
+    start to end which mention any of the countries.
+    """
+    return lake_dataset(lake_dir).to_table(
+        columns=columns, filter=lake_filter(start, end, countries)
+    )
+
+
+def iter_lake_batches(columns=None, start=None, end=None, countries=None,
+                      lake_dir=LAKE_DIR):
+    """Like read_lake, but yields RecordBatches, so memory stays bounded."""
+    yield from lake_dataset(lake_dir).to_batches(
+        columns=columns, filter=lake_filter(start, end, countries)
+    )
+
+
+def iter_lake_lines(start=None, end=None, countries=None, fields=GKG_FIELDS,
+                    lake_dir=LAKE_DIR):
+    """
+    Yields (filename_dt, lines) for each GKG file in the lake from start to
+    end, in time order, where lines are the file's lines (articles which
+    don't mention any of the countries are blank, to keep the line numbers).
+    Only the given fields are read - the others are left empty.
+    """
+    fragments = sorted(
+        lake_dataset(lake_dir).get_fragments(filter=lake_filter(start, end)),
+        key=lambda fragment: os.path.basename(fragment.path)
+    )
+    columns = ['article_num'] + [field for field in GKG_FIELDS
+                                 if field in fields]
+    for fragment in fragments:
+        table = fragment.to_table(columns=columns,
+                                  filter=lake_filter(countries=countries))
+        lines = [''] * (pc.max(table['article_num']).as_py() + 1
+                        if table.num_rows else 0)
+        values = {name: table[name].to_pylist() for name in columns}
+        for i, article_num in enumerate(values['article_num']):
+            line = [values[field][i] if field in values else ''
+                    for field in GKG_FIELDS]
+            while line[-1] is None:
+                line.pop()  # fields missing from the original line
+            lines[article_num] = '\t'.join(line)
+        yield os.path.basename(fragment.path)[:14], lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*',
+                        help="GKG zip files or urls (default: every GKG file "
+                             "in the master list)")
+    parser.add_argument('--since', help="only files from this timestamp "
+                                        "(YYYYMMDDHHMMSS)")
+    parser.add_argument('--lake', default=LAKE_DIR)
+    args = parser.parse_args()
+
+    gkg_files = args.files
+    if not gkg_files:
+        master_list = MasterList(MASTER_LIST_FPATH)
+        master_list.update()
+        gkg_files = master_list.entries(since=args.since)
+    start = perf_counter()
+    num_added = build_lake(gkg_files, args.lake)
+    print(f"Added {num_added} files in {perf_counter() - start:.1f}s")
@@ -0,0 +1,292 @@
+"""
+Incrementally updated local copy of the GKG entries in GDELT's master file
+list, shared by all of the GKG processing scripts.
+
+masterfilelist.txt has a "<size> <md5> <url>" line for every file GDELT has
+published, is append-only and grows every 15 minutes. Rather than downloading
+all of it on every run, the byte offset reached in the remote file is kept in
+a sidecar ("<fpath>.state") and only the new tail is requested with an HTTP
+Range request. The gkg.csv.zip lines are appended to the local file, which
+keeps the same format as the master list (so it is sorted by timestamp and
+can be searched with `MasterList.entries(since=...)`).
+
+If the master list can't be fetched, lastupdate.txt is used to at least add
+the newest GKG file for this run. It isn't written to the local file, so
+the gap is filled from the master list on the next successful update.
+
+LastUpdatePoller polls lastupdate.txt for the newest GKG file as it is
+published, for long-running ingests (eg. `gkg_raw_to_db.py --follow`), and
+`catch_up_entries` lists the files published since a timestamp without
+fetching the master list.
+
+Usage:
+    gkg_files = update_master_list('gdelt2_master.txt')  # list of urls
+    entries = schedule_by_size(MasterList('gdelt2_master.txt').entries()[::-1])
+"""
+import os
+import re
+import json
+import bisect
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import requests
+
+MASTER_LIST_URL = 'http://data.gdeltproject.org/gdeltv2/masterfilelist.txt'
+LAST_UPDATE_URL = 'http://data.gdeltproject.org/gdeltv2/lastupdate.txt'
+REQUEST_TIMEOUT = 60  # seconds
+GKG_SUFFIX = b'gkg.csv.zip'
+SCHEDULE_WINDOW = 96  # files reordered together by schedule_by_size (1 day)
+FILE_INTERVAL = timedelta(minutes=15)  # between GDELT's files
+DT_FORMAT = '%Y%m%d%H%M%S'
+
+MasterEntry = namedtuple('MasterEntry', 'size md5 url')
+
+
+def as_entry(file):
+    """Wraps a plain url as a MasterEntry without a size or md5."""
+    if isinstance(file, MasterEntry):
+        return file
+    return MasterEntry(None, None, file)
+
+
+def schedule_by_size(entries, window=SCHEDULE_WINDOW):
+    """
+    Reorders the entries largest-first within each run of `window` entries.
+    Starting the biggest files first (longest-processing-time-first) stops a
+    large file that happens to be near the end of the list from leaving the
+    other workers idle, while the list as a whole keeps its order (eg. newest
+    first). Entries without a size are treated as size 0.
+    """
+    scheduled = []
+    for i in range(0, len(entries), window):
+        scheduled += sorted(entries[i:i + window],
+                            key=lambda entry: entry.size or 0, reverse=True)
+    return scheduled
+
+
+def parse_master_line(line):
+    """Parses a "<size> <md5> <url>" line, or returns None if malformed."""
+    parts = line.strip().split(' ')
+    if len(parts) != 3 or not parts[0].isdigit():
+        return None
+    return MasterEntry(int(parts[0]), parts[1], parts[2])
+
+
+def get_entry_dt(url):
+    """Returns the 'YYYYMMDDHHMMSS' timestamp in a GDELT file url."""
+    match = re.search(r'(\d{14})\.[^/]*$', url)
+    return match.group(1) if match else ''
+
+
+def parse_last_update(content, suffix=GKG_SUFFIX):
+    """
+    Returns the entries in the bytes of lastupdate.txt whose url ends with
+    suffix.
+    """
+    entries = [parse_master_line(line.decode('utf-8', 'replace'))
+               for line in content.splitlines()
+               if line.strip().endswith(suffix)]
+    return [entry for entry in entries if entry is not None]
+
+
+def catch_up_entries(latest, last_dt=None, max_files=SCHEDULE_WINDOW):
+    """
+    Returns the entries of the files published after last_dt
+    ('YYYYMMDDHHMMSS') up to and including latest (eg. from lastupdate.txt),
+    oldest first. The urls of the earlier files are made from their 15-minute
+    timestamps, so they have no size or md5 (and GDELT has occasionally
+    skipped a file). If more than max_files were published, only the newest
+    max_files are returned.
+    """
+    latest_dt = get_entry_dt(latest.url)
+    base_url, filename = latest.url.rsplit('/', 1)
+    entries = [latest]
+    if last_dt:
+        dt = datetime.strptime(latest_dt, DT_FORMAT) - FILE_INTERVAL
+        while (dt.strftime(DT_FORMAT) > last_dt and
+               len(entries) < max_files):
+            entries.append(as_entry(
+                f"{base_url}/"
+                f"{filename.replace(latest_dt, dt.strftime(DT_FORMAT))}"
+            ))
+            dt -= FILE_INTERVAL
+    return entries[::-1]
+
+
+class LastUpdatePoller:
+    """
+    Polls lastupdate.txt for the newest GKG file. The requests are
+    conditional (If-None-Match / If-Modified-Since), so while the file is
+    unchanged each poll is a 304 response without a body.
+    """
+    def __init__(self, url=LAST_UPDATE_URL, suffix=GKG_SUFFIX, session=None):
+        self.url = url
+        self.suffix = suffix
+        self.session = session if session is not None else requests.Session()
+        self.latest = None
+        self._validators = {}
+
+    def poll(self):
+        """
+        Returns the MasterEntry of the newest GKG file (or None if
+        lastupdate.txt doesn't list one). Raises requests.RequestException if
+        it can't be fetched.
+        """
+        with self.session.get(self.url, headers=self._validators,
+                              timeout=REQUEST_TIMEOUT) as r:
+            if r.status_code == 304:
+                return self.latest
+            r.raise_for_status()
+            content = r.content
+        entries = parse_last_update(content, self.suffix)
+        self.latest = max(entries, key=lambda entry: get_entry_dt(entry.url),
+                          default=None)
+        self._validators = {
+            header: r.headers[name] for header, name in
+            [('If-None-Match', 'ETag'), ('If-Modified-Since', 'Last-Modified')]
+            if name in r.headers
+        }
+        return self.latest
+
+
+class MasterList:
+    """
+    Local, filtered copy of masterfilelist.txt at fpath, holding only the
+    lines whose url ends with `suffix`.
+    """
+    def __init__(self, fpath, master_list_url=MASTER_LIST_URL,
+                 last_update_url=LAST_UPDATE_URL, suffix=GKG_SUFFIX,
+                 session=None):
+        self.fpath = fpath
+        self.state_fpath = f'{fpath}.state'
+        self.master_list_url = master_list_url
+        self.last_update_url = last_update_url
+        self.suffix = suffix
+        self.session = session if session is not None else requests.Session()
+        self._latest = []  # entries from lastupdate.txt, for this run only
+
+    def _read_state(self):
+        if not os.path.exists(self.fpath):
+            return {'offset': 0, 'last_dt': ''}
+        try:
+            with open(self.state_fpath) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        if state.get('source') != self.master_list_url:
+            # Unknown offset, so rebuild the local file from scratch
+            return {'offset': 0, 'last_dt': ''}
+        return state
+
+    def _write_state(self, state):
+        state['source'] = self.master_list_url
+        tmp_fpath = f'{self.state_fpath}.tmp'
+        with open(tmp_fpath, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_fpath, self.state_fpath)
+
+    def _fetch_tail(self, offset):
+        """
+        Returns the bytes of the master list from offset onwards, or None if
+        the remote file no longer matches what has been seen (so it must be
+        read again from the start).
+
+        The request starts one byte early, which must be the newline ending
+        the last line already seen.
+        """
+        start = max(offset - 1, 0)
+        headers = {'Range': f'bytes={start}-'} if offset else {}
+        with self.session.get(self.master_list_url, headers=headers,
+                              stream=True, timeout=REQUEST_TIMEOUT) as r:
+            if r.status_code == 416:
+                return None  # the file is shorter than what has been seen
+            r.raise_for_status()
+            data = r.content
+        if offset == 0:
+            return data
+        if r.status_code == 200:
+            data = data[start:]  # Range was ignored, so skip what's been seen
+        return data[1:] if data[:1] == b'\n' else None
+
+    def update(self):
+        """
+        Appends the new GKG entries in the remote master list to the local
+        file. Returns the number of entries added. Falls back to
+        lastupdate.txt if the master list can't be fetched.
+        """
+        state = self._read_state()
+        try:
+            tail = self._fetch_tail(state['offset'])
+            if tail is None:
+                state = {'offset': 0, 'last_dt': ''}
+                tail = self._fetch_tail(0)
+        except requests.RequestException as e:
+            print(f"Exception fetching master list: {e}; {type(e)}")
+            self._latest = self._fetch_last_update()
+            return 0
+
+        # Only whole lines are used, so a partly-written last line is
+        # fetched again on the next update
+        complete = tail[:tail.rfind(b'\n') + 1]
+        new_lines = []
+        last_dt = state['last_dt']
+        for line in complete.splitlines():
+            entry = parse_master_line(line.decode('utf-8', 'replace'))
+            if entry is None or not entry.url.encode().endswith(self.suffix):
+                continue
+            entry_dt = get_entry_dt(entry.url)
+            if entry_dt <= last_dt:
+                continue  # already in the local file
+            new_lines.append(line + b'\n')
+            last_dt = entry_dt
+
+        with open(self.fpath, 'wb' if state['offset'] == 0 else 'ab') as f:
+            f.writelines(new_lines)
+        self._write_state({'offset': state['offset'] + len(complete),
+                           'last_dt': last_dt})
+        self._latest = []
+        return len(new_lines)
+
+    def _fetch_last_update(self):
+        """Returns the GKG entry in lastupdate.txt (as a list)."""
+        try:
+            with self.session.get(self.last_update_url,
+                                  timeout=REQUEST_TIMEOUT) as r:
+                r.raise_for_status()
+                content = r.content
+        except requests.RequestException as e:
+            print(f"Exception fetching last update: {e}; {type(e)}")
+            return []
+        last_dt = self._read_state().get('last_dt', '')
+        return [entry for entry in parse_last_update(content, self.suffix)
+                if get_entry_dt(entry.url) > last_dt]
+
+    def entries(self, since=None):
+        """
+        Returns the MasterEntry of every file, oldest first, optionally only
+        those with a timestamp >= since ('YYYYMMDDHHMMSS').
+        """
+        entries = []
+        if os.path.exists(self.fpath):
+            with open(self.fpath) as f:
+                entries = [entry for entry in map(parse_master_line, f)
+                           if entry is not None]
+        entries += self._latest
+        if since is not None:
+            dts = [get_entry_dt(entry.url) for entry in entries]
+            entries = entries[bisect.bisect_left(dts, since):]
+        return entries
+
+    def urls(self, since=None):
+        return [entry.url for entry in self.entries(since)]
+
+
+def update_master_list(fpath, **kwargs):
+    """
+    Updates the local master list at fpath and returns the url of every GKG
+    file, oldest first. kwargs are passed to MasterList.
+    """
+    master_list = MasterList(fpath, **kwargs)
+    master_list.update()
+    return master_list.urls()
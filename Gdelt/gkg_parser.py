@@ -0,0 +1,231 @@
+"""
+Parser for the lines of GKG raw data files, shared by all of the GKG
+processing scripts.
+
+A GkgParser is configured once with the countries and GCAM codes of interest,
+and builds its lookups up front:
+- lines are pre-filtered with a substring test for "#<country code>#" before
+  being split into fields, since most articles don't mention any country of
+  interest,
+- GCAM values are found with a dict lookup (or a substring search, if only a
+  few codes are wanted) rather than merging two sorted lists,
+- the timestamp parse is cached, since almost every article in a file has the
+  same DATE.
+
+The database rows hold numbers rather than the strings in the file: the
+V1.5TONE values and GCAM value dimensions ('v' codes) are floats, and the
+word count, source and GCAM count dimensions ('c' codes) are ints. With
+`full_gcam=True`, each row also ends with the whole V2GCAM field as a
+SparseGcam of (codes, values) (see gcam_sparse.py), for the "gcam" column.
+
+Usage:
+    parser = GkgParser(['NZ', 'AS'])
+    db_rows = parser.db_rows(iter_gkg_lines(file_url), filename_dt)
+    for chunk in iter_row_chunks(
+            parser.iter_db_rows(iter_gkg_lines(file_url), filename_dt),
+            max_rows=5000, max_bytes=2**24):
+        writer(chunk)
+    csv_rows = parser.csv_rows(iter_gkg_lines(file_url))
+"""
+from datetime import datetime
+from functools import lru_cache
+from operator import itemgetter
+
+from Gdelt.gcam_sparse import parse_gcam
+from Gdelt.gdelt_utils import GCAM_CODES, get_loc_item
+
+# Index of the '#'-delimited field of a V1LOCATIONS block that is compared to
+# the countries of interest. This is the ADM1 code, which is the country code
+# for country-level mentions.
+COUNTRY_FIELD = 3
+# Up to this many GCAM codes, each code is found by searching the GCAM string
+# rather than splitting the whole string.
+MAX_SEARCHED_CODES = 8
+
+# gkg_id, date, source, source_name, doc_id, v1themes, v1locations,
+# v1persons, v1org
+get_article_info = itemgetter(0, 1, 2, 3, 4, 7, 9, 11, 13)
+
+
+@lru_cache(maxsize=64)
+def parse_gkg_datetime(dt_str):
+    return datetime.strptime(dt_str, '%Y%m%d%H%M%S')
+
+
+def to_number(convert, value):
+    """Converts a numeric string, or returns None if it is missing/empty."""
+    return convert(value) if value else None
+
+
+# tone, pos, neg, polarity, ard, srd, wc
+TONE_TYPES = [float] * 6 + [int]
+
+
+def get_gcam_type(code):
+    """GCAM count dimensions ('c...') are ints, value dimensions floats."""
+    return int if code.startswith('c') else float
+
+
+def split_list_field(field):
+    """Splits a ';'-delimited field into a list, dropping empty strings."""
+    return [x for x in field.split(';') if x] if field else []
+
+
+class GkgParser:
+    """
+    Parses GKG lines into rows for the articles which reference any of the
+    given countries, with the values of the given GCAM codes (and all of the
+    GCAM codes, as a SparseGcam, if full_gcam).
+    """
+    def __init__(self, countries, gcam_codes=GCAM_CODES, full_gcam=False):
+        self.countries = frozenset(countries)
+        self.gcam_codes = list(gcam_codes)
+        self.full_gcam = full_gcam
+        self._needles = [f'#{c}#' for c in self.countries]
+        self._gcam_index = {code: i for i, code in enumerate(self.gcam_codes)}
+        self._gcam_searches = [
+            (f',{code}:', len(code) + 2) for code in self.gcam_codes
+        ]
+        self._gcam_types = [get_gcam_type(code) for code in self.gcam_codes]
+
+    def tone_numbers(self, values):
+        """Converts the values of the V1.5TONE field to numbers."""
+        return [to_number(convert, value)
+                for convert, value in zip(TONE_TYPES, values)]
+
+    def gcam_numbers(self, values):
+        """Converts the values from `gcam_values` to numbers."""
+        return [to_number(convert, value)
+                for convert, value in zip(self._gcam_types, values)]
+
+    def iter_relevant(self, lines):
+        """
+        Yields (article_num, fields, relevant_codes) for each line which
+        references any country of interest, where relevant_codes lists the
+        country code of every relevant location (including repeats).
+        """
+        needles, countries = self._needles, self.countries
+        for article_num, raw in enumerate(lines):
+            if not any(needle in raw for needle in needles):
+                continue  # no countries of interest mentioned anywhere
+            line = raw.split('\t')
+            if len(line) < 10 or not line[9]:
+                continue  # no locations detected by gdelt
+
+            relevant_codes = []
+            for loc in line[9].split(';'):
+                country_code = loc.split('#')[COUNTRY_FIELD]
+                if country_code in countries:
+                    relevant_codes.append(country_code)
+            if relevant_codes:
+                yield article_num, line, relevant_codes
+
+    def gcam_values(self, gcam, missing=None):
+        """
+        Returns the value of each GCAM code of interest in the V2GCAM field,
+        or `missing` for codes that are absent.
+        """
+        if len(self.gcam_codes) <= MAX_SEARCHED_CODES:
+            out = []
+            for needle, offset in self._gcam_searches:
+                start = gcam.find(needle)
+                if start == -1:
+                    out.append(missing)
+                    continue
+                end = gcam.find(',', start + offset)
+                out.append(gcam[start + offset:end if end != -1 else None])
+            return out
+
+        out = [missing] * len(self.gcam_codes)
+        gcam_index = self._gcam_index
+        # gcam[0] is word count ("wc"), which is never a code of interest
+        for el in gcam.split(','):
+            code, _, val = el.partition(':')
+            i = gcam_index.get(code)
+            if i is not None:
+                out[i] = val
+        return out
+
+    def iter_db_rows(self, lines, filename_dt):
+        """
+        Yields a row tuple for the "gdelt_raw" table for each relevant article
+        of the GKG file published at filename_dt, so the rows of a file can be
+        written in chunks (see `iter_row_chunks`).
+
+        The ID field is constructed from scratch, as some raw data files have
+        corrupted/non-unique GKGRECORDID fields (see gkg_raw_to_db.py).
+        """
+        translated_prefix = f'{filename_dt}-T'
+        for article_num, line, relevant_codes in self.iter_relevant(lines):
+            # 'T' in ID suffix should be preserved, as it indicates if an
+            # article is translated.
+            synthetic_gkg_id = (
+                f"{filename_dt}-T{article_num}"
+                if translated_prefix in line[0]
+                else f"{filename_dt}-{article_num}"
+            )
+            row = (
+                synthetic_gkg_id,
+                parse_gkg_datetime(line[1]),
+                int(line[2]), line[3], line[4],
+                split_list_field(line[7]),                        # themes
+                [get_loc_item(loc) for loc in line[9].split(';')],
+                split_list_field(line[11]),                       # persons
+                split_list_field(line[13]),                       # orgs
+                relevant_codes,                                   # countries
+                *self.tone_numbers(line[15].split(',')),         # V1.5TONE
+                *self.gcam_numbers(self.gcam_values(line[17]))    # V2GCAM
+            )
+            if self.full_gcam:
+                row += (parse_gcam(line[17]),)
+            yield row
+
+    def db_rows(self, lines, filename_dt):
+        """
+        Returns a list of row tuples for the "gdelt_raw" table, for the GKG file
+        published at filename_dt.
+        """
+        return list(self.iter_db_rows(lines, filename_dt))
+
+    def csv_rows(self, lines):
+        """
+        Returns a list of rows for the CSV outputs: the raw article info.
+        fields, then V1.5TONE, then the GCAM codes ('' if absent).
+        """
+        return [
+            [*get_article_info(line), *line[15].split(','),
+             *self.gcam_values(line[17], missing='')]
+            for _, line, _ in self.iter_relevant(lines)
+        ]
+
+
+def row_nbytes(value):
+    """
+    Approximate size of a row's values: the length of each string, and 8
+    bytes per number. Used to bound the size of a chunk of rows, not to
+    measure memory exactly (Python objects are several times bigger).
+    """
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(row_nbytes(x) for x in value)
+    return 8
+
+
+def iter_row_chunks(rows, max_rows=None, max_bytes=None):
+    """
+    Groups an iterable of rows into lists of at most max_rows rows, each
+    ending at the first row which takes it to max_bytes (see `row_nbytes`),
+    so only one chunk is held at a time.
+    """
+    chunk, chunk_bytes = [], 0
+    for row in rows:
+        chunk.append(row)
+        if max_bytes is not None:
+            chunk_bytes += row_nbytes(row)
+        if ((max_rows is not None and len(chunk) >= max_rows) or
+                (max_bytes is not None and chunk_bytes >= max_bytes)):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+    if chunk:
+        yield chunk
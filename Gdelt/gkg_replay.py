@@ -0,0 +1,271 @@
+"""
+Local stand-in for data.gdeltproject.org which replays historical GKG files
+as if they were being published, to test the follow mode of gkg_raw_to_db.py
+(or anything else that polls lastupdate.txt) and the tail fetch of
+gkg_master_list.MasterList without waiting for GDELT.
+
+The files are published one at a time, in timestamp order, every `interval`
+seconds (GDELT publishes every 15 minutes): lastupdate.txt lists the newest
+published file with its size and md5, like GDELT's, and a file is served
+once it has been published (404 before then). lastupdate.txt has an ETag and
+Last-Modified, so conditional polls get a 304 while it is unchanged.
+
+masterfilelist.txt lists every published file, after a line for an export
+file of the same timestamp (as GDELT's list mixes the file types), and
+honours Range requests (206, or 416 past the end). The cases MasterList has
+to handle can be switched on: `ignore_range` (a 200 with the whole file),
+`partial_line` (the next file's line is half written), `master_list_down`
+(503) and `rotate()` (the file is rewritten, so the offsets seen so far no
+longer match). `--check-master-list` runs MasterList.update through each of
+them.
+
+Usage:
+    python -m Gdelt.gkg_replay ../data/20210901*.gkg.csv.zip --interval 30
+    python -m Gdelt.process_v2.gkg_raw_to_db --follow \\
+        --last-update-url http://127.0.0.1:8000/lastupdate.txt
+    python -m Gdelt.gkg_replay ../data/20210901*.gkg.csv.zip \\
+        --check-master-list
+"""
+import os
+import re
+import hashlib
+import argparse
+import tempfile
+import threading
+from email.utils import formatdate
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+
+from Gdelt.gkg_master_list import MasterList, get_entry_dt
+
+INTERVAL = 15 * 60  # seconds between files, as on GDELT
+PORT = 8000
+
+
+class ReplayHandler(SimpleHTTPRequestHandler):
+    """Serves lastupdate.txt and the published files of `server.replay`."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        replay = self.server.replay
+        name = self.path.lstrip('/')
+        if name == 'lastupdate.txt':
+            self.send_last_update(replay)
+        elif name == 'masterfilelist.txt':
+            self.send_master_list(replay)
+        elif name in replay.published():
+            super().do_GET()
+        else:
+            self.send_error(404)
+
+    def send_last_update(self, replay):
+        name = replay.published()[-1]
+        etag = f'"{name}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = replay.master_line(name)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified',
+                         formatdate(replay.published_at(name), usegmt=True))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_master_list(self, replay):
+        if replay.master_list_down:
+            self.send_error(503)
+            return
+        body = replay.master_list()
+        match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match and not replay.ignore_range:
+            start = int(match.group(1))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             f'bytes {start}-{len(body) - 1}/{len(body)}')
+            body = body[start:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Replay:
+    """
+    Replays the GKG zip files at fpaths (in one directory), starting with
+    the first published when the server starts, on a local port (0 for any
+    free port). Use `start()` to serve in a daemon thread and `shutdown()`.
+    """
+    def __init__(self, fpaths, interval=INTERVAL, port=PORT):
+        fpaths = sorted(fpaths, key=get_entry_dt)
+        directory = os.path.dirname(os.path.abspath(fpaths[0]))
+        self.names = [os.path.basename(fpath) for fpath in fpaths]
+        self.checksums = {}
+        for fpath in fpaths:
+            with open(fpath, 'rb') as f:
+                data = f.read()
+            self.checksums[os.path.basename(fpath)] = (
+                len(data), hashlib.md5(data).hexdigest()
+            )
+        self.interval = interval
+        self.ignore_range = False
+        self.partial_line = False
+        self.master_list_down = False
+        self.with_exports = True
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', port), partial(ReplayHandler, directory=directory)
+        )
+        self.server.replay = self
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}/"
+        self.last_update_url = self.base_url + 'lastupdate.txt'
+        self.master_list_url = self.base_url + 'masterfilelist.txt'
+        self.start_time = time()
+
+    def published(self):
+        """The names of the files published so far."""
+        num_published = int((time() - self.start_time) // self.interval) + 1
+        return self.names[:num_published]
+
+    def published_at(self, name):
+        return self.start_time + self.names.index(name) * self.interval
+
+    def advance(self, num_files=1):
+        """Publishes the next num_files files now."""
+        self.start_time -= num_files * self.interval
+
+    def master_line(self, name):
+        size, md5 = self.checksums[name]
+        return f"{size} {md5} {self.base_url}{name}\n".encode()
+
+    def master_list(self):
+        """
+        The bytes of masterfilelist.txt, with the first half of the next
+        file's line if partial_line.
+        """
+        published = self.published()
+        lines = []
+        for name in published:
+            if self.with_exports:
+                lines.append(self.master_line(name).replace(
+                    b'.gkg.csv.zip', b'.export.CSV.zip'
+                ))
+            lines.append(self.master_line(name))
+        if self.partial_line and len(published) < len(self.names):
+            next_line = self.master_line(self.names[len(published)])
+            lines.append(next_line[:len(next_line) // 2])
+        return b''.join(lines)
+
+    def rotate(self):
+        """
+        Rewrites masterfilelist.txt with (or without) the export lines, so
+        that it has the same GKG lines at different offsets.
+        """
+        self.with_exports = not self.with_exports
+
+    def start(self):
+        self.start_time = time()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def check_master_list(fpaths):
+    """
+    Runs MasterList.update against a replay of fpaths (at least 5 files)
+    through each case of the tail fetch: first fetch, no change, append,
+    partial line, Range ignored, rotated file, and an outage (when only
+    lastupdate.txt is used) with recovery. Raises AssertionError if the
+    local list doesn't have the published files after any of them.
+    """
+    replay = Replay(fpaths, interval=24 * 3600, port=0).start()
+    if len(replay.names) < 5:
+        raise ValueError("check_master_list needs at least 5 files")
+    try:
+        with tempfile.TemporaryDirectory() as local_dir:
+            master_list = MasterList(
+                os.path.join(local_dir, 'gdelt2_master.txt'),
+                master_list_url=replay.master_list_url,
+                last_update_url=replay.last_update_url
+            )
+
+            def check(case, num_added, in_file=None):
+                added = master_list.update()
+                published = [replay.base_url + name
+                             for name in replay.published()]
+                in_file = len(published) if in_file is None else in_file
+                local = MasterList(master_list.fpath).urls()
+                assert added == num_added, (case, added, num_added)
+                assert local == published[:in_file], (case, local)
+                assert master_list.urls() == published, case
+                print(f"{case}: {added} added, {len(local)} in the file")
+
+            check('first fetch', 1)
+            check('no change', 0)
+            replay.advance()
+            check('append', 1)
+            replay.partial_line = True
+            check('partial line', 0)
+            replay.advance()
+            check('partial line completed', 1)
+            replay.partial_line = False
+            replay.ignore_range = True
+            replay.advance()
+            check('Range ignored', 1)
+            replay.ignore_range = False
+            replay.rotate()
+            check('rotated file', 4)
+            replay.master_list_down = True
+            replay.advance()
+            check('master list down', 0, in_file=4)
+            replay.master_list_down = False
+            check('recovered', 1)
+    finally:
+        replay.shutdown()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('fpaths', nargs='+',
+                            help="local GKG .csv.zip files, in one directory")
+    arg_parser.add_argument('--interval', type=float, default=INTERVAL,
+                            help="seconds between files")
+    arg_parser.add_argument('--port', type=int, default=PORT)
+    arg_parser.add_argument('--check-master-list', action='store_true',
+                            help="check MasterList's tail fetch against the "
+                                 "replay, instead of serving it")
+    args = arg_parser.parse_args()
+
+    if args.check_master_list:
+        check_master_list(args.fpaths)
+    else:
+        replay = Replay(args.fpaths, args.interval, args.port).start()
+        print(f"Replaying {len(replay.names)} files at "
+              f"{replay.last_update_url}")
+        try:
+            while len(replay.published()) < len(replay.names):
+                sleep(1)
+            print("All files published")
+            while True:
+                sleep(60)
+        except KeyboardInterrupt:
+            replay.shutdown()
@@ -0,0 +1,192 @@
+"""
+The "gdelt_raw_themes" table (see create_gdelt_raw.sql) holds, for each
+article in "gdelt_raw" and each high-level theme in "themes_ref", the
+proportion of the article's themes that are one of the theme's low-level
+themes:
+
+    |themes ∩ low_levels| / |themes|   (1.0 for the 'ALL' theme)
+
+where the intersection counts each distinct theme once and |themes| counts
+every theme mentioned (as `array_intersect` did in get_daily_averages.sql).
+Only non-zero proportions are stored.
+
+The writers in gkg_raw_to_db.py and gdelt_raw_copy.py compute these with
+`write_article_themes`, against "themes_ref" as of that transaction, so
+computing "daily_tone" is a filter on "prop_relevant" rather than an array
+intersection per article per theme.
+
+When "themes_ref" changes (eg. a theme is added or its low-level themes are
+changed), recompute the existing rows for those themes with:
+    python -m Gdelt.process_v2.article_themes [--themes economic housing]
+which also recomputes those themes in "daily_tone".
+"""
+import argparse
+from time import perf_counter
+
+from psycopg2 import extras
+
+from Gdelt.process_v2.db_pool import get_conn
+from Gdelt.process_v2.gdelt_raw_columns import get_columns
+from Gdelt.process_v2.gkg_dictionary import is_dictionary_encoded
+
+THEMES_TABLE = "gdelt_raw_themes"
+ALL_THEME = 'ALL'
+THEMES_COLUMN = 5  # index of "themes" in a gdelt_raw row
+
+
+def has_themes_table(cur):
+    """True if both "gdelt_raw_themes" and "themes_ref" exist."""
+    return bool(get_columns(cur, THEMES_TABLE) and
+                get_columns(cur, 'themes_ref'))
+
+
+def load_themes_ref(cur):
+    """Returns a list of (high_level, frozenset of low_levels)."""
+    cur.execute("SELECT high_level, low_levels FROM themes_ref")
+    return [(high_level, frozenset(low_levels)) for high_level, low_levels in cur]
+
+
+def theme_proportions(themes, themes_ref):
+    """
+    Yields (high_level, proportion) for each theme in themes_ref which is
+    relevant to an article with the given themes.
+    """
+    distinct_themes = set(themes)
+    for high_level, low_levels in themes_ref:
+        if high_level == ALL_THEME:
+            yield high_level, 1.0
+        elif themes:
+            num_relevant = len(distinct_themes & low_levels)
+            if num_relevant:
+                yield high_level, num_relevant / len(themes)
+
+
+def write_article_themes(cur, processed):
+    """
+    Inserts the theme proportions of the gdelt_raw rows, as part of the
+    caller's transaction.
+    """
+    if not processed or not has_themes_table(cur):
+        return
+    themes_ref = load_themes_ref(cur)
+    theme_rows = [
+        (row[0], row[1], high_level, prop)
+        for row in processed
+        for high_level, prop in theme_proportions(row[THEMES_COLUMN],
+                                                  themes_ref)
+    ]
+    extras.execute_values(cur, f"""
+        INSERT INTO {THEMES_TABLE} (gkg_id, datetime, theme, prop_relevant)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+    """, theme_rows, page_size=10000)
+
+
+def get_months(cur):
+    cur.execute("""
+        SELECT DISTINCT Date(date_trunc('month', file_dt)) AS month
+        FROM gkg_ingest_ledger
+        WHERE status = 'done'
+        ORDER BY month
+    """)
+    return [month for month, in cur]
+
+
+def backfill_month(month, themes):
+    """
+    Recomputes the rows for the given themes for one month of gdelt_raw.
+    Returns the number of rows inserted.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if is_dictionary_encoded(cur):
+                # Compare the themes as dictionary ids
+                themes_ref = """(
+                    SELECT high_level, gkg_theme_ids(low_levels) AS low_levels
+                    FROM themes_ref
+                ) themes_ref"""
+            else:
+                themes_ref = "themes_ref"
+            params = {'month': month, 'themes': themes}
+            cur.execute(f"""
+                DELETE FROM {THEMES_TABLE}
+                WHERE theme = ANY(%(themes)s) AND
+                      datetime >= %(month)s AND
+                      datetime < %(month)s + INTERVAL '1 month'
+            """, params)
+            cur.execute(f"""
+                INSERT INTO {THEMES_TABLE} (gkg_id, datetime, theme, prop_relevant)
+                SELECT gkg_id, datetime, high_level, prop_relevant
+                FROM (
+                    SELECT gkg_id,
+                           datetime,
+                           high_level,
+                           CASE
+                              WHEN high_level = %(all_theme)s THEN 1.0
+                              WHEN Cardinality(themes) = 0 THEN 0.0
+                              ELSE 1.0 * Cardinality(ARRAY(
+                                  SELECT Unnest(low_levels)
+                                  INTERSECT
+                                  SELECT Unnest(themes)
+                              )) / Cardinality(themes)
+                           END AS prop_relevant
+                    FROM gdelt_raw, {themes_ref}
+                    WHERE high_level = ANY(%(themes)s) AND
+                          datetime >= %(month)s AND
+                          datetime < %(month)s + INTERVAL '1 month'
+                ) t
+                WHERE prop_relevant > 0
+            """, {**params, 'all_theme': ALL_THEME})
+            return cur.rowcount
+
+
+def reset_daily_tone(themes):
+    """
+    Deletes the themes from "daily_tone", and their watermarks, so that they
+    are computed from the start on the next refresh.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('daily_tone_watermark')")
+            if cur.fetchone()[0] is None:
+                return  # never refreshed, so everything will be computed
+            cur.execute("DELETE FROM daily_tone WHERE theme = ANY(%s)",
+                        (themes,))
+            cur.execute("DELETE FROM daily_tone_watermark WHERE theme = ANY(%s)",
+                        (themes,))
+
+
+def backfill(themes=None):
+    """
+    Recomputes the rows of "gdelt_raw_themes" for the given themes (default:
+    all the themes in "themes_ref", removing the rows of any themes no longer
+    in it), a month at a time, then refreshes them in "daily_tone".
+    """
+    from Gdelt.process_v2.daily_tone import refresh_daily_tone
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if themes is None:
+                cur.execute("SELECT high_level FROM themes_ref")
+                themes = [high_level for high_level, in cur]
+                cur.execute(f"""
+                    DELETE FROM {THEMES_TABLE}
+                    WHERE theme NOT IN (SELECT high_level FROM themes_ref)
+                """)
+            months = get_months(cur)
+
+    for month in months:
+        start = perf_counter()
+        num_rows = backfill_month(month, themes)
+        print(f"{month:%Y-%m}: {num_rows} rows in "
+              f"{perf_counter() - start:.1f}s")
+    reset_daily_tone(themes)
+    print(f"Computed {refresh_daily_tone()} (date, theme) pairs of daily_tone")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--themes', nargs='+',
+                        help="high-level themes to recompute (default: all)")
+    args = parser.parse_args()
+    backfill(args.themes)
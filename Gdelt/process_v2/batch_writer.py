@@ -0,0 +1,95 @@
+"""
+A writer which coalesces the rows of many small GKG files into fewer, larger
+writes.
+
+Most GKG files only have a few hundred relevant articles, and each write is a
+transaction (with its partition check, dictionary lookups and ledger
+entries), so writing every file on its own spends most of the time on the
+per-write overhead. A BatchWriter is called like the writers in
+gkg_raw_to_db.py and gdelt_raw_copy.py, but buffers the rows and ledger
+entries, and only passes them on once there are at least `max_rows` rows or
+`max_bytes` bytes (see gkg_parser.row_nbytes), and on `flush()`. Rows can be
+given as lists or as GkgBatches (see gkg_batch.py), which are joined into
+one GkgBatch per write.
+
+The ledger entries of a batch are written in the same transaction as its
+rows, so a file is only recorded as done once all of its rows are written.
+If a batch fails, its files are recorded as failed.
+
+Usage:
+    with BatchWriter(write_processed_to_db_copy) as writer:
+        for gkg_file in gkg_files:
+            process_gkg(gkg_file, parser, writer=writer)
+"""
+import threading
+from itertools import chain
+
+from Gdelt.gkg_parser import row_nbytes
+from Gdelt.process_v2.gkg_batch import GkgBatch, as_rows
+from Gdelt.process_v2.ingest_ledger import STATUS_FAILED, record_failures
+
+BATCH_ROWS = 50000
+BATCH_BYTES = 64 * 2**20
+
+
+class BatchWriter:
+    """Buffers rows and ledger entries, and writes them in batches."""
+    def __init__(self, writer, max_rows=BATCH_ROWS, max_bytes=BATCH_BYTES):
+        self.writer = writer
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.stats = {'files_written': 0, 'rows_written': 0, 'failed': []}
+        self._parts, self._entries = [], []
+        self._num_rows, self._nbytes = 0, 0
+        self._lock = threading.Lock()
+
+    def __call__(self, processed, ledger_entries=()):
+        """
+        Adds the rows (and entries) to the batch, writing the batch if it is
+        full. Returns False if a write failed.
+        """
+        with self._lock:
+            self._parts.append(processed)
+            self._entries += ledger_entries
+            self._num_rows += len(processed)
+            if isinstance(processed, GkgBatch):
+                self._nbytes += processed.nbytes
+            elif self.max_bytes is not None:
+                self._nbytes += sum(row_nbytes(row) for row in processed)
+            if ((self.max_rows is not None and
+                    self._num_rows >= self.max_rows) or
+                    (self.max_bytes is not None and
+                     self._nbytes >= self.max_bytes)):
+                return self._flush()
+            return True
+
+    def flush(self):
+        """Writes the rows and entries left in the batch."""
+        with self._lock:
+            return self._flush()
+
+    def _flush(self):
+        parts, entries, num_rows = self._parts, self._entries, self._num_rows
+        self._parts, self._entries = [], []
+        self._num_rows, self._nbytes = 0, 0
+        if not num_rows and not entries:
+            return True
+        parts = [part for part in parts if len(part)]
+        if parts and all(isinstance(part, GkgBatch) for part in parts):
+            rows = GkgBatch.concat(parts)
+        else:
+            rows = list(chain.from_iterable(as_rows(part) for part in parts))
+        if self.writer(rows, ledger_entries=entries):
+            self.stats['files_written'] += len(entries)
+            self.stats['rows_written'] += num_rows
+            return True
+        self.stats['failed'] += [entry.file_dt for entry in entries]
+        record_failures([entry._replace(status=STATUS_FAILED)
+                         for entry in entries])
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
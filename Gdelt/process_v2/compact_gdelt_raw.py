@@ -0,0 +1,171 @@
+"""
+Converts an existing version 2 "gdelt_raw" table (see create_gdelt_raw_v2.sql)
+from the original NUMERIC/INTEGER column types to the compact ones: REAL for
+the tone and GCAM value columns and SMALLINT for "source". "daily_tone"
+.avg_tone is also changed to DOUBLE PRECISION.
+
+Each partition is detached and rewritten in its own transaction (so the
+conversion can be stopped and run again), then the parent table is altered
+and the partitions are attached again. The table size and the time taken by
+a daily aggregation are printed before and after.
+
+Stop the ingest (gkg_raw_to_db.py) while this is running, since the detached
+months can't be written to. For a version 1 table, run
+migrate_gdelt_raw_v2.py instead, which creates the compact types directly.
+
+Usage:
+    python -m Gdelt.process_v2.compact_gdelt_raw [--no-measure]
+"""
+import re
+import argparse
+from datetime import datetime
+from time import perf_counter
+
+from Gdelt.process_v2.db_pool import get_conn
+
+DB_TABLE = "gdelt_raw"
+COMPACT_TYPES = {
+    'source': 'SMALLINT',
+    'tone': 'REAL',
+    'pos': 'REAL',
+    'neg': 'REAL',
+    'polarity': 'REAL',
+    'ard': 'REAL',
+    'srd': 'REAL',
+    'sent_pos': 'REAL',
+    'sent_neg': 'REAL',
+    'sent_pol': 'REAL',
+}
+PARTITION_PATTERN = re.compile(rf'^{DB_TABLE}_(\d{{4}})_(\d{{2}})$')
+# Representative of the aggregation in get_daily_averages.sql
+MEASURE_QUERY = f"""
+    SELECT Date(datetime), Avg(tone), Avg(pos), Avg(neg), Avg(polarity),
+           Avg(ard), Avg(srd), Count(*)
+    FROM {DB_TABLE}
+    GROUP BY 1
+"""
+
+
+def get_column_types(cur, table):
+    cur.execute("""
+        SELECT attname, format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+    """, (table,))
+    return dict(cur.fetchall())
+
+
+def is_compact(cur, table):
+    column_types = get_column_types(cur, table)
+    return all(column_types[column] == type_.lower()
+               for column, type_ in COMPACT_TYPES.items())
+
+
+def alter_types_query(table):
+    return f"ALTER TABLE {table} " + ', '.join(
+        f"ALTER COLUMN {column} TYPE {type_}"
+        for column, type_ in COMPACT_TYPES.items()
+    )
+
+
+def get_partitions(cur):
+    """
+    Returns {partition name: attached?} for the monthly partitions, including
+    any left detached by an interrupted run.
+    """
+    cur.execute("""
+        SELECT c.relname, i.inhparent IS NOT NULL
+        FROM pg_class c
+             LEFT JOIN pg_inherits i
+               ON i.inhrelid = c.oid AND i.inhparent = %s::regclass
+        WHERE c.relkind = 'r' AND c.relname LIKE %s
+        ORDER BY c.relname
+    """, (DB_TABLE, f'{DB_TABLE}\\_%'))
+    return {name: attached for name, attached in cur
+            if PARTITION_PATTERN.match(name)}
+
+
+def get_bounds(partition):
+    year, month = map(int, PARTITION_PATTERN.match(partition).groups())
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    return start, end
+
+
+def measure(label):
+    """Prints the size of gdelt_raw and the time for a daily aggregation."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT pg_size_pretty(Sum(pg_total_relation_size(inhrelid)))
+                FROM pg_inherits
+                WHERE inhparent = %s::regclass
+            """, (DB_TABLE,))
+            size, = cur.fetchone()
+            best = float('inf')
+            for _ in range(3):
+                start = perf_counter()
+                cur.execute(MEASURE_QUERY)
+                cur.fetchall()
+                best = min(best, perf_counter() - start)
+    print(f"{label}: {size}, daily aggregation {best:.2f}s")
+
+
+def compact_partition(partition, attached):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if attached:
+                cur.execute(f"ALTER TABLE {DB_TABLE} DETACH PARTITION {partition}")
+            if not is_compact(cur, partition):
+                start = perf_counter()
+                cur.execute(alter_types_query(partition))
+                print(f"{partition}: rewritten in {perf_counter() - start:.1f}s")
+
+
+def compact(measure_before_after=True):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)",
+                        (DB_TABLE,))
+            if cur.fetchone() != ('p',):
+                print(f"{DB_TABLE} isn't partitioned, so run "
+                      "migrate_gdelt_raw_v2.py instead")
+                return
+            partitions = get_partitions(cur)
+            done = is_compact(cur, DB_TABLE) and all(partitions.values())
+    if done:
+        print(f"{DB_TABLE} is already compact")
+        return
+
+    if measure_before_after and all(partitions.values()):
+        measure("Before")
+    for partition, attached in partitions.items():
+        compact_partition(partition, attached)
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if not is_compact(cur, DB_TABLE):
+                cur.execute(alter_types_query(DB_TABLE))
+            for partition in partitions:
+                start, end = get_bounds(partition)
+                cur.execute(f"""
+                    ALTER TABLE {DB_TABLE} ATTACH PARTITION {partition}
+                    FOR VALUES FROM (%s) TO (%s)
+                """, (start, end))
+            cur.execute("SELECT to_regclass('daily_tone')")
+            if cur.fetchone()[0] is not None:
+                cur.execute("""
+                    ALTER TABLE daily_tone
+                    ALTER COLUMN avg_tone TYPE DOUBLE PRECISION
+                """)
+            cur.execute(f"ANALYZE {DB_TABLE}")
+    if measure_before_after:
+        measure("After")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--no-measure', action='store_true',
+                        help="don't measure the size and aggregation time")
+    args = parser.parse_args()
+    compact(not args.no_measure)
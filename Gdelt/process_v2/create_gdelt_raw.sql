@@ -8,6 +8,12 @@ CREATE TYPE location_item AS (
     feature_id   TEXT
 );
 
+-- Dictionary for the ids in the gcam column
+CREATE TABLE gkg_gcam (
+    id   SMALLSERIAL PRIMARY KEY,
+    name TEXT        NOT NULL UNIQUE  -- GCAM code, eg. 'c4.9'
+);
+
 CREATE TABLE gdelt_raw (
     -- Non-sentiment information about article
     gkg_id                    VARCHAR(25) PRIMARY KEY,
@@ -76,5 +82,49 @@ CREATE TABLE gdelt_raw (
     -- SentiWord
     sent_pos                  NUMERIC,
     sent_neg                  NUMERIC,
-    sent_pol                  NUMERIC
+    sent_pol                  NUMERIC,
+    -- Hash of Date(datetime), pos, neg and wc, and whether an earlier row had
+    -- the same hash, ie. this is a syndicated copy (see syndication.py)
+    syndication_fp            BIGINT,
+    is_syndicated             BOOLEAN,
+    -- Country of the domain in source_name (see source_countries.py)
+    source_country            VARCHAR(2),
+    -- Every GCAM entry of the article, as gkg_gcam ids and their values,
+    -- packed by pack_sparse in Gdelt/gcam_sparse.py (see gcam_arrays.py)
+    gcam                      BYTEA
 );
+
+CREATE INDEX gdelt_raw_syndication_fp ON gdelt_raw (syndication_fp);
+-- For the one-day lookups of syndication.py (as in create_gdelt_raw_v2.sql)
+CREATE INDEX gdelt_raw_datetime_brin ON gdelt_raw USING BRIN (datetime);
+
+-- gcam_value() reads one code of "gcam". It is defined in gcam_value.sql
+-- (run it after this file), so both versions of the schema share it.
+
+-- One row per GKG file, written in the same transaction as the file's rows so
+-- the ingest can skip files that are already done (including files with no
+-- relevant articles) without scanning gdelt_raw.
+CREATE TABLE gkg_ingest_ledger (
+    file_dt      TIMESTAMP   PRIMARY KEY,  -- timestamp in the GKG file name
+    status       VARCHAR(10) NOT NULL,     -- 'done' or 'failed'
+    num_rows     INTEGER,                  -- relevant rows in the file
+    duration     REAL,                     -- seconds to download and parse
+    num_bytes    BIGINT,                   -- size of the downloaded zip
+    processed_at TIMESTAMP   NOT NULL DEFAULT now()
+);
+
+-- For each article and each high-level theme in themes_ref, the proportion of
+-- the article's themes which are one of the theme's low-level themes (only
+-- if > 0). Written with the article's rows (see article_themes.py).
+CREATE TABLE gdelt_raw_themes (
+    gkg_id        VARCHAR(25) NOT NULL,
+    datetime      TIMESTAMP   NOT NULL,
+    theme         TEXT        NOT NULL,  -- themes_ref.high_level
+    prop_relevant REAL        NOT NULL,
+    PRIMARY KEY (datetime, gkg_id, theme)
+);
+
+-- Run once if gdelt_raw was loaded before the ledger existed:
+-- INSERT INTO gkg_ingest_ledger (file_dt, status, num_rows)
+-- SELECT datetime, 'done', count(*) FROM gdelt_raw GROUP BY datetime
+-- ON CONFLICT DO NOTHING;
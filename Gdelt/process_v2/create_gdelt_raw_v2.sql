@@ -0,0 +1,277 @@
+/*
+Version 2 of the "gdelt_raw" schema, which is partitioned by month on
+"datetime" so that queries for a range of dates (eg. in get_daily_averages.sql)
+only scan the partitions for those months.
+
+- The primary key must include the partition key, so it is (gkg_id, datetime).
+  gkg_id is still unique on its own, since it is built from the file timestamp.
+- Partitions are created as needed by gdelt_raw_add_partition(), which the
+  writers call for any new month (see gdelt_raw_partitions.py).
+- Rows are loaded in roughly datetime order, so a BRIN index on "datetime" is
+  tiny but still lets a time-range scan skip most of a partition.
+- The tone and GCAM value columns are REAL rather than NUMERIC, which is
+  smaller and much faster to aggregate (and 7 significant figures is plenty
+  for averages), and "source" is SMALLINT. The parser already
+  produces numbers (see gkg_parser.py). To convert an existing version 2
+  table, run compact_gdelt_raw.py.
+- "themes", "persons" and "orgs" are INTEGER[] of ids in the gkg_themes,
+  gkg_persons and gkg_orgs dictionary tables (see gkg_dictionary.py), since
+  the same strings are repeated in millions of rows. They have GIN indexes,
+  eg. for `themes && gkg_theme_ids('{TAX_DISEASE_CORONAVIRUS}')`, and
+  gkg_theme_names(themes) etc. convert them back to strings.
+- "syndication_fp" is computed at ingest (see syndication.py), so syndicated
+  copies of an article can be grouped on one indexed column.
+- "gcam" holds every GCAM entry of the article, not just the wide GCAM
+  columns, packed into ~2 bytes per entry (see gcam_arrays.py), and
+  gcam_value() reads one code.
+
+Run this on a new database, followed by gcam_value.sql (which defines
+gcam_value() for both versions of the schema). To convert an existing
+(version 1) "gdelt_raw", run migrate_gdelt_raw_v2.py instead, which also
+runs both files.
+*/
+
+DO $$
+BEGIN
+    CREATE TYPE location_item AS (
+        type         INTEGER,
+        full_name    TEXT,
+        country_code TEXT,
+        ADM1_code    TEXT,
+        lat          NUMERIC,
+        long         NUMERIC,
+        feature_id   TEXT
+    );
+EXCEPTION
+    WHEN duplicate_object THEN NULL;  -- already created for version 1
+END
+$$;
+
+-- Dictionaries for the themes, persons and orgs columns
+CREATE TABLE IF NOT EXISTS gkg_themes (
+    id   SERIAL PRIMARY KEY,
+    name TEXT   NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS gkg_persons (
+    id   SERIAL PRIMARY KEY,
+    name TEXT   NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS gkg_orgs (
+    id   SERIAL PRIMARY KEY,
+    name TEXT   NOT NULL UNIQUE
+);
+-- Dictionary for the ids in the gcam column (~2,300 GCAM codes, so SMALLINT ids)
+CREATE TABLE IF NOT EXISTS gkg_gcam (
+    id   SMALLSERIAL PRIMARY KEY,
+    name TEXT        NOT NULL UNIQUE  -- GCAM code, eg. 'c4.9'
+);
+
+CREATE TABLE gdelt_raw (
+    -- Non-sentiment information about article
+    gkg_id                    VARCHAR(25) NOT NULL,
+    datetime                  TIMESTAMP   NOT NULL,
+    source                    SMALLINT    NOT NULL,  -- 1 to 6
+    source_name               TEXT        NOT NULL,
+    doc_id                    TEXT        NOT NULL,
+    themes                    INTEGER[],  -- gkg_themes.id
+    locations                 location_item[],
+    persons                   INTEGER[],  -- gkg_persons.id
+    orgs                      INTEGER[],  -- gkg_orgs.id
+    countries                 VARCHAR(2)[],
+    -- "Core emotional dimensions" & wc - see 1.5TONE in GKG codebook for details
+    tone                      REAL,
+    pos                       REAL,
+    neg                       REAL,
+    polarity                  REAL,
+    ard                       REAL,
+    srd                       REAL,
+    wc                        INTEGER,
+    -- GCAM entries - see V2GCAM in GKG codebook for details
+    -- NB: INTEGER are count dimensions, REAL are value dimensions. Counts stay
+    -- INTEGER, as they can exceed SMALLINT for very long documents
+    -- Lexicoder sentiment dictionary
+    lexicode_neg              INTEGER,
+    lexicode_pos              INTEGER,
+    -- lexicoder Topic Dictionaries
+    macroeconomics            INTEGER,
+    energy                    INTEGER,
+    fisheries                 INTEGER,
+    transportation            INTEGER,
+    crime                     INTEGER,
+    social_welfare            INTEGER,
+    housing                   INTEGER,
+    finance                   INTEGER,
+    defence                   INTEGER,
+    sstc                      INTEGER,
+    foreign_trade             INTEGER,
+    civil_rights              INTEGER,
+    intl_rights               INTEGER,
+    govt_ops                  INTEGER,
+    land_water_management     INTEGER,
+    culture                   INTEGER,
+    prov_local                INTEGER,
+    intergovernmental         INTEGER,
+    constitutional_natl_unity INTEGER,
+    aboriginal                INTEGER,
+    religion                  INTEGER,
+    healthcare                INTEGER,
+    agriculture               INTEGER,
+    forestry                  INTEGER,
+    labour                    INTEGER,
+    immigration               INTEGER,
+    education                 INTEGER,
+    environment               INTEGER,
+    -- Central Bank Financial Stability Sentiment
+    finstab_pos               INTEGER,
+    finstab_neg               INTEGER,
+    finstab_neutral           INTEGER,
+    -- Loughran & McDonald Financial Sentiment
+    finsent_neg               INTEGER,
+    finsent_pos               INTEGER,
+    finsent_unc               INTEGER,  -- uncertainty
+    -- Opinion observer
+    opin_neg                  INTEGER,
+    opin_pos                  INTEGER,
+    -- SentiWord
+    sent_pos                  REAL,
+    sent_neg                  REAL,
+    sent_pol                  REAL,
+    -- Hash of Date(datetime), pos, neg and wc, and whether an earlier row had
+    -- the same hash, ie. this is a syndicated copy (see syndication.py)
+    syndication_fp            BIGINT,
+    is_syndicated             BOOLEAN,
+    -- Country of the domain in source_name (see source_countries.py)
+    source_country            VARCHAR(2),
+    -- Every GCAM entry of the article, as gkg_gcam ids and their values,
+    -- packed by pack_sparse in Gdelt/gcam_sparse.py (see gcam_arrays.py)
+    gcam                      BYTEA,
+    PRIMARY KEY (gkg_id, datetime)
+) PARTITION BY RANGE (datetime);
+
+CREATE INDEX gdelt_raw_datetime_brin ON gdelt_raw USING BRIN (datetime);
+CREATE INDEX gdelt_raw_themes_gin ON gdelt_raw USING GIN (themes);
+CREATE INDEX gdelt_raw_persons_gin ON gdelt_raw USING GIN (persons);
+CREATE INDEX gdelt_raw_orgs_gin ON gdelt_raw USING GIN (orgs);
+CREATE INDEX gdelt_raw_syndication_fp ON gdelt_raw (syndication_fp);
+
+-- Converts between arrays of names and arrays of dictionary ids, keeping the
+-- order (names which aren't in the dictionary are dropped)
+CREATE OR REPLACE FUNCTION gkg_theme_ids(names TEXT[])
+  RETURNS INTEGER[]
+  language sql STABLE
+AS $FUNCTION$
+    SELECT ARRAY(
+        SELECT id
+        FROM Unnest(names) WITH ORDINALITY AS u(name, i)
+             JOIN gkg_themes USING (name)
+        ORDER BY i
+    );
+$FUNCTION$;
+
+CREATE OR REPLACE FUNCTION gkg_person_ids(names TEXT[])
+  RETURNS INTEGER[]
+  language sql STABLE
+AS $FUNCTION$
+    SELECT ARRAY(
+        SELECT id
+        FROM Unnest(names) WITH ORDINALITY AS u(name, i)
+             JOIN gkg_persons USING (name)
+        ORDER BY i
+    );
+$FUNCTION$;
+
+CREATE OR REPLACE FUNCTION gkg_org_ids(names TEXT[])
+  RETURNS INTEGER[]
+  language sql STABLE
+AS $FUNCTION$
+    SELECT ARRAY(
+        SELECT id
+        FROM Unnest(names) WITH ORDINALITY AS u(name, i)
+             JOIN gkg_orgs USING (name)
+        ORDER BY i
+    );
+$FUNCTION$;
+
+CREATE OR REPLACE FUNCTION gkg_theme_names(ids INTEGER[])
+  RETURNS TEXT[]
+  language sql STABLE
+AS $FUNCTION$
+    SELECT ARRAY(
+        SELECT name
+        FROM Unnest(ids) WITH ORDINALITY AS u(id, i)
+             JOIN gkg_themes USING (id)
+        ORDER BY i
+    );
+$FUNCTION$;
+
+CREATE OR REPLACE FUNCTION gkg_person_names(ids INTEGER[])
+  RETURNS TEXT[]
+  language sql STABLE
+AS $FUNCTION$
+    SELECT ARRAY(
+        SELECT name
+        FROM Unnest(ids) WITH ORDINALITY AS u(id, i)
+             JOIN gkg_persons USING (id)
+        ORDER BY i
+    );
+$FUNCTION$;
+
+CREATE OR REPLACE FUNCTION gkg_org_names(ids INTEGER[])
+  RETURNS TEXT[]
+  language sql STABLE
+AS $FUNCTION$
+    SELECT ARRAY(
+        SELECT name
+        FROM Unnest(ids) WITH ORDINALITY AS u(id, i)
+             JOIN gkg_orgs USING (id)
+        ORDER BY i
+    );
+$FUNCTION$;
+
+-- gcam_value() reads one code of "gcam". It is defined in gcam_value.sql
+-- (run it after this file), so both versions of the schema share it.
+
+-- Creates the partition for the month containing month_start, if it doesn't
+-- already exist. Creation is serialised with an advisory lock so concurrent
+-- writers don't race to create the same partition.
+CREATE OR REPLACE FUNCTION gdelt_raw_add_partition(month_start DATE)
+  RETURNS void
+  language plpgsql
+AS $FUNCTION$
+DECLARE
+    first_day DATE := date_trunc('month', month_start);
+    partition TEXT := 'gdelt_raw_' || to_char(first_day, 'YYYY_MM');
+BEGIN
+    IF to_regclass(partition) IS NOT NULL THEN
+        RETURN;  -- the usual case, without taking any locks
+    END IF;
+    PERFORM pg_advisory_xact_lock(hashtext('gdelt_raw_add_partition'));
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF gdelt_raw '
+        'FOR VALUES FROM (%L) TO (%L)',
+        partition,
+        first_day,
+        first_day + INTERVAL '1 month'
+    );
+END;
+$FUNCTION$;
+
+CREATE TABLE IF NOT EXISTS gkg_ingest_ledger (
+    file_dt      TIMESTAMP   PRIMARY KEY,  -- timestamp in the GKG file name
+    status       VARCHAR(10) NOT NULL,     -- 'done' or 'failed'
+    num_rows     INTEGER,                  -- relevant rows in the file
+    duration     REAL,                     -- seconds to download and parse
+    num_bytes    BIGINT,                   -- size of the downloaded zip
+    processed_at TIMESTAMP   NOT NULL DEFAULT now()
+);
+
+-- For each article and each high-level theme in themes_ref, the proportion of
+-- the article's themes which are one of the theme's low-level themes (only
+-- if > 0). Written with the article's rows (see article_themes.py).
+CREATE TABLE IF NOT EXISTS gdelt_raw_themes (
+    gkg_id        VARCHAR(25) NOT NULL,
+    datetime      TIMESTAMP   NOT NULL,
+    theme         TEXT        NOT NULL,  -- themes_ref.high_level
+    prop_relevant REAL        NOT NULL,
+    PRIMARY KEY (datetime, gkg_id, theme)
+);
@@ -6,9 +6,8 @@ table, then you need to DROP TABLE before running this script.
 import os
 
 import pandas as pd
-import psycopg2
 
-import postgres_config
+from Gdelt.process_v2.db_pool import get_conn
 
 # Load Spacy NLP model
 try:
@@ -71,18 +70,14 @@ def write_themes_mappings_to_db(theme_mappings):
         low_levels    TEXT[]  NOT NULL
     );
     """
+    # Add row to get overall indicator:
+    theme_mappings = [('ALL', [])] + theme_mappings
     insert_query = (
         "INSERT INTO themes_ref VALUES " + 
         ','.join(['%s'] * len(theme_mappings)) + ';'
     )
-    connection_details = (
-        f"host={postgres_config.HOST} dbname=gdelt user=postgres "
-        f"password={postgres_config.PASSWORD}"
-    )
-    # Add row to get overall indicator:
-    theme_mappings = ['ALL', []] + themes_mappings
     
-    with psycopg2.connect(connection_details) as conn:
+    with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(create_table_query)
             cur.execute(insert_query, theme_mappings)
@@ -0,0 +1,42 @@
+"""
+Runs the incremental refresh of the "daily_tone" table in
+get_daily_averages.sql, which only computes the dates after each theme's
+watermark and any earlier dates that have had late GKG files ingested.
+
+Usage:
+    python -m Gdelt.process_v2.daily_tone
+"""
+import os
+from time import perf_counter
+
+from Gdelt.process_v2.db_pool import get_conn
+
+SQL_FPATH = os.path.join(os.path.dirname(__file__), 'get_daily_averages.sql')
+
+
+def refresh_daily_tone(include_last_date=False):
+    """
+    Refreshes "daily_tone" in a single transaction, and returns the number of
+    (date, theme) pairs that were computed.
+
+    include_last_date: if True, the last date in the ingest ledger is
+        computed too, although it may not be complete yet (eg. when following
+        the new GKG files as they're published - see `follow` in
+        gkg_raw_to_db.py, or `gkg_raw_to_db.py --follow`).
+    """
+    with open(SQL_FPATH) as f:
+        query = f.read()
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if include_last_date:
+                cur.execute("SET LOCAL daily_tone.include_last_date = on")
+            cur.execute(query)
+            cur.execute("SELECT count(*) FROM daily_tone_pending")
+            return cur.fetchone()[0]
+
+
+if __name__ == '__main__':
+    start = perf_counter()
+    num_pending = refresh_daily_tone()
+    print(f"Computed {num_pending} (date, theme) pairs in "
+          f"{perf_counter() - start:.1f}s")
@@ -0,0 +1,325 @@
+"""
+Computes "daily_tone" with DuckDB, an embedded (multi-threaded, columnar)
+query engine, over date-partitioned Parquet extracts of GKG, as an
+alternative to get_daily_averages.sql which doesn't need a Postgres server or
+"gdelt_raw".
+
+The extract has a directory per date (eg. `date=2021-09-01/`) with a Parquet
+file of the relevant articles of each GKG file, holding only the columns the
+aggregation needs (EXTRACT_SCHEMA). The aggregation is the same as in
+get_daily_averages.sql:
+- an article is relevant to a theme if more than 10% of its themes are one of
+  the theme's low-level themes (every article is relevant to 'ALL'),
+- syndicated copies are grouped on (date, pos, neg, wc), which is what
+  "syndication_fp" hashes (see syndication.py),
+- "from_onshore" is whether the country of the source domain (see
+  Gdelt/source_country.py) is the country mentioned,
+- the first and last dates in the extract are left out, as they are
+  potentially incomplete.
+
+The extract is built from GKG zip files, or from the local lake of GKG files
+(see Gdelt/gkg_lake.py) with `--lake`.
+
+The themes come from a JSON file of {high_level: [low_levels]}, which can be
+dumped from "themes_ref" with the `themes-ref` command. The result is a
+Parquet file with the columns of "daily_tone", which news_sent.py and
+weekly_econ_sent.py read instead of the database with `--parquet`.
+
+Usage:
+    python -m Gdelt.process_v2.daily_tone_duckdb extract ../data/*.gkg.csv.zip
+    python -m Gdelt.process_v2.daily_tone_duckdb extract --lake
+    python -m Gdelt.process_v2.daily_tone_duckdb themes-ref
+    python -m Gdelt.process_v2.daily_tone_duckdb compute
+"""
+import os
+import re
+import json
+import argparse
+import concurrent.futures
+from time import perf_counter
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from Gdelt.gkg_fetch import download_gkg_zip, iter_zip_lines
+from Gdelt.gkg_lake import LAKE_DIR, PARSER_FIELDS, iter_lake_lines
+from Gdelt.gkg_parser import GkgParser
+from Gdelt.process_v2.gkg_batch import GkgBatch
+from Gdelt.source_country import source_country
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+EXTRACT_DIR = os.path.join(DATA_DIR, 'gdelt_raw_parquet')
+THEMES_REF_FPATH = os.path.join(DATA_DIR, 'themes_ref.json')
+DAILY_TONE_FPATH = os.path.join(DATA_DIR, 'daily_tone.parquet')
+ALL_THEME = 'ALL'
+EXTRACT_SCHEMA = pa.schema([
+    ('gkg_id', pa.string()),
+    ('datetime', pa.timestamp('s')),
+    ('source_name', pa.string()),
+    ('source_country', pa.string()),
+    ('themes', pa.list_(pa.string())),
+    ('countries', pa.list_(pa.string())),
+    # float32, like the REAL columns of gdelt_raw
+    ('tone', pa.float32()),
+    ('pos', pa.float32()),
+    ('neg', pa.float32()),
+    ('wc', pa.int32()),
+])
+# Index of each extract column in a gdelt_raw row
+ROW_COLUMNS = {
+    'gkg_id': 0, 'datetime': 1, 'source_name': 3, 'themes': 5,
+    'countries': 9, 'tone': 10, 'pos': 11, 'neg': 12, 'wc': 16,
+}
+
+DAILY_TONE_QUERY = """
+WITH articles AS (
+    SELECT *
+    FROM read_parquet($files, hive_partitioning = true)
+    WHERE date >= $first_date AND date <= $last_date
+),
+-- Take the (article, theme) pairs with sufficient relevant themes (compared
+-- as REAL, as "prop_relevant" is stored in gdelt_raw_themes)
+relevant AS (
+    SELECT articles.*, themes_ref.high_level AS theme
+    FROM articles, themes_ref
+    WHERE themes_ref.high_level = $all_theme OR (
+        len(themes) > 0 AND
+        CAST(len(list_intersect(themes, low_levels)) / len(themes) AS REAL)
+            > REAL '0.1'
+    )
+),
+-- Expand "countries", and construct "from_onshore" (for each country)
+expanded AS (
+    SELECT *, Coalesce(source_country = country, FALSE) AS from_onshore
+    FROM (SELECT *, Unnest(countries) AS country FROM relevant)
+),
+-- Combine (intra-country) syndicated articles into one row
+combined AS (
+    SELECT date, country, from_onshore, theme, Avg(tone) AS tone
+    FROM expanded
+    GROUP BY date, country, from_onshore, theme,
+             pos, neg, wc  -- to control for syndication
+)
+SELECT date,
+       country,
+       from_onshore,
+       theme,
+       Avg(tone)               AS avg_tone,
+       CAST(Count(*) AS INTEGER) AS num_articles
+FROM combined
+GROUP BY date, country, from_onshore, theme
+ORDER BY date, country, from_onshore, theme
+"""
+
+
+def rows_to_table(processed):
+    """
+    Converts gdelt_raw rows (a list, or a GkgBatch) to a pyarrow Table of the
+    extract columns.
+    """
+    if isinstance(processed, GkgBatch):
+        return batch_to_table(processed)
+    columns = {
+        name: [row[index] for row in processed]
+        for name, index in ROW_COLUMNS.items()
+    }
+    columns['source_country'] = [source_country(name)
+                                 for name in columns['source_name']]
+    return pa.Table.from_pydict(columns, schema=EXTRACT_SCHEMA)
+
+
+def batch_to_table(batch):
+    """
+    rows_to_table for a GkgBatch, which takes the columns from its arrays
+    rather than building the rows (each distinct source_name is resolved
+    once).
+    """
+    arrays = batch.to_arrow_columns()
+    source_names = arrays['source_name'].dictionary_encode()
+    countries = pa.array([source_country(name) for name
+                          in source_names.dictionary.to_pylist()],
+                         pa.string())
+    arrays['source_country'] = countries.take(source_names.indices)
+    return pa.Table.from_arrays(
+        [arrays[name].cast(field.type) for name, field
+         in zip(EXTRACT_SCHEMA.names, EXTRACT_SCHEMA)],
+        schema=EXTRACT_SCHEMA
+    )
+
+
+def write_extract_file(processed, filename_dt, extract_dir=EXTRACT_DIR):
+    """
+    Writes the rows of a GKG file to the extract, replacing any earlier
+    extract of the file.
+    """
+    date_dir = os.path.join(extract_dir, f'date={filename_dt[:4]}-'
+                                         f'{filename_dt[4:6]}-{filename_dt[6:8]}')
+    os.makedirs(date_dir, exist_ok=True)
+    pq.write_table(rows_to_table(processed),
+                   os.path.join(date_dir, f'{filename_dt}.parquet'),
+                   compression='zstd')
+
+
+def extract_gkg_file(path_or_url, parser, extract_dir=EXTRACT_DIR):
+    """
+    Parses a GKG zip file (local, or downloaded) and writes its relevant
+    articles to the extract. Returns the number of rows.
+    """
+    filename_dt = re.search(r'(\d{14}).gkg.csv.zip$', path_or_url).group(1)
+    if os.path.exists(path_or_url):
+        with open(path_or_url, 'rb') as f:
+            data = f.read()
+    else:
+        data = download_gkg_zip(path_or_url)
+    processed = parser.db_rows(iter_zip_lines([data]), filename_dt)
+    write_extract_file(processed, filename_dt, extract_dir)
+    return len(processed)
+
+
+def extract_from_lake(parser, start=None, end=None, lake_dir=LAKE_DIR,
+                      extract_dir=EXTRACT_DIR):
+    """
+    Builds the extract from the GKG files in the local lake (see
+    Gdelt/gkg_lake.py) from start to end, rather than downloading them.
+    """
+    for filename_dt, lines in iter_lake_lines(start, end, parser.countries,
+                                              PARSER_FIELDS, lake_dir):
+        processed = parser.db_rows(lines, filename_dt)
+        write_extract_file(processed, filename_dt, extract_dir)
+        print(f"{filename_dt}: {len(processed)} rows")
+
+
+def extract(paths_or_urls, parser, extract_dir=EXTRACT_DIR, num_workers=None):
+    """Extracts the GKG files in a process pool (one per core by default)."""
+    with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+        futures = {
+            executor.submit(extract_gkg_file, path_or_url, parser,
+                            extract_dir): path_or_url
+            for path_or_url in paths_or_urls
+        }
+        for future in concurrent.futures.as_completed(futures):
+            path_or_url = futures[future]
+            try:
+                print(f"{os.path.basename(path_or_url)}: "
+                      f"{future.result()} rows")
+            except Exception as e:
+                print(f"{path_or_url} EXCEPTION: {e}; {type(e)}")
+
+
+def dump_themes_ref(fpath=THEMES_REF_FPATH):
+    """Saves the "themes_ref" table to a JSON file, for `compute`."""
+    from Gdelt.process_v2.db_pool import get_conn
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT high_level, low_levels FROM themes_ref")
+            themes_ref = dict(cur.fetchall())
+    with open(fpath, 'w') as f:
+        json.dump(themes_ref, f, indent=1)
+
+
+def load_themes_ref(fpath=THEMES_REF_FPATH):
+    """Returns themes_ref as a pyarrow Table of (high_level, low_levels)."""
+    with open(fpath) as f:
+        themes_ref = json.load(f)
+    return pa.Table.from_pydict(
+        {'high_level': list(themes_ref),
+         'low_levels': [low_levels or [] for low_levels in themes_ref.values()]},
+        schema=pa.schema([('high_level', pa.string()),
+                          ('low_levels', pa.list_(pa.string()))])
+    )
+
+
+def get_date_bounds(con, files):
+    """The dates to compute: all but the first and last in the extract."""
+    return con.execute("""
+        SELECT Min(date) + 1, Max(date) - 1
+        FROM (
+            SELECT DISTINCT date
+            FROM read_parquet($files, hive_partitioning = true)
+        )
+    """, {'files': files}).fetchone()
+
+
+def compute_daily_tone(extract_dir=EXTRACT_DIR, themes_ref_fpath=THEMES_REF_FPATH,
+                       out_fpath=DAILY_TONE_FPATH, first_date=None,
+                       last_date=None, threads=None):
+    """
+    Computes daily_tone from the extract and writes it to a Parquet file.
+    Returns the number of rows.
+    """
+    con = duckdb.connect()
+    con.execute(f"SET threads = {threads or os.cpu_count() or 1}")
+    themes_ref = load_themes_ref(themes_ref_fpath)
+    con.register('themes_ref', themes_ref)
+    files = os.path.join(extract_dir, 'date=*', '*.parquet')
+    if first_date is None or last_date is None:
+        default_first, default_last = get_date_bounds(con, files)
+        first_date = first_date or default_first
+        last_date = last_date or default_last
+    daily_tone = con.execute(DAILY_TONE_QUERY, {
+        'files': files, 'first_date': first_date, 'last_date': last_date,
+        'all_theme': ALL_THEME,
+    }).fetch_arrow_table()
+    pq.write_table(daily_tone, out_fpath)
+    return daily_tone.num_rows
+
+
+def read_daily_tone(fpath=DAILY_TONE_FPATH, theme=None, country=None):
+    """
+    Reads the daily_tone Parquet file as a DataFrame, optionally for one theme
+    and/or country, like `SELECT * FROM daily_tone WHERE ...`.
+    """
+    filters = [(column, '=', value)
+               for column, value in [('theme', theme), ('country', country)]
+               if value is not None]
+    daily = pq.read_table(fpath, filters=filters or None).to_pandas()
+    return daily.sort_values(['date', 'country', 'from_onshore'],
+                             ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    extract_parser = subparsers.add_parser(
+        'extract', help="add GKG zip files (local or urls) to the extract"
+    )
+    extract_parser.add_argument('files', nargs='*')
+    extract_parser.add_argument('--lake', nargs='?', const=LAKE_DIR,
+                                help="extract from the GKG lake instead of "
+                                     "files (see Gdelt/gkg_lake.py)")
+    extract_parser.add_argument('--first-date')
+    extract_parser.add_argument('--last-date')
+    extract_parser.add_argument('--countries', nargs='+',
+                                default=['NZ', 'AS', 'CA', 'UK'])
+    extract_parser.add_argument('--extract-dir', default=EXTRACT_DIR)
+    themes_parser = subparsers.add_parser(
+        'themes-ref', help="dump themes_ref from the database to JSON"
+    )
+    themes_parser.add_argument('--themes-ref', default=THEMES_REF_FPATH)
+    compute_parser = subparsers.add_parser(
+        'compute', help="compute daily_tone from the extract"
+    )
+    compute_parser.add_argument('--extract-dir', default=EXTRACT_DIR)
+    compute_parser.add_argument('--themes-ref', default=THEMES_REF_FPATH)
+    compute_parser.add_argument('--out', default=DAILY_TONE_FPATH)
+    compute_parser.add_argument('--first-date')
+    compute_parser.add_argument('--last-date')
+    compute_parser.add_argument('--threads', type=int)
+    args = parser.parse_args()
+
+    start = perf_counter()
+    if args.command == 'extract' and args.lake:
+        extract_from_lake(GkgParser(args.countries), args.first_date,
+                          args.last_date, args.lake, args.extract_dir)
+    elif args.command == 'extract':
+        extract(args.files, GkgParser(args.countries), args.extract_dir)
+    elif args.command == 'themes-ref':
+        dump_themes_ref(args.themes_ref)
+    else:
+        num_rows = compute_daily_tone(args.extract_dir, args.themes_ref,
+                                      args.out, args.first_date,
+                                      args.last_date, args.threads)
+        print(f"Wrote {num_rows} rows to {args.out}")
+    print(f"Time taken: {perf_counter() - start:.1f}s")
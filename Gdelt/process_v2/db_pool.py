@@ -0,0 +1,151 @@
+"""
+Shared, thread-safe pool of connections to the "gdelt" Postgres database, used
+by every script in process_v2.
+
+Opening a connection for each query means a TCP + authentication handshake
+(and, for "gdelt_raw", a `register_composite` lookup) for every 15-minute file
+in every ingest thread. Instead, connections are opened on first use, kept
+open, and handed out to one thread at a time. The "location_item" composite is
+registered once, when each connection is opened.
+
+Usage:
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(...)
+
+The transaction is committed when the block exits (or rolled back if it
+raises), and the connection is returned to the pool.
+"""
+import os
+import atexit
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extras, pool
+
+import postgres_config
+from Gdelt.gdelt_utils import Loc_Item
+
+CONNECTION_DETAILS = (
+    f"host={postgres_config.HOST} dbname=gdelt user=postgres "
+    f"password={postgres_config.PASSWORD}"
+)
+MIN_CONNECTIONS = 1
+MAX_CONNECTIONS = 10
+
+
+class Loc_Item_Adapter:
+    """Adapts Loc_Item into the "location_item" composite type."""
+    def __init__(self, x):
+        self.adapted = psycopg2.extensions.SQL_IN(x)
+    def prepare(self, conn):
+        self.adapted.prepare(conn)
+    def getquoted(self):
+        return self.adapted.getquoted() + b'::location_item'
+
+
+psycopg2.extensions.register_adapter(Loc_Item, Loc_Item_Adapter)
+
+
+def setup_connection(conn):
+    """
+    Sets the client encoding of a new connection (COPY encodes text as UTF-8)
+    and registers the custom types of the "gdelt" database. Databases without
+    the "gdelt_raw" schema don't have "location_item", so it is skipped.
+    """
+    conn.set_client_encoding('UTF8')
+    try:
+        extras.register_composite('location_item', conn)
+    except psycopg2.ProgrammingError:
+        pass
+
+
+class ConnectionPool(pool.ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool which blocks (rather than raising PoolError) when
+    all connections are in use, and sets up each connection when it's opened.
+
+    connections_opened counts the handshakes made, so should stop increasing
+    once the pool has warmed up.
+    """
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        self._available = threading.BoundedSemaphore(maxconn)
+        self.connections_opened = 0
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        # The base class closes returned connections once minconn are idle,
+        # which would mean a new handshake for most files. Only minconn are
+        # opened up front, but up to maxconn are kept open once returned.
+        self.minconn = maxconn
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        setup_connection(conn)
+        self.connections_opened += 1
+        return conn
+
+    def getconn(self, key=None):
+        self._available.acquire()
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._available.release()
+            raise
+
+    def putconn(self, conn, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._available.release()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+# Pools inherited from a parent process are kept referenced (and never closed)
+# by a forked child, since closing them would end the parent's sessions.
+_inherited_pools = []
+
+
+def get_pool():
+    """
+    Returns the pool for this process, creating it on first use. A process
+    forked from one with a pool (eg. by ProcessPoolExecutor) gets a new pool
+    rather than sharing the parent's sockets.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            if _pool is not None:
+                _inherited_pools.append(_pool)
+            _pool = ConnectionPool(MIN_CONNECTIONS, MAX_CONNECTIONS,
+                                   CONNECTION_DETAILS)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+@contextmanager
+def get_conn():
+    """
+    Borrows a connection from the pool for the duration of the block, as a
+    single transaction.
+    """
+    conn_pool = get_pool()
+    conn = conn_pool.getconn()
+    try:
+        with conn:
+            yield conn
+    finally:
+        # Don't put broken connections (eg. after a server restart) back
+        conn_pool.putconn(conn, close=bool(conn.closed))
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+
+
+atexit.register(close_pool)
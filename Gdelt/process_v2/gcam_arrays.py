@@ -0,0 +1,220 @@
+"""
+The full V2GCAM field of each article in "gdelt_raw", as the "gcam" column:
+the sparse pair of arrays of ids in the "gkg_gcam" dictionary table and
+their values, packed into one BYTEA by `pack_sparse` (see
+Gdelt/gcam_sparse.py) in ~2 bytes per entry. The wide GCAM columns only hold
+the codes in GCAM_CODES, so a new lexicon used to mean reprocessing the
+whole history - with the arrays, every code is already in the table.
+
+The ingest parser is created with `full_gcam=True`, so each row ends with a
+SparseGcam of the article's codes and values. The writers call
+`add_gcam_arrays` after the other appended columns, which replaces the codes
+with their dictionary ids (see gkg_dictionary.py) and moves the packed pair
+to the end of the row, or drops it if gdelt_raw doesn't have the column.
+
+`read_gcam_columns` extracts any codes as dense NumPy columns, and in SQL
+`gcam_value(gcam, 'c4.9')` gives one code's value (gcam_value.sql - it
+decodes the bytes in PL/pgSQL, so use `read_gcam_columns` for many rows).
+
+To add the column to an existing table, and fill it in from the GKG lake
+(see Gdelt/gkg_lake.py) for the files already ingested, run:
+    python -m Gdelt.process_v2.gcam_arrays [--lake DIR]
+"""
+import os
+import argparse
+from datetime import timedelta
+from time import perf_counter
+
+import numpy as np
+from psycopg2 import extras
+
+from Gdelt.gcam_sparse import SparseGcam, pack_sparse, to_dense, unpack_sparse
+from Gdelt.gdelt_utils import GCAM_CODES
+from Gdelt.gkg_lake import LAKE_DIR, PARSER_FIELDS, iter_lake_lines
+from Gdelt.gkg_parser import GkgParser
+from Gdelt.process_v2.db_pool import get_conn
+from Gdelt.process_v2.gdelt_raw_columns import SPARSE_GCAM_COLUMNS, has_columns
+from Gdelt.process_v2.gkg_dictionary import Dictionary
+from Gdelt.process_v2.ingest_ledger import get_done_dts
+
+DB_TABLE = "gdelt_raw"
+DICTIONARY_TABLE = "gkg_gcam"
+FUNCTION_FPATH = os.path.join(os.path.dirname(__file__), 'gcam_value.sql')
+# Index of the parser's SparseGcam in a gdelt_raw row: after the article
+# info, the V1.5TONE values and the wide GCAM columns
+SPARSE_COLUMN = 17 + len(GCAM_CODES)
+COUNTRIES = ['NZ', 'AS', 'CA', 'UK']  # as ingested by gkg_raw_to_db.py
+
+_dictionary = Dictionary(DICTIONARY_TABLE)
+
+
+def has_gcam_arrays(cur):
+    """True if gdelt_raw has the "gcam" column."""
+    return has_columns(cur, SPARSE_GCAM_COLUMNS, DB_TABLE)
+
+
+def has_sparse_gcam(row):
+    return len(row) > SPARSE_COLUMN and isinstance(row[SPARSE_COLUMN],
+                                                   SparseGcam)
+
+
+def encode_sparse(sparse, ids):
+    """The (ids, values) arrays of a SparseGcam, sorted by id."""
+    pairs = sorted(zip((ids[code] for code in sparse.codes), sparse.values))
+    return [i for i, _ in pairs], [value for _, value in pairs]
+
+
+def pack_rows(cur, processed):
+    """The packed "gcam" of each row, from the parser's SparseGcam."""
+    ids = _dictionary.get_ids(cur, {
+        code for row in processed for code in row[SPARSE_COLUMN].codes
+    })
+    arrays = [encode_sparse(row[SPARSE_COLUMN], ids) for row in processed]
+    return pack_sparse([code_ids for code_ids, _ in arrays],
+                       [values for _, values in arrays])
+
+
+def add_gcam_arrays(cur, processed):
+    """
+    Returns the gdelt_raw rows with the SparseGcam from the parser (if any)
+    replaced by the packed "gcam" at the end of the row, or without it if
+    gdelt_raw doesn't have the column. Rows from a parser without full_gcam
+    get a NULL "gcam".
+    """
+    if not processed:
+        return processed
+    with_sparse = has_sparse_gcam(processed[0])
+    if not has_gcam_arrays(cur):
+        if not with_sparse:
+            return processed
+        return [row[:SPARSE_COLUMN] + row[SPARSE_COLUMN + 1:]
+                for row in processed]
+    if not with_sparse:
+        return [(*row, None) for row in processed]
+    return [
+        (*row[:SPARSE_COLUMN], *row[SPARSE_COLUMN + 1:], gcam)
+        for row, gcam in zip(processed, pack_rows(cur, processed))
+    ]
+
+
+def get_code_ids(cur, codes):
+    """{code: id} for the codes in the dictionary (ie. seen at ingest)."""
+    cur.execute(f"SELECT name, id FROM {DICTIONARY_TABLE} WHERE name = ANY(%s)",
+                (list(codes),))
+    return dict(cur.fetchall())
+
+
+def read_gcam_columns(codes, start, end, where="TRUE", params=None):
+    """
+    Reads the articles from start to end (dates, end exclusive) matching the
+    `where` condition, and returns a dict of 'gkg_id' and 'datetime' -> their
+    values, and each GCAM code -> a float32 array of its values (NaN where an
+    article doesn't have the code).
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            code_ids = get_code_ids(cur, codes)
+            cur.execute(f"""
+                SELECT gkg_id, datetime, gcam
+                FROM {DB_TABLE}
+                WHERE datetime >= %(start)s AND datetime < %(end)s AND
+                      gcam IS NOT NULL AND {where}
+                ORDER BY datetime, gkg_id
+            """, {**(params or {}), 'start': start, 'end': end})
+            rows = cur.fetchall()
+    gkg_ids, dts, packed = zip(*rows) if rows else ([],) * 3
+    ids, values = unpack_sparse(packed)
+
+    # Ids start at 1, so codes which no article has had yet are all missing
+    dense = to_dense(ids, values, [code_ids.get(code, 0) for code in codes])
+    columns = {'gkg_id': np.array(gkg_ids, dtype=object),
+               'datetime': np.array(dts, dtype='datetime64[s]')}
+    for i, code in enumerate(codes):
+        columns[code] = dense[:, i]
+    return columns
+
+
+def add_columns(cur):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DICTIONARY_TABLE} (
+            id   SMALLSERIAL PRIMARY KEY,
+            name TEXT        NOT NULL UNIQUE
+        )
+    """)
+    cur.execute(f"""
+        ALTER TABLE {DB_TABLE}
+        ADD COLUMN IF NOT EXISTS gcam BYTEA
+    """)
+    create_gcam_value(cur)
+
+
+def create_gcam_value(cur):
+    """Creates (or replaces) the gcam_value() SQL function (gcam_value.sql)."""
+    with open(FUNCTION_FPATH) as f:
+        cur.execute(f.read())
+
+
+def backfill_file(filename_dt, lines, parser):
+    """
+    Fills in the "gcam" of the rows from one GKG file which don't have it,
+    returning the number of rows updated.
+    """
+    processed = parser.db_rows(lines, filename_dt)
+    if not processed:
+        return 0
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            packed = [(row[0], row[1], gcam) for row, gcam
+                      in zip(processed, pack_rows(cur, processed))]
+            cur.execute("""
+                CREATE TEMP TABLE gcam_packed (
+                    gkg_id VARCHAR(25), datetime TIMESTAMP, gcam BYTEA
+                ) ON COMMIT DROP
+            """)
+            extras.execute_values(cur, "INSERT INTO gcam_packed VALUES %s",
+                                  packed, page_size=1000)
+            first = min(row[1] for row in processed)
+            last = max(row[1] for row in processed)
+            cur.execute(f"""
+                UPDATE {DB_TABLE}
+                SET    gcam = p.gcam
+                FROM   gcam_packed p
+                WHERE  {DB_TABLE}.gkg_id = p.gkg_id AND
+                       {DB_TABLE}.datetime = p.datetime AND
+                       {DB_TABLE}.datetime >= %s AND
+                       {DB_TABLE}.datetime < %s AND
+                       {DB_TABLE}.gcam IS NULL
+            """, (first, last + timedelta(seconds=1)))
+            return cur.rowcount
+
+
+def backfill(lake_dir=LAKE_DIR, countries=COUNTRIES):
+    """
+    Adds the column (and the dictionary table) to gdelt_raw if needed, and
+    fills it in from the lake for every file recorded as done.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            add_columns(cur)
+    done_dts = get_done_dts()
+    parser = GkgParser(countries, full_gcam=True)
+    for filename_dt, lines in iter_lake_lines(countries=countries,
+                                              fields=PARSER_FIELDS,
+                                              lake_dir=lake_dir):
+        if filename_dt not in done_dts:
+            continue
+        start = perf_counter()
+        num_rows = backfill_file(filename_dt, lines, parser)
+        if num_rows:
+            print(f"{filename_dt}: {num_rows} rows in "
+                  f"{perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--lake', default=LAKE_DIR)
+    args = arg_parser.parse_args()
+
+    start = perf_counter()
+    backfill(args.lake)
+    print(f"Time taken: {perf_counter() - start:.1f}s")
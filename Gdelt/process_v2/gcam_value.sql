@@ -0,0 +1,89 @@
+/*
+gcam_value(gcam, code): the value of one GCAM code (eg. 'c4.9') from an
+article's "gcam" column (packed by pack_sparse in Gdelt/gcam_sparse.py), or
+NULL if the article doesn't have it. The varints are decoded inline, as a
+function call per varint is several times slower.
+
+This is the one definition of the function, for both versions of the schema:
+run it after create_gdelt_raw.sql or create_gdelt_raw_v2.sql (gcam_arrays.py
+and migrate_gdelt_raw_v2.py run it themselves). A change to the format of
+pack_sparse must be made here too.
+*/
+
+CREATE OR REPLACE FUNCTION gcam_value(gcam BYTEA, code TEXT)
+  RETURNS REAL
+  language plpgsql STABLE
+AS $FUNCTION$
+DECLARE
+    wanted        INTEGER := (SELECT id FROM gkg_gcam WHERE name = code);
+    pos           INTEGER := 0;
+    byte          INTEGER;
+    shift         INTEGER;
+    number        BIGINT;
+    i             BIGINT := -2;  -- varint number (-2, -1: the header)
+    n             BIGINT;
+    num_floats    BIGINT;
+    id            BIGINT := 0;
+    counts_before INTEGER := 0;
+    floats_before INTEGER := 0;
+    nth_count     INTEGER;  -- of the wanted code, if it is a count
+    bits          BIGINT;
+    sign          INTEGER;
+    exponent      INTEGER;
+BEGIN
+    IF gcam IS NULL OR wanted IS NULL THEN
+        RETURN NULL;
+    END IF;
+    LOOP
+        number := 0;
+        shift := 0;
+        LOOP
+            byte := get_byte(gcam, pos);
+            pos := pos + 1;
+            number := number | ((byte & 127)::BIGINT << shift);
+            EXIT WHEN byte < 128;
+            shift := shift + 7;
+        END LOOP;
+
+        IF i = -2 THEN
+            n := number;
+        ELSIF i = -1 THEN
+            num_floats := number;
+        ELSIF i >= n THEN
+            IF i - n = nth_count THEN
+                RETURN number;
+            END IF;
+        ELSIF nth_count IS NULL THEN
+            id := id + (number >> 1);
+            IF id > wanted THEN
+                RETURN NULL;
+            ELSIF id = wanted AND (number & 1) = 0 THEN
+                nth_count := counts_before;
+            ELSIF id = wanted THEN
+                -- A big-endian float32, from the floats at the end
+                pos := length(gcam) - 4 * (num_floats - floats_before);
+                bits := (get_byte(gcam, pos)::BIGINT << 24) |
+                        (get_byte(gcam, pos + 1) << 16) |
+                        (get_byte(gcam, pos + 2) << 8) |
+                        get_byte(gcam, pos + 3);
+                sign := CASE WHEN bits >> 31 = 1 THEN -1 ELSE 1 END;
+                exponent := (bits >> 23) & 255;
+                IF exponent = 0 THEN  -- subnormal
+                    RETURN sign * (bits & 8388607) *
+                           2.0::FLOAT8 ^ -149;
+                END IF;
+                RETURN sign * ((bits & 8388607) + 8388608) *
+                       2.0::FLOAT8 ^ (exponent - 150);
+            ELSIF (number & 1) = 1 THEN
+                floats_before := floats_before + 1;
+            ELSE
+                counts_before := counts_before + 1;
+            END IF;
+        END IF;
+        IF i = n - 1 AND nth_count IS NULL THEN
+            RETURN NULL;
+        END IF;
+        i := i + 1;
+    END LOOP;
+END
+$FUNCTION$;
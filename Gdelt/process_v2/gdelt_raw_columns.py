@@ -0,0 +1,80 @@
+"""
+The columns of "gdelt_raw" which the writers load, by name.
+
+The parser's rows have the columns of create_gdelt_raw.sql up to the wide
+GCAM columns. The writers then append the syndication, source country and
+GCAM array columns (see syndication.py, source_countries.py and
+gcam_arrays.py) if the table has them. Those are added to existing tables by
+ALTER TABLE, so where they are in the table depends on the order the scripts
+were run in, and they can be added while a writer is running (eg. the follow
+mode of gkg_raw_to_db.py). So the writers name the columns of their INSERT
+and COPY with `row_columns`, and the table's columns are looked up for each
+cursor (ie. each write) rather than once per process.
+"""
+import weakref
+
+DB_TABLE = "gdelt_raw"
+# Columns of the parser's rows, in order
+ARTICLE_COLUMNS = [
+    'gkg_id', 'datetime', 'source', 'source_name', 'doc_id',
+    'themes', 'locations', 'persons', 'orgs', 'countries',
+    'tone', 'pos', 'neg', 'polarity', 'ard', 'srd', 'wc',
+]
+WIDE_GCAM_COLUMNS = [
+    'lexicode_neg', 'lexicode_pos',
+    'macroeconomics', 'energy', 'fisheries', 'transportation', 'crime',
+    'social_welfare', 'housing', 'finance', 'defence', 'sstc',
+    'foreign_trade', 'civil_rights', 'intl_rights', 'govt_ops',
+    'land_water_management', 'culture', 'prov_local', 'intergovernmental',
+    'constitutional_natl_unity', 'aboriginal', 'religion', 'healthcare',
+    'agriculture', 'forestry', 'labour', 'immigration', 'education',
+    'environment',
+    'finstab_pos', 'finstab_neg', 'finstab_neutral',
+    'finsent_neg', 'finsent_pos', 'finsent_unc',
+    'opin_neg', 'opin_pos',
+    'sent_pos', 'sent_neg', 'sent_pol',
+]
+PARSER_COLUMNS = ARTICLE_COLUMNS + WIDE_GCAM_COLUMNS
+# Columns appended by the writers, in the order they append them
+SYNDICATION_COLUMNS = ['syndication_fp', 'is_syndicated']
+SOURCE_COUNTRY_COLUMNS = ['source_country']
+SPARSE_GCAM_COLUMNS = ['gcam']
+
+_columns = weakref.WeakKeyDictionary()  # cursor -> {table: columns}
+
+
+def get_columns(cur, table=DB_TABLE):
+    """
+    {name: type} of the table's columns (an empty dict if there is no such
+    table), looked up once for each cursor.
+    """
+    tables = _columns.setdefault(cur, {})
+    if table not in tables:
+        cur.execute("""
+            SELECT attname, format_type(atttypid, atttypmod)
+            FROM   pg_attribute
+            WHERE  attrelid = to_regclass(%s) AND
+                   attnum > 0 AND NOT attisdropped
+            ORDER  BY attnum
+        """, (table,))
+        tables[table] = dict(cur.fetchall())
+    return tables[table]
+
+
+def has_columns(cur, columns, table=DB_TABLE):
+    """True if the table has all of the columns."""
+    table_columns = get_columns(cur, table)
+    return all(column in table_columns for column in columns)
+
+
+def row_columns(cur):
+    """
+    The names of the columns of the writers' rows, ie. after
+    `mark_syndicated`, `add_source_countries` and `add_gcam_arrays`.
+    """
+    columns = list(PARSER_COLUMNS)
+    for appended in (SYNDICATION_COLUMNS, SOURCE_COUNTRY_COLUMNS,
+                     SPARSE_GCAM_COLUMNS):
+        if has_columns(cur, appended):
+            columns += appended
+    return columns
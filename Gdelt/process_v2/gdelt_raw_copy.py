@@ -0,0 +1,360 @@
+"""
+Bulk loading of "gdelt_raw" rows with COPY FROM STDIN, as an alternative to
+the multi-row INSERT in `gkg_raw_to_db.write_processed_to_db`.
+
+Rows are streamed to the server in either the text or binary COPY format,
+including the location_item[] and TEXT[] columns, so psycopg2 doesn't have to
+mogrify every tuple client-side. Rows are copied into a temporary staging
+table and then inserted with ON CONFLICT DO NOTHING, so a duplicate gkg_id
+skips that row rather than aborting the whole batch.
+
+The binary encoders are chosen from the column types in the database catalog,
+so they follow any changes to the schema in create_gdelt_raw.sql.
+
+Running this script compares the rows/second of the INSERT and COPY loaders
+for local GKG zip files (NB: it truncates "gdelt_raw" between runs, so point
+it at a scratch database):
+    python gdelt_raw_copy.py ../data/20210901000000.gkg.csv.zip
+"""
+import io
+import re
+import struct
+import argparse
+from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
+from itertools import chain
+from time import perf_counter
+
+from Gdelt.process_v2.article_themes import write_article_themes
+from Gdelt.process_v2.db_pool import get_conn
+from Gdelt.process_v2.gcam_arrays import add_gcam_arrays
+from Gdelt.process_v2.gdelt_raw_columns import row_columns
+from Gdelt.process_v2.gdelt_raw_partitions import ensure_partitions
+from Gdelt.process_v2.gkg_batch import as_rows
+from Gdelt.process_v2.gkg_dictionary import encode_rows
+from Gdelt.process_v2.ingest_ledger import record_entries
+from Gdelt.process_v2.source_countries import add_source_countries
+from Gdelt.process_v2.syndication import forget_seen, mark_syndicated
+
+DB_TABLE = "gdelt_raw"
+COPY_FORMATS = ('text', 'binary')
+
+
+# Text format
+def escape_copy_text(s):
+    """Backslash-escapes a literal for the COPY text format."""
+    return (s.replace('\\', '\\\\').replace('\t', '\\t')
+             .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def quote_element(x):
+    """Double-quotes an array element or composite field."""
+    return '"' + str(x).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def to_text_literal(value):
+    """
+    Converts a row value to its Postgres literal. Lists become array literals,
+    tuples (ie. Loc_Item) become composite literals, and bytes become BYTEA
+    hex literals.
+    """
+    if isinstance(value, tuple):
+        return '(' + ','.join(
+            '' if x is None else quote_element(x) for x in value
+        ) + ')'
+    if isinstance(value, list):
+        return '{' + ','.join(
+            quote_element(to_text_literal(x)) for x in value
+        ) + '}'
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, bytes):
+        return '\\x' + value.hex()
+    return str(value)
+
+
+def encode_text_row(row):
+    return ('\t'.join(
+        '\\N' if value is None
+        else escape_copy_text(to_text_literal(value))
+        for value in row
+    ) + '\n').encode('utf-8')
+
+
+# Binary format - see "Binary Format" in the Postgres COPY documentation, and
+# the typsend/typreceive functions for each type in the Postgres source.
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+PG_EPOCH = datetime(2000, 1, 1)
+NUMERIC_POS, NUMERIC_NEG, NUMERIC_NAN = 0x0000, 0x4000, 0xC000
+
+
+@lru_cache(maxsize=4096)
+def encode_numeric(value):
+    """
+    Encodes a number (or numeric string) in the binary NUMERIC format. Cached,
+    since most tone, GCAM and coordinate values repeat within a file.
+    """
+    d = Decimal(str(value))
+    if d.is_nan():
+        return struct.pack('>hhHh', 0, 0, NUMERIC_NAN, 0)
+    sign, digits, exponent = d.as_tuple()
+    dscale = max(0, -exponent)
+    digit_str = ''.join(map(str, digits)) + '0' * max(0, exponent)
+    n_int = len(digit_str) + min(0, exponent)  # digits before decimal point
+    if n_int < 0:
+        digit_str, n_int = '0' * -n_int + digit_str, 0
+
+    # Group into base-10000 digits, aligned at the decimal point
+    int_str = digit_str[:n_int].zfill(-(-n_int // 4) * 4)
+    frac_str = digit_str[n_int:]
+    frac_str = frac_str.ljust(-(-len(frac_str) // 4) * 4, '0')
+    groups = [
+        int(s[i:i + 4]) for s in (int_str, frac_str)
+        for i in range(0, len(s), 4)
+    ]
+    weight = len(int_str) // 4 - 1
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    return struct.pack(f'>hhHh{len(groups)}h', len(groups), weight,
+                       NUMERIC_NEG if sign else NUMERIC_POS, dscale, *groups)
+
+
+def encode_timestamp(value):
+    delta = value - PG_EPOCH
+    return struct.pack(
+        '>q',
+        (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    )
+
+
+SCALAR_ENCODERS = {
+    'int2': lambda v: struct.pack('>h', int(v)),
+    'int4': lambda v: struct.pack('>i', int(v)),
+    'int8': lambda v: struct.pack('>q', int(v)),
+    'float4': lambda v: struct.pack('>f', float(v)),
+    'float8': lambda v: struct.pack('>d', float(v)),
+    'bool': lambda v: struct.pack('>?', bool(v)),
+    'numeric': encode_numeric,
+    'timestamp': encode_timestamp,
+    'text': lambda v: str(v).encode('utf-8'),
+    'varchar': lambda v: str(v).encode('utf-8'),
+    'bpchar': lambda v: str(v).encode('utf-8'),
+    'bytea': bytes,
+}
+
+
+def encode_field(encode, value):
+    """Length-prefixed field, as used in rows, arrays and composites."""
+    if value is None:
+        return b'\xff\xff\xff\xff'  # -1 length means NULL
+    data = encode(value)
+    return struct.pack('>i', len(data)) + data
+
+
+def make_array_encoder(elem_oid, encode_elem):
+    def encode_array(values):
+        if len(values) == 0:
+            return struct.pack('>iii', 0, 0, elem_oid)
+        has_null = any(v is None for v in values)
+        return (
+            struct.pack('>iiiii', 1, has_null, elem_oid, len(values), 1)
+            + b''.join(encode_field(encode_elem, v) for v in values)
+        )
+    return encode_array
+
+
+def make_composite_encoder(fields):
+    """fields: list of (type oid, encoder) for each field of the composite."""
+    def encode_composite(value):
+        return struct.pack('>i', len(fields)) + b''.join(
+            struct.pack('>I', oid) + encode_field(encode, x)
+            for (oid, encode), x in zip(fields, value)
+        )
+    return encode_composite
+
+
+def get_binary_encoders(cur, columns, table=DB_TABLE):
+    """
+    Returns a list of binary encoders, one per named column of the table,
+    based on the column types in the database catalog. They are looked up for
+    each COPY, so they follow any ALTER TABLE (eg. compact_gdelt_raw.py).
+    """
+    def attribute_types(relid_query, relid_arg):
+        cur.execute(f"""
+            SELECT a.attname, t.oid, t.typname, t.typtype, t.typelem,
+                   t.typrelid
+            FROM   pg_attribute a
+                   JOIN pg_type t ON a.atttypid = t.oid
+            WHERE  a.attrelid = {relid_query} AND
+                   a.attnum > 0 AND NOT a.attisdropped
+            ORDER  BY a.attnum
+        """, (relid_arg,))
+        return [(name, col_type) for name, *col_type in cur.fetchall()]
+
+    def get_type(oid):
+        cur.execute("""
+            SELECT oid, typname, typtype, typelem, typrelid
+            FROM pg_type WHERE oid = %s
+        """, (oid,))
+        return cur.fetchone()
+
+    def make_encoder(oid, typname, typtype, typelem, typrelid):
+        if typtype == 'c':
+            return make_composite_encoder([
+                (attr[0], make_encoder(*attr))
+                for _, attr in attribute_types('%s', typrelid)
+            ])
+        if typelem != 0 and typname.startswith('_'):
+            return make_array_encoder(typelem, make_encoder(*get_type(typelem)))
+        return SCALAR_ENCODERS[typname]
+
+    col_types = dict(attribute_types('%s::regclass', table))
+    return [make_encoder(*col_types[column]) for column in columns]
+
+
+def encode_binary_row(encoders, row):
+    return struct.pack('>h', len(row)) + b''.join(
+        encode_field(encode, value) for encode, value in zip(encoders, row)
+    )
+
+
+class IterStream(io.RawIOBase):
+    """Read-only file object over an iterator of bytes, for copy_expert."""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._leftover = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._leftover:
+            try:
+                self._leftover = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._leftover))
+        b[:n] = self._leftover[:n]
+        self._leftover = self._leftover[n:]
+        return n
+
+
+def copy_rows(cur, rows, columns, copy_format='text', table=DB_TABLE):
+    """
+    Copies rows of the named columns into the table through a temporary
+    staging table, skipping any rows whose primary key is already in the
+    table. Must be run inside a transaction. Returns the number of rows
+    inserted.
+    """
+    if copy_format not in COPY_FORMATS:
+        raise ValueError(f"copy_format must be one of {COPY_FORMATS}")
+
+    # Dropped at commit rather than kept for the session, so it has the
+    # columns of the table as it is now
+    staging = f"{table}_staging"
+    cur.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {staging}
+        (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP
+    """)
+    column_list = ', '.join(columns)
+    if copy_format == 'binary':
+        encoders = get_binary_encoders(cur, columns, table)
+        chunks = chain([PGCOPY_HEADER],
+                       (encode_binary_row(encoders, row) for row in rows),
+                       [PGCOPY_TRAILER])
+    else:
+        chunks = (encode_text_row(row) for row in rows)
+    cur.copy_expert(
+        f"COPY {staging} ({column_list}) FROM STDIN "
+        f"WITH (FORMAT {copy_format})",
+        io.BufferedReader(IterStream(chunks), 8192 * 8)
+    )
+    cur.execute(f"""
+        INSERT INTO {table} ({column_list})
+        SELECT {column_list} FROM {staging}
+        ON CONFLICT DO NOTHING
+    """)
+    return cur.rowcount
+
+
+def write_processed_to_db_copy(processed, ledger_entries=(),
+                               copy_format='text', skip_syndicated=False):
+    """
+    Drop-in alternative to `gkg_raw_to_db.write_processed_to_db` which loads
+    the rows (a list, or a GkgBatch) with COPY. Returns True if committed.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            try:
+                processed = as_rows(processed)
+                ensure_partitions(cur, processed)
+                processed = mark_syndicated(cur, processed, skip_syndicated)
+                processed = add_source_countries(cur, processed)
+                processed = add_gcam_arrays(cur, processed)
+                if processed:
+                    copy_rows(cur, encode_rows(cur, processed),
+                              row_columns(cur), copy_format)
+                write_article_themes(cur, processed)
+                record_entries(cur, ledger_entries)
+            except Exception as e:
+                print(f"Exception executing COPY: {e}")
+                print(f"Exception type: {type(e)}")
+                conn.rollback()
+                forget_seen()
+                return False
+    return True
+
+
+def compare_loaders(fpaths, countries_of_interest, repeats=3):
+    """
+    Prints the rows/second for loading the rows of the given local GKG zip
+    files with the INSERT, COPY (text) and COPY (binary) loaders.
+    """
+    from Gdelt.gkg_fetch import iter_zip_lines
+    from Gdelt.gkg_parser import GkgParser
+    from Gdelt.process_v2.gkg_raw_to_db import write_processed_to_db
+    from Gdelt.process_v2.gkg_vectorized import read_zip_chunks
+
+    parser = GkgParser(countries_of_interest)
+    processed = []
+    for fpath in fpaths:
+        filename_dt = re.search(r'(\d{14}).gkg.csv.zip$', fpath).group(1)
+        processed += parser.db_rows(iter_zip_lines(read_zip_chunks(fpath)()),
+                                    filename_dt)
+    print(f"{len(processed)} rows")
+
+    loaders = {
+        'INSERT': write_processed_to_db,
+        'COPY (text)': lambda rows: write_processed_to_db_copy(
+            rows, copy_format='text'
+        ),
+        'COPY (binary)': lambda rows: write_processed_to_db_copy(
+            rows, copy_format='binary'
+        ),
+    }
+    for name, load in loaders.items():
+        best = float('inf')
+        for _ in range(repeats):
+            with get_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(f"TRUNCATE {DB_TABLE}")
+            start = perf_counter()
+            load(processed)
+            best = min(best, perf_counter() - start)
+        print(f"  {name: <13}: {len(processed) / best:8.0f} rows/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fpaths', nargs='+', help="local GKG .csv.zip files")
+    parser.add_argument('--countries', nargs='+',
+                        default=['NZ', 'AS', 'CA', 'UK'])
+    args = parser.parse_args()
+    compare_loaders(args.fpaths, args.countries)
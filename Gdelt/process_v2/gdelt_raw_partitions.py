@@ -0,0 +1,46 @@
+"""
+Creates the monthly partitions of "gdelt_raw" (version 2 schema, see
+create_gdelt_raw_v2.sql) before rows for a new month are written.
+
+The writers call `ensure_partitions` with each batch, in the same transaction
+as the rows (so a partition is never assumed to exist when its creation was
+rolled back). It is a no-op for the unpartitioned version 1 table, and is one
+cheap function call per month in the batch otherwise.
+"""
+DB_TABLE = "gdelt_raw"
+DATETIME_COLUMN = 1  # index of "datetime" in a gdelt_raw row
+
+_is_partitioned = None
+
+
+def month_start(dt):
+    return dt.date().replace(day=1)
+
+
+def is_partitioned(cur):
+    """True if "gdelt_raw" is a partitioned (version 2) table."""
+    global _is_partitioned
+    if _is_partitioned is None:
+        cur.execute("""
+            SELECT relkind = 'p' FROM pg_class
+            WHERE oid = to_regclass(%s)
+        """, (DB_TABLE,))
+        result = cur.fetchone()
+        _is_partitioned = bool(result and result[0])
+    return _is_partitioned
+
+
+def add_partition(cur, month):
+    cur.execute("SELECT gdelt_raw_add_partition(%s)", (month,))
+
+
+def ensure_partitions(cur, processed):
+    """
+    Creates any missing partitions for the rows about to be written, as part
+    of the caller's transaction.
+    """
+    if not processed or not is_partitioned(cur):
+        return
+    months = {month_start(row[DATETIME_COLUMN]) for row in processed}
+    for month in sorted(months):
+        add_partition(cur, month)
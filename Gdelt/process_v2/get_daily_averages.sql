@@ -5,9 +5,10 @@ Gets daily average tone and article count, broken down by country mentioned
 
 
 Controls for syndication by grouping articles that have the same publish date,
-positive score, negative score, and word count. There is two main limitations
-to the current implementation, which are expected to have minor impacts on the
-resulting data.
+positive score, negative score, and word count, ie. the same "syndication_fp"
+(a hash of those values computed at ingest - see syndication.py). There is two
+main limitations to the current implementation, which are expected to have
+minor impacts on the resulting data.
 
 Limitations:
 1) Doesn't adjust for articles syndicated within country on different dates.
@@ -24,30 +25,136 @@ was published first to determine where the article was originally published (for
 "from_onshore" column).
 */
 
-CREATE OR REPLACE FUNCTION array_intersect(anyarray, anyarray)
-  RETURNS anyarray
-  language sql
-AS $FUNCTION$
-    SELECT ARRAY(
-        SELECT UNNEST($1)
-        INTERSECT
-        SELECT UNNEST($2)
-    );
-$FUNCTION$;
-
 CREATE TABLE IF NOT EXISTS daily_tone (
     date         DATE,
     country      VARCHAR(2),
     from_onshore BOOLEAN,
     theme        TEXT,
-    avg_tone     NUMERIC,
+    avg_tone     DOUBLE PRECISION,
     num_articles INTEGER,
     PRIMARY KEY (date, country, from_onshore, theme)
 );
 
--- Compute average tones for dates not already in "daily_tone"
--- NB: Doesn't include min/max dates as these are potentially incomplete.
--- Q/  CAN/SHOULD THIS BE CHANGED SO THAT IT ADJUSTS FOR TIMEZONES?
+-- Per-theme watermark: "daily_tone" is complete for the theme up to and
+-- including computed_through (apart from dates in daily_tone_stale_dates)
+CREATE TABLE IF NOT EXISTS daily_tone_watermark (
+    theme            TEXT      PRIMARY KEY,
+    computed_through DATE,
+    refreshed_at     TIMESTAMP
+);
+
+-- Dates which have had a GKG file ingested since the last refresh, added by a
+-- trigger on gkg_ingest_ledger. Not unique, so that ingest transactions never
+-- wait on each other (or on a refresh) to add the same date.
+CREATE TABLE IF NOT EXISTS daily_tone_stale_dates (
+    date DATE NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION mark_daily_tone_stale()
+  RETURNS trigger
+  language plpgsql
+AS $FUNCTION$
+BEGIN
+    IF NEW.status = 'done' THEN
+        INSERT INTO daily_tone_stale_dates VALUES (Date(NEW.file_dt));
+    END IF;
+    RETURN NULL;
+END;
+$FUNCTION$;
+
+DROP TRIGGER IF EXISTS gkg_ingest_ledger_stale_dates ON gkg_ingest_ledger;
+CREATE TRIGGER gkg_ingest_ledger_stale_dates
+    AFTER INSERT OR UPDATE ON gkg_ingest_ledger
+    FOR EACH ROW EXECUTE FUNCTION mark_daily_tone_stale();
+
+/*
+Incremental refresh of "daily_tone". Run the rest of this file in a single
+transaction (eg. `psql -1 -f get_daily_averages.sql`, or refresh_daily_tone()
+in daily_tone.py).
+
+For each theme in "themes_ref", the (date, theme) pairs to compute are:
+- the dates after the theme's watermark (all dates for a new theme, so adding
+  a theme only backfills that theme), and
+- any earlier dates which had a late GKG file ingested (from
+  daily_tone_stale_dates).
+Their rows are deleted from "daily_tone" and computed again, and the
+watermarks are moved forward.
+
+The articles relevant to each theme are read from "gdelt_raw_themes", so
+after adding or changing a theme in "themes_ref" run article_themes.py for it
+(which also refreshes it here).
+
+NB: Doesn't include min/max dates ingested as these are potentially incomplete.
+(Unless "daily_tone.include_last_date" is set to 'on' for the transaction, eg.
+by the follow mode of gkg_raw_to_db.py, which computes the current day as its
+files arrive. The later files of that day mark it stale, so it is computed
+again by the next refresh.)
+Q/  CAN/SHOULD THIS BE CHANGED SO THAT IT ADJUSTS FOR TIMEZONES?
+*/
+
+-- Only one refresh at a time
+SELECT pg_advisory_xact_lock(hashtext('daily_tone_refresh'));
+
+CREATE TEMP TABLE refresh_bounds ON COMMIT DROP AS
+SELECT Min(Date(file_dt)) + 1 AS first_date,
+       Max(Date(file_dt)) -
+       CASE WHEN current_setting('daily_tone.include_last_date', true) = 'on'
+            THEN 0 ELSE 1 END AS last_date
+FROM gkg_ingest_ledger
+WHERE status = 'done';
+
+-- Takes the stale dates up to last_date. Rows added by ingest transactions
+-- which haven't committed yet aren't visible, so are kept for the next refresh.
+CREATE TEMP TABLE refresh_stale_dates (date DATE) ON COMMIT DROP;
+WITH taken AS (
+    DELETE FROM daily_tone_stale_dates
+    WHERE date <= (SELECT last_date FROM refresh_bounds)
+    RETURNING date
+)
+INSERT INTO refresh_stale_dates
+SELECT DISTINCT date FROM taken;
+
+-- New themes start from the last date already in "daily_tone" (ie. from
+-- before there were watermarks), or from the beginning
+INSERT INTO daily_tone_watermark (theme, computed_through)
+SELECT high_level,
+       (SELECT Max(date) FROM daily_tone WHERE theme = high_level)
+FROM themes_ref
+ON CONFLICT DO NOTHING;
+
+CREATE TEMP TABLE daily_tone_pending ON COMMIT DROP AS
+SELECT Date(dates.date) AS date,
+       daily_tone_watermark.theme
+FROM daily_tone_watermark
+     JOIN themes_ref ON themes_ref.high_level = daily_tone_watermark.theme,
+     refresh_bounds,
+     LATERAL (
+         SELECT generate_series(
+                    Greatest(first_date, computed_through + 1),
+                    last_date,
+                    INTERVAL '1 day'
+                ) AS date
+         UNION
+         SELECT date
+         FROM refresh_stale_dates
+         WHERE date >= first_date AND
+               date <= computed_through
+     ) dates;
+ANALYZE daily_tone_pending;
+
+DELETE FROM daily_tone
+USING daily_tone_pending
+WHERE daily_tone.date = daily_tone_pending.date AND
+      daily_tone.theme = daily_tone_pending.theme;
+
+-- Compute average tones for the pending (date, theme) pairs.
+-- gdelt_raw is read a date at a time by comparing the raw "datetime" column
+-- (not Date(datetime)), so that the BRIN index can be used, and so that only
+-- the partitions for those months are scanned if gdelt_raw is partitioned
+-- (see create_gdelt_raw_v2.sql).
+-- Rows written before "syndication_fp" and "source_country" existed need
+-- them filled in first (run syndication.py and source_countries.py), or they
+-- would all be grouped together and counted as from offshore.
 INSERT INTO daily_tone(date, country, from_onshore, theme, avg_tone, num_articles)
 SELECT date,
        country,
@@ -63,65 +170,43 @@ FROM (
            theme,
            Avg(tone)      AS tone
     FROM (
-        -- Construct "from_onshore" (for each country)
+        -- Construct "from_onshore" (for each country), from the country of
+        -- the source domain found at ingest (see source_countries.py)
         SELECT *,
-               CASE
-                 WHEN country = 'AS' THEN source_name LIKE '%.au%'
-                 ELSE source_name LIKE '%.' || Lower(country) || '%'
-               END AS from_onshore
+               Coalesce(source_country = country, FALSE) AS from_onshore
         FROM (
             -- Expand "countries", for rows with sufficient relevant themes
             SELECT *,
-                   ref_high_level AS theme,
                    Unnest(countries) AS country
             FROM (
-                -- Calculate proportion of relevant themes, for any date+theme
-                -- combinations not already calculated
-                SELECT *,
-                       CASE
-                          WHEN ref_high_level = 'ALL' THEN 1.0
-                          WHEN Cardinality(themes) = 0 THEN 0.0
-                          ELSE 1.0 * Cardinality(array_intersect(ref_low_levels, themes)) / Cardinality(themes)
-                       END AS prop_relevant_themes
-                FROM (
-                    -- Take all combinations of gdelt_raw and high/low themes,
-                    -- for any dates not the min/max
-                    SELECT gdelt_raw.*,
-                           Date(gdelt_raw.datetime) as date,
-                           themes_ref.high_level AS ref_high_level,
-                           themes_ref.low_levels AS ref_low_levels
-                    FROM   gdelt_raw,
-                           themes_ref,
-                           (
-                              SELECT Date(datetime) AS min_date
-                              FROM gdelt_raw
-                              ORDER BY gkg_id ASC
-                              LIMIT 1
-                           ) g_r_min,
-                           (
-                              SELECT Date(datetime) AS max_date
-                              FROM gdelt_raw
-                              ORDER BY gkg_id DESC
-                              LIMIT 1
-                           ) g_r_max
-                    WHERE --Date(gdelt_raw.datetime) >= '2021-08-16' AND -- FOR TESTING
-                          Date(gdelt_raw.datetime) > g_r_min.min_date AND
-                          Date(gdelt_raw.datetime) < g_r_max.max_date
-                ) gdelt_raw_w_themes
-                WHERE NOT EXISTS (
-                          SELECT FROM daily_tone
-                          WHERE date = gdelt_raw_w_themes.date AND
-                                theme = gdelt_raw_w_themes.ref_high_level
-                      )
+                -- Take the pending combinations of gdelt_raw dates and
+                -- themes, using the proportion of relevant themes computed at
+                -- ingest (see article_themes.py)
+                SELECT gdelt_raw.*,
+                       pending_dates.date,
+                       gdelt_raw_themes.theme
+                FROM   (
+                          SELECT DISTINCT date FROM daily_tone_pending
+                       ) pending_dates
+                       JOIN gdelt_raw
+                         ON gdelt_raw.datetime >= pending_dates.date AND
+                            gdelt_raw.datetime < pending_dates.date + 1
+                       JOIN gdelt_raw_themes
+                         ON gdelt_raw_themes.datetime = gdelt_raw.datetime AND
+                            gdelt_raw_themes.gkg_id = gdelt_raw.gkg_id
+                       JOIN daily_tone_pending
+                         ON daily_tone_pending.date = pending_dates.date AND
+                            daily_tone_pending.theme = gdelt_raw_themes.theme
+                -- theme threshold (compared as REAL, as it is stored)
+                WHERE  gdelt_raw_themes.prop_relevant > REAL '0.1'
             ) t1
-            WHERE  prop_relevant_themes > 0.1 -- theme threshold
         ) t2
     ) t3
     GROUP  BY date,
               country,
               from_onshore,
               theme,
-              pos, neg, wc -- to control for syndication
+              syndication_fp -- to control for syndication
 ) t4
 GROUP  BY date,
           country,
@@ -131,3 +216,10 @@ ORDER  BY date,
           country,
           from_onshore,
           theme;
+
+UPDATE daily_tone_watermark
+SET    computed_through = Greatest(computed_through, last_date),
+       refreshed_at = now()
+FROM   refresh_bounds
+WHERE  last_date IS NOT NULL AND
+       theme IN (SELECT high_level FROM themes_ref);
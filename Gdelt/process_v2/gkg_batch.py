@@ -0,0 +1,361 @@
+"""
+Compact, array-backed container for a batch of parsed "gdelt_raw" rows.
+
+A parsed row is a tuple of Python objects: a string per field, a list of
+strings per themes/persons/orgs/countries, a Loc_Item namedtuple per
+location and a float or int per tone/GCAM value, so a row of ~60 values
+takes a few KB of object headers and pointers, and pickling a file's rows
+(eg. from a parse process to the writer) means pickling every object. A
+GkgBatch holds the same rows as a handful of NumPy arrays:
+- numbers are typed columns: floats (tone, pos, ..., GCAM value dimensions)
+  are float64 with NaN for missing, and ints (wc, source, GCAM count
+  dimensions) are int32 with -1 for missing (counts are never negative),
+- strings are offset-encoded: one uint8 buffer of the UTF-8 bytes, and the
+  int64 offset of each string in it (the Arrow layout),
+- lists of strings are offsets into a string column of their elements,
+- locations are a structured array (type, country code, ADM1 code, lat,
+  long, feature id) with offsets per article, and a string column of names,
+- the full GCAM field (if the parser has full_gcam) is a list column of codes
+  and a float64 array of their values.
+
+So a batch pickles as a few large buffers, and `arrays()`/`from_arrays()`
+expose the buffers for the shared memory transport (see shm_transport.py).
+The writers take a GkgBatch wherever they take a list of rows, and
+`to_arrow_columns` gives Arrow arrays without building the rows (eg. for
+daily_tone_duckdb.py). `to_rows()` gives back exactly the tuples the parser
+produced.
+
+Usage:
+    batch = GkgBatch.from_rows(parser.iter_db_rows(lines, filename_dt),
+                               parser.gcam_codes)
+    write_processed_to_db_copy(batch)
+"""
+import numpy as np
+import pyarrow as pa
+
+from Gdelt.gcam_sparse import SparseGcam
+from Gdelt.gdelt_utils import GCAM_CODES, Loc_Item
+from Gdelt.gkg_parser import TONE_TYPES, get_gcam_type
+
+# Index of each column in a gdelt_raw row
+STRING_COLUMNS = {'gkg_id': 0, 'source_name': 3, 'doc_id': 4}
+LIST_COLUMNS = {'themes': 5, 'persons': 7, 'orgs': 8, 'countries': 9}
+DATETIME_COLUMN, SOURCE_COLUMN, LOCATIONS_COLUMN = 1, 2, 6
+FIRST_NUMBER_COLUMN = 10  # tone, ..., wc, then the GCAM codes
+MISSING_INT = -1
+
+
+def encode_strings(strings):
+    """
+    Offset-encodes strings (None is stored as an empty string). Returns the
+    (data, offsets) arrays.
+    """
+    encoded = [s.encode('utf-8') if s else b'' for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(data, offsets, empty=''):
+    """Inverse of `encode_strings`, with `empty` for empty strings."""
+    text = data.tobytes()
+    bounds = offsets.tolist()
+    return [text[start:end].decode('utf-8') if end > start else empty
+            for start, end in zip(bounds, bounds[1:])]
+
+
+def encode_lists(lists):
+    """Returns (offsets, data, string offsets) for lists of strings."""
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in lists], out=offsets[1:])
+    data, string_offsets = encode_strings([s for x in lists for s in x])
+    return offsets, data, string_offsets
+
+
+def split_by_offsets(values, offsets):
+    bounds = offsets.tolist()
+    return [values[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def slice_offsets(offsets, start, stop):
+    """The offsets of items start:stop, rebased to 0, and their bounds."""
+    first, last = int(offsets[start]), int(offsets[stop])
+    return offsets[start:stop + 1] - first, first, last
+
+
+def number_kinds(gcam_codes):
+    """'f' or 'i' for each number column: V1.5TONE then the GCAM codes."""
+    types = TONE_TYPES + [get_gcam_type(code) for code in gcam_codes]
+    return ['i' if type_ is int else 'f' for type_ in types]
+
+
+def location_dtype(locations):
+    """Structured dtype for the locations, with byte strings wide enough."""
+    def width(field):
+        return max([len(getattr(loc, field) or '') for loc in locations],
+                   default=0) or 1
+    return np.dtype([
+        ('type', np.int8),
+        ('country_code', f'S{width("country_code")}'),
+        ('adm1_code', f'S{width("ADM1_code")}'),
+        ('lat', np.float64),
+        ('long', np.float64),
+        ('feature_id', f'S{width("feature_id")}'),
+    ])
+
+
+class GkgBatch:
+    """
+    Columns of a batch of gdelt_raw rows, held in `self.columns` (a dict of
+    name -> ndarray), plus the GCAM codes of the wide columns.
+    """
+    def __init__(self, columns, gcam_codes=GCAM_CODES):
+        self.columns = columns
+        self.gcam_codes = list(gcam_codes)
+
+    @classmethod
+    def from_rows(cls, rows, gcam_codes=GCAM_CODES):
+        rows = list(rows)
+        columns = {}
+        for name, index in STRING_COLUMNS.items():
+            columns[f'{name}.data'], columns[f'{name}.offsets'] = \
+                encode_strings([row[index] for row in rows])
+        for name, index in LIST_COLUMNS.items():
+            (columns[f'{name}.offsets'], columns[f'{name}.data'],
+             columns[f'{name}.string_offsets']) = \
+                encode_lists([row[index] for row in rows])
+        columns['datetime'] = np.array([row[DATETIME_COLUMN] for row in rows],
+                                       dtype='datetime64[s]')
+        columns['source'] = np.array([row[SOURCE_COLUMN] for row in rows],
+                                     dtype=np.int16)
+
+        locations = [loc for row in rows for loc in row[LOCATIONS_COLUMN]]
+        columns['locations.offsets'] = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(row[LOCATIONS_COLUMN]) for row in rows],
+                  out=columns['locations.offsets'][1:])
+        columns['locations'] = np.array([
+            (MISSING_INT if loc.type is None else loc.type,
+             (loc.country_code or '').encode('utf-8'),
+             (loc.ADM1_code or '').encode('utf-8'),
+             np.nan if loc.lat is None else loc.lat,
+             np.nan if loc.long is None else loc.long,
+             (loc.feature_id or '').encode('utf-8'))
+            for loc in locations
+        ], dtype=location_dtype(locations))
+        columns['locations.name_data'], columns['locations.name_offsets'] = \
+            encode_strings([loc.full_name for loc in locations])
+
+        kinds = number_kinds(gcam_codes)
+        number_end = FIRST_NUMBER_COLUMN + len(kinds)
+        for kind in 'fi':
+            indices = [FIRST_NUMBER_COLUMN + i
+                       for i, k in enumerate(kinds) if k == kind]
+            missing = np.nan if kind == 'f' else MISSING_INT
+            columns[f'numbers.{kind}'] = np.array(
+                [[missing if row[i] is None else row[i] for i in indices]
+                 for row in rows],
+                dtype=np.float64 if kind == 'f' else np.int32
+            ).reshape(len(rows), len(indices))
+
+        if rows and len(rows[0]) > number_end:
+            sparse = [row[number_end] for row in rows]
+            (columns['gcam.offsets'], columns['gcam.data'],
+             columns['gcam.string_offsets']) = \
+                encode_lists([s.codes for s in sparse])
+            columns['gcam.values'] = np.array(
+                [value for s in sparse for value in s.values], dtype=np.float64
+            )
+        return cls(columns, gcam_codes)
+
+    def __len__(self):
+        return len(self.columns['datetime'])
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.columns.values())
+
+    @property
+    def full_gcam(self):
+        return 'gcam.values' in self.columns
+
+    def arrays(self):
+        """The batch's buffers, as a dict of name -> ndarray."""
+        return self.columns
+
+    @classmethod
+    def from_arrays(cls, arrays, gcam_codes=GCAM_CODES):
+        return cls(dict(arrays), gcam_codes)
+
+    def strings(self, name):
+        return decode_strings(self.columns[f'{name}.data'],
+                              self.columns[f'{name}.offsets'])
+
+    def lists(self, name):
+        return split_by_offsets(
+            decode_strings(self.columns[f'{name}.data'],
+                           self.columns[f'{name}.string_offsets']),
+            self.columns[f'{name}.offsets']
+        )
+
+    def loc_items(self):
+        """The Loc_Items of each row."""
+        names = decode_strings(self.columns['locations.name_data'],
+                               self.columns['locations.name_offsets'],
+                               empty=None)
+        items = [
+            Loc_Item(None if type_ == MISSING_INT else type_, name,
+                     country_code.decode('utf-8') or None,
+                     adm1_code.decode('utf-8') or None,
+                     None if lat != lat else lat,  # NaN
+                     None if long != long else long,
+                     feature_id.decode('utf-8') or None)
+            for (type_, country_code, adm1_code, lat, long, feature_id), name
+            in zip(self.columns['locations'].tolist(), names)
+        ]
+        return split_by_offsets(items, self.columns['locations.offsets'])
+
+    def number_rows(self):
+        """The V1.5TONE and wide GCAM values of each row, None if missing."""
+        kinds = number_kinds(self.gcam_codes)
+        floats = self.columns['numbers.f'].tolist()
+        ints = self.columns['numbers.i'].tolist()
+        out = []
+        for float_row, int_row in zip(floats, ints):
+            float_row, int_row = iter(float_row), iter(int_row)
+            values = []
+            for kind in kinds:
+                if kind == 'f':
+                    value = next(float_row)
+                    values.append(None if value != value else value)
+                else:
+                    value = next(int_row)
+                    values.append(None if value == MISSING_INT else value)
+            out.append(values)
+        return out
+
+    def to_rows(self):
+        """The batch as the list of row tuples the parser produced."""
+        columns = [
+            self.strings('gkg_id'),
+            self.columns['datetime'].astype(object).tolist(),
+            self.columns['source'].tolist(),
+            self.strings('source_name'),
+            self.strings('doc_id'),
+            self.lists('themes'),
+            self.loc_items(),
+            self.lists('persons'),
+            self.lists('orgs'),
+            self.lists('countries'),
+        ]
+        rows = [(*info, *numbers)
+                for *info, numbers in zip(*columns, self.number_rows())]
+        if self.full_gcam:
+            values = split_by_offsets(self.columns['gcam.values'].tolist(),
+                                      self.columns['gcam.offsets'])
+            rows = [(*row, SparseGcam(codes, row_values))
+                    for row, codes, row_values
+                    in zip(rows, self.lists('gcam'), values)]
+        return rows
+
+    def slice(self, start, stop):
+        """The rows start:stop, as a new GkgBatch (the arrays are views)."""
+        columns = {}
+        for name, array in self.columns.items():
+            if name in ('datetime', 'source') or name.startswith('numbers.'):
+                columns[name] = array[start:stop]
+        for name in ['locations', 'gcam', *STRING_COLUMNS, *LIST_COLUMNS]:
+            if f'{name}.offsets' not in self.columns:
+                continue
+            offsets, first, last = slice_offsets(
+                self.columns[f'{name}.offsets'], start, stop
+            )
+            columns[f'{name}.offsets'] = offsets
+            if name in STRING_COLUMNS:
+                columns[f'{name}.data'] = self.columns[f'{name}.data'][first:last]
+                continue
+            if name == 'locations':
+                columns['locations'] = self.columns['locations'][first:last]
+                prefix, data = 'locations.name_', 'locations.name_data'
+                string_offsets = self.columns['locations.name_offsets']
+            else:
+                prefix, data = f'{name}.string_', f'{name}.data'
+                string_offsets = self.columns[f'{name}.string_offsets']
+                if name == 'gcam':
+                    columns['gcam.values'] = \
+                        self.columns['gcam.values'][first:last]
+            string_offsets, data_first, data_last = slice_offsets(
+                string_offsets, first, last
+            )
+            columns[prefix + 'offsets'] = string_offsets
+            columns[data] = self.columns[data][data_first:data_last]
+        return GkgBatch(columns, self.gcam_codes)
+
+    def iter_chunks(self, max_rows):
+        for start in range(0, len(self), max_rows):
+            yield self.slice(start, min(start + max_rows, len(self)))
+
+    @classmethod
+    def concat(cls, batches):
+        """Joins batches (with the same GCAM codes) into one."""
+        batches = [batch for batch in batches if len(batch)]
+        if len(batches) == 1:
+            return batches[0]
+        if not batches:
+            return cls.from_rows([])
+        columns = {}
+        for name in batches[0].columns:
+            arrays = [batch.columns[name] for batch in batches]
+            if name.endswith('offsets'):
+                # Rebase each batch's offsets onto the end of the previous one
+                shift = np.cumsum([0] + [int(a[-1]) for a in arrays[:-1]])
+                columns[name] = np.concatenate(
+                    [arrays[0][:1]] + [a[1:] + s for a, s in zip(arrays, shift)]
+                )
+            elif name == 'locations':
+                dtype = np.result_type(*[a.dtype for a in arrays])
+                columns[name] = np.concatenate([a.astype(dtype)
+                                                for a in arrays])
+            else:
+                columns[name] = np.concatenate(arrays)
+        return cls(columns, batches[0].gcam_codes)
+
+    def to_arrow_columns(self):
+        """
+        The string, list and number columns as Arrow arrays, built from the
+        buffers without creating Python objects. Number columns are named as
+        in gdelt_raw for the V1.5TONE values, and by code for GCAM.
+        """
+        def string_array(data, offsets):
+            return pa.LargeStringArray.from_buffers(
+                len(offsets) - 1, pa.py_buffer(offsets), pa.py_buffer(data)
+            )
+
+        out = {'datetime': pa.array(self.columns['datetime']),
+               'source': pa.array(self.columns['source'])}
+        for name in STRING_COLUMNS:
+            out[name] = string_array(self.columns[f'{name}.data'],
+                                     self.columns[f'{name}.offsets'])
+        for name in LIST_COLUMNS:
+            out[name] = pa.LargeListArray.from_arrays(
+                pa.array(self.columns[f'{name}.offsets']),
+                string_array(self.columns[f'{name}.data'],
+                             self.columns[f'{name}.string_offsets'])
+            )
+        names = ['tone', 'pos', 'neg', 'polarity', 'ard', 'srd', 'wc',
+                 *self.gcam_codes]
+        positions = {'f': 0, 'i': 0}
+        for name, kind in zip(names, number_kinds(self.gcam_codes)):
+            values = self.columns[f'numbers.{kind}'][:, positions[kind]]
+            positions[kind] += 1
+            out[name] = pa.array(
+                values, mask=np.isnan(values) if kind == 'f'
+                else values == MISSING_INT
+            )
+        return out
+
+
+def as_rows(processed):
+    """The rows of a GkgBatch, or the list of rows unchanged."""
+    if isinstance(processed, GkgBatch):
+        return processed.to_rows()
+    return processed
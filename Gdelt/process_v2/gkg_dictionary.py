@@ -0,0 +1,106 @@
+"""
+Dictionary encoding of the "themes", "persons" and "orgs" columns of
+"gdelt_raw" (version 2 schema, see create_gdelt_raw_v2.sql), which are
+INTEGER[] of ids in the "gkg_themes", "gkg_persons" and "gkg_orgs" tables
+rather than TEXT[].
+
+The parser still produces rows with lists of strings. The writers call
+`encode_rows` in the same transaction as the rows, which replaces the lists
+with lists of ids, adding any new strings to the dictionary tables. Ids are
+cached in memory, so the database is only asked about strings which haven't
+been seen by this process. Ids for strings inserted by this transaction are
+not cached until they are seen again, since the transaction may still be
+rolled back.
+
+If the columns are still TEXT[] (version 1 schema), the rows are unchanged.
+"""
+import threading
+
+from Gdelt.process_v2.gdelt_raw_columns import get_columns
+
+DB_TABLE = "gdelt_raw"
+# Index of each dictionary-encoded column in a gdelt_raw row, and its table
+DICTIONARY_COLUMNS = {
+    5: ("themes", "gkg_themes"),
+    7: ("persons", "gkg_persons"),
+    8: ("orgs", "gkg_orgs"),
+}
+MAX_CACHED = 1000000  # ids per dictionary, before the cache is cleared
+
+
+def is_dictionary_encoded(cur):
+    """True if the "themes" column of gdelt_raw holds dictionary ids."""
+    return get_columns(cur, DB_TABLE).get('themes') == 'integer[]'
+
+
+class Dictionary:
+    """Cached name -> id lookup for one dictionary table."""
+    def __init__(self, table):
+        self.table = table
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def get_ids(self, cur, names):
+        """
+        Returns a dict of name -> id for the names, adding any new names to
+        the table (as part of the caller's transaction).
+        """
+        with self._lock:
+            ids = {name: self._ids[name] for name in names if name in self._ids}
+        missing = [name for name in names if name not in ids]
+        if not missing:
+            return ids
+
+        committed = self._select(cur, missing)
+        missing = sorted(set(missing) - committed.keys())
+        if missing:
+            # Sorted so that concurrent writers lock the names in the same order
+            cur.execute(f"""
+                INSERT INTO {self.table} (name)
+                SELECT Unnest(%s::TEXT[])
+                ON CONFLICT (name) DO NOTHING
+                RETURNING name, id
+            """, (missing,))
+            ids.update(cur.fetchall())
+            # Names inserted by another writer since the select
+            committed.update(self._select(cur, set(missing) - ids.keys()))
+        ids.update(committed)
+
+        with self._lock:
+            if len(self._ids) + len(committed) > MAX_CACHED:
+                self._ids.clear()
+            self._ids.update(committed)
+        return ids
+
+    def _select(self, cur, names):
+        if not names:
+            return {}
+        cur.execute(f"SELECT name, id FROM {self.table} WHERE name = ANY(%s)",
+                    (list(names),))
+        return dict(cur.fetchall())
+
+
+_dictionaries = {
+    index: Dictionary(table) for index, (_, table) in DICTIONARY_COLUMNS.items()
+}
+
+
+def encode_rows(cur, processed):
+    """
+    Returns the gdelt_raw rows with the themes, persons and orgs replaced by
+    their dictionary ids, or the rows unchanged if gdelt_raw isn't dictionary
+    encoded.
+    """
+    if not processed or not is_dictionary_encoded(cur):
+        return processed
+    ids = {}
+    for index, dictionary in _dictionaries.items():
+        names = {name for row in processed for name in row[index]}
+        ids[index] = dictionary.get_ids(cur, names)
+    encoded = []
+    for row in processed:
+        row = list(row)
+        for index, column_ids in ids.items():
+            row[index] = [column_ids[name] for name in row[index]]
+        encoded.append(tuple(row))
+    return encoded
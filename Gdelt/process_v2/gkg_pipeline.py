@@ -0,0 +1,327 @@
+"""
+Staged pipeline for ingesting GKG files into "gdelt_raw", which separates the
+I/O-bound and CPU-bound work so that parsing isn't limited to one core by the
+GIL:
+
+    fetch (threads) -> decompress + parse (processes) -> write (one thread)
+
+- Fetcher threads download the compressed zip files, each with its own
+  keep-alive requests.Session, and check them against the size and md5 in
+  the master list (retrying a corrupt download). With `async_fetch`, one
+  thread runs the downloads on an event loop instead, over a shared pool of
+  keep-alive connections (see Gdelt/gkg_async_fetch.py). With a
+  `fetch_controller`, the number of downloads at once grows and shrinks
+  with their throughput and errors (see adaptive_concurrency.py).
+- The zip files are inflated and parsed in a process pool (started with
+  forkserver, as the other stages' threads are already running). With
+  `shared_memory`, each worker puts its file's rows (as a GkgBatch) in a
+  shared memory block and only returns its handle, so the parent doesn't
+  unpickle the rows (see shm_transport.py).
+- A single writer thread gathers the rows of many files and loads them in
+  batches of at least `batch_rows` rows or `batch_bytes` bytes, along with
+  the files' entries in the ingest ledger (see batch_writer.py and
+  ingest_ledger.py).
+
+The stages are connected by bounded queues (and a bounded number of files in
+the process pool), so a slow stage makes the earlier stages wait rather than
+piling up downloaded files or parsed rows in memory.
+
+Files are processed in the order given, so pass master list entries through
+`gkg_master_list.schedule_by_size` to start the biggest files first.
+
+Usage:
+    parser = GkgParser(['NZ', 'AS'])
+    stats = run_pipeline(schedule_by_size(gkg_entries), parser)
+"""
+import io
+import os
+import re
+import queue
+import asyncio
+import threading
+import multiprocessing
+import concurrent.futures
+from collections import deque
+from time import perf_counter
+
+import requests
+
+from Gdelt.gkg_async_fetch import PER_HOST, AsyncFetcher
+from Gdelt.gkg_fetch import download_gkg_zip, iter_zip_lines, open_zip_member
+from Gdelt.gkg_master_list import as_entry
+from Gdelt.process_v2.batch_writer import BATCH_BYTES, BATCH_ROWS, BatchWriter
+from Gdelt.process_v2.gdelt_raw_copy import write_processed_to_db_copy
+from Gdelt.process_v2.gkg_batch import GkgBatch
+from Gdelt.process_v2.gkg_vectorized import parse_gkg_file
+from Gdelt.process_v2.ingest_ledger import (
+    STATUS_DONE, STATUS_FAILED, make_entry, record_failures
+)
+from adaptive_concurrency import AimdController, AimdLimiter, AsyncAimdLimiter
+from shm_transport import ShmHandle, put_arrays, take_arrays
+
+NUM_FETCHERS = 5
+MAX_FETCHERS = 32  # with a fetch_controller
+NUM_PARSERS = os.cpu_count() or 1
+QUEUE_SIZE = 16  # max files waiting between stages
+# The parse processes are started while the fetcher and writer threads are
+# running, so they mustn't be forked from this process: a thread may hold a
+# lock (eg. stdout's, or the connection pool's) which would then never be
+# released in the child. They are forked from a clean server process instead.
+MP_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+    else 'spawn'
+)
+
+_DONE = object()  # sentinel marking the end of a queue
+
+
+def get_filename_dt(file_url):
+    return re.search(r'(\d{14}).gkg.csv.zip$', file_url).group(1)
+
+
+def parse_gkg_zip(data, filename_dt, parser, vectorized=False):
+    """
+    Inflates and parses the bytes of a GKG zip file (in a worker process).
+    Returns the list of row tuples for the "gdelt_raw" table.
+    """
+    if vectorized:
+        csv_data = open_zip_member([data]).read()
+        processed = parse_gkg_file(csv_data, filename_dt, parser)
+        if processed is not None:
+            return processed
+        # Irregular file, so fall back to the line-by-line parser
+        lines = io.TextIOWrapper(io.BytesIO(csv_data), encoding='latin-1')
+        return parser.db_rows(lines, filename_dt)
+    return parser.db_rows(iter_zip_lines([data]), filename_dt)
+
+
+def timed_parse_gkg_zip(data, filename_dt, parser, vectorized=False,
+                        compact=False, shared_memory=False):
+    """
+    parse_gkg_zip, also returning the seconds taken. If compact, the rows are
+    returned as a GkgBatch, which is much cheaper to send back from the
+    worker process than the row tuples (see gkg_batch.py). If shared_memory,
+    the GkgBatch's arrays are put in shared memory, and the ShmHandle is
+    returned instead (with the number of rows as its meta).
+    """
+    start = perf_counter()
+    processed = parse_gkg_zip(data, filename_dt, parser, vectorized)
+    if compact or shared_memory:
+        processed = GkgBatch.from_rows(processed, parser.gcam_codes)
+    if shared_memory:
+        processed = put_arrays(processed.arrays(), meta=len(processed))
+    return processed, perf_counter() - start
+
+
+def fetch_worker(files, fetched, limiter):
+    """
+    Downloads files from the files queue until it is empty, while the
+    limiter (see adaptive_concurrency.py) has a free slot.
+    """
+    session = requests.Session()
+    try:
+        while True:
+            try:
+                entry = files.get_nowait()
+            except queue.Empty:
+                break
+            file_url = entry.url
+            start = perf_counter()
+            try:
+                with limiter.slot():
+                    data = download_gkg_zip(file_url, session=session,
+                                            size=entry.size, md5=entry.md5)
+            except Exception as e:
+                print(f"{file_url} FETCH EXCEPTION: {e}; {type(e)}")
+                data = None
+            # blocks while the parse stage is full
+            fetched.put((file_url, data, perf_counter() - start))
+    finally:
+        session.close()
+        fetched.put(_DONE)
+
+
+def async_fetch_worker(files, fetched, controller, per_host=PER_HOST):
+    """
+    Downloads the files from the files queue with an AsyncFetcher, up to
+    `controller.limit` at once (and per_host from one host), until it is
+    empty.
+    """
+    async def fetch(fetcher, limiter):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                entry = files.get_nowait()
+            except queue.Empty:
+                break
+            start = perf_counter()
+            try:
+                async with limiter.slot():
+                    data = await fetcher.download(entry.url, size=entry.size,
+                                                  md5=entry.md5)
+            except Exception as e:
+                print(f"{entry.url} FETCH EXCEPTION: {e}; {type(e)}")
+                data = None
+            # blocks (in a thread) while the parse stage is full
+            await loop.run_in_executor(
+                None, fetched.put, (entry.url, data, perf_counter() - start)
+            )
+
+    async def fetch_all():
+        limiter = AsyncAimdLimiter(controller)
+        async with AsyncFetcher(controller.max_limit, per_host) as fetcher:
+            await asyncio.gather(*[fetch(fetcher, limiter)
+                                   for _ in range(controller.max_limit)])
+
+    try:
+        asyncio.run(fetch_all())
+    finally:
+        fetched.put(_DONE)
+
+
+def write_worker(parsed, writer, errors):
+    """
+    Writes the rows from the parsed queue with a BatchWriter, ie. in batches
+    of >= batch_rows rows (or batch_bytes), with the ledger entries of the
+    files in the batch.
+
+    If the writer raises, the exception is appended to errors, and the rest
+    of the queue is drained (without writing) so that the earlier stages
+    don't block on it. run_pipeline re-raises it.
+    """
+    try:
+        while True:
+            item = parsed.get()
+            if item is _DONE:
+                break
+            processed, entry = item
+            writer(processed, ledger_entries=[entry])
+        writer.flush()
+    except Exception as e:
+        print(f"WRITE EXCEPTION: {e}; {type(e)}")
+        errors.append(e)
+        while item is not _DONE:
+            item = parsed.get()
+
+
+def run_pipeline(files, parser, writer=write_processed_to_db_copy,
+                 vectorized=False, num_fetchers=NUM_FETCHERS,
+                 num_parsers=NUM_PARSERS, queue_size=QUEUE_SIZE,
+                 batch_rows=BATCH_ROWS, batch_bytes=BATCH_BYTES,
+                 compact=False, shared_memory=False, async_fetch=False,
+                 fetch_controller=None):
+    """
+    Downloads, parses and writes the GKG files, in order.
+
+    files: list of MasterEntry (see gkg_master_list.py), or of plain urls if
+        the sizes and md5s aren't known.
+    parser: GkgParser, with the countries and GCAM codes of interest.
+    writer: function which loads a list of rows, and the ledger entries of
+        the files they came from, into the database.
+    vectorized: if True, use the columnar parser (see gkg_raw_to_db.py).
+    num_fetchers: downloads at once, unless there is a fetch_controller.
+    compact: if True, the parse processes send the rows back as GkgBatches
+        (see gkg_batch.py) rather than lists of tuples.
+    shared_memory: if True, the parse processes send the GkgBatches through
+        shared memory (see shm_transport.py), and the parent copies their
+        arrays out rather than unpickling them.
+    async_fetch: if True, the downloads share one pool of keep-alive
+        connections on an event loop (see Gdelt/gkg_async_fetch.py), rather
+        than each fetcher thread having its own connection.
+    fetch_controller: optional AimdController (see adaptive_concurrency.py),
+        which sets the number of downloads at once (up to its max_limit) from
+        their throughput, latency and errors, backing off when GDELT
+        throttles with a 429 or 503.
+
+    Returns a dict with the number of files and rows written, and the
+    timestamps of the files which failed to be fetched, parsed or written
+    (which are recorded as 'failed' in the ingest ledger). If the writer
+    raises rather than returning False, the exception is re-raised once the
+    other stages have stopped.
+    """
+    file_queue = queue.Queue()
+    for file in files:
+        file_queue.put(as_entry(file))
+    fetched = queue.Queue(maxsize=queue_size)
+    parsed = queue.Queue(maxsize=queue_size)
+    batch_writer = BatchWriter(writer, batch_rows, batch_bytes)
+    stats = batch_writer.stats
+    failed_entries = []
+    write_errors = []
+
+    if fetch_controller is None:
+        fetch_controller = AimdController(num_fetchers, min_limit=num_fetchers,
+                                          max_limit=num_fetchers)
+    if async_fetch:
+        fetchers = [
+            threading.Thread(target=async_fetch_worker,
+                             args=(file_queue, fetched, fetch_controller),
+                             daemon=True)
+        ]
+    else:
+        limiter = AimdLimiter(fetch_controller)
+        fetchers = [
+            threading.Thread(target=fetch_worker,
+                             args=(file_queue, fetched, limiter), daemon=True)
+            for _ in range(fetch_controller.max_limit)
+        ]
+    write_thread = threading.Thread(
+        target=write_worker, args=(parsed, batch_writer, write_errors),
+        daemon=True
+    )
+    for thread in [*fetchers, write_thread]:
+        thread.start()
+
+    def collect(future, file_url, filename_dt, fetch_seconds, num_bytes):
+        try:
+            processed, parse_seconds = future.result()
+        except Exception as e:
+            print(f"{file_url} PARSE EXCEPTION: {e}; {type(e)}")
+            failed_entries.append(make_entry(filename_dt, STATUS_FAILED))
+            return
+        if isinstance(processed, ShmHandle):
+            processed = GkgBatch.from_arrays(take_arrays(processed),
+                                             parser.gcam_codes)
+        entry = make_entry(filename_dt, STATUS_DONE, len(processed),
+                           fetch_seconds + parse_seconds, num_bytes)
+        parsed.put((processed, entry))  # blocks while the writer is busy
+
+    # Dispatch fetched files to the process pool, with at most queue_size
+    # files being parsed at once.
+    with concurrent.futures.ProcessPoolExecutor(
+            num_parsers, mp_context=MP_CONTEXT) as executor:
+        in_flight = deque()
+        fetchers_running = len(fetchers)
+        while fetchers_running:
+            item = fetched.get()
+            if item is _DONE:
+                fetchers_running -= 1
+                continue
+            file_url, data, fetch_seconds = item
+            filename_dt = get_filename_dt(file_url)
+            if data is None:
+                failed_entries.append(make_entry(filename_dt, STATUS_FAILED))
+                continue
+            print(file_url.split('/')[-1][:-4])
+            future = executor.submit(timed_parse_gkg_zip, data, filename_dt,
+                                     parser, vectorized, compact,
+                                     shared_memory)
+            in_flight.append(
+                (future, file_url, filename_dt, fetch_seconds, len(data))
+            )
+            while len(in_flight) >= queue_size or (in_flight and
+                                                   in_flight[0][0].done()):
+                collect(*in_flight.popleft())
+        while in_flight:
+            collect(*in_flight.popleft())
+
+    parsed.put(_DONE)
+    write_thread.join()
+    if failed_entries:
+        record_failures(failed_entries)
+        stats['failed'] += [entry.file_dt for entry in failed_entries]
+    if write_errors:
+        # The files after the failed write aren't in the ledger, so they are
+        # pending for the next run
+        raise write_errors[0]
+    return stats
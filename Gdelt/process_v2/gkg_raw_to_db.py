@@ -9,108 +9,158 @@
 #     'amounts', 'translation', 'extra'
 # ]
 
-import io, zipfile
+import io
 import re
-import concurrent.futures
+import argparse
 
 from datetime import datetime
-from operator import itemgetter
-from itertools import repeat
-from collections import namedtuple
+from functools import partial
+from time import perf_counter, sleep
 
 import requests
-import psycopg2
-from psycopg2 import extras
 
-import postgres_config
+from Gdelt.gkg_fetch import download_gkg_zip, iter_zip_lines, stream_gkg_zip
+from Gdelt.gkg_lake import LAKE_DIR, PARSER_FIELDS, iter_lake_lines
+from Gdelt.gkg_master_list import (
+    LAST_UPDATE_URL, LastUpdatePoller, MasterList, as_entry, catch_up_entries,
+    get_entry_dt, schedule_by_size
+)
+from Gdelt.gkg_parser import GkgParser, iter_row_chunks
+from Gdelt.process_v2.article_themes import (
+    THEMES_TABLE, has_themes_table, write_article_themes
+)
+from Gdelt.process_v2.daily_tone import refresh_daily_tone
+from Gdelt.process_v2.db_pool import get_conn, get_pool
+from Gdelt.process_v2.gdelt_raw_copy import write_processed_to_db_copy
+from Gdelt.process_v2.gcam_arrays import add_gcam_arrays
+from Gdelt.process_v2.gdelt_raw_columns import row_columns
+from Gdelt.process_v2.gdelt_raw_partitions import ensure_partitions
+from Gdelt.process_v2.gkg_batch import as_rows
+from Gdelt.process_v2.gkg_dictionary import encode_rows
+from Gdelt.process_v2.gkg_pipeline import (
+    MAX_FETCHERS, NUM_FETCHERS, parse_gkg_zip, run_pipeline
+)
+from Gdelt.process_v2.ingest_ledger import (
+    LEDGER_TABLE, STATUS_DONE, STATUS_FAILED, get_done_dts, get_last_done_dt,
+    make_entry, record_entries, record_failures
+)
+from Gdelt.process_v2.source_countries import add_source_countries
+from Gdelt.process_v2.syndication import forget_seen, mark_syndicated
+from adaptive_concurrency import AimdController
 
 io.DEFAULT_BUFFER_SIZE = 8192*4
 DB_TABLE = "gdelt_raw"
-CONNECTION_DETAILS = (
-    f"host={postgres_config.HOST} "
-    "dbname=gdelt "
-    "user=postgres "
-    f"password={postgres_config.PASSWORD}"
-)
+# Rows of a file passed to the writer at a time (see `process_gkg`)
+FLUSH_ROWS = 5000
+FLUSH_BYTES = 16 * 2**20
+# Follow mode (see `follow`): GDELT publishes a file every 15 minutes
+POLL_SECONDS = 10
+MAX_CATCH_UP = 96  # files ingested after a gap (older ones need a batch run)
 
 
-def get_dts_in_db():
-    """Returns list of datetime-strings already in the database.
+def filter_gkg_files(gkg_files):
     """
-    all_dt_query = """
-    SELECT DISTINCT datetime FROM gdelt_raw
+    Drops the files which the ingest ledger records as done. This is a set
+    lookup per file, and reads one ledger row per file rather than scanning
+    "gdelt_raw".
     """
-    with psycopg2.connect(CONNECTION_DETAILS) as conn:
-        with conn.cursor() as cur:
-            try:
-                cur.execute(all_dt_query)
-                dts_in_db = cur.fetchall()
-            except Exception as e:
-                print(f"Exception executing Select Query: {e}")
-                print(f"Exception type: {type(e)}")
-    
-    dt_strs = [x[0].strftime("%Y%m%d%H%M%S") for x in dts_in_db]
-    return dt_strs
-
-
-def filter_gkg_files(gkg_files):
-    already_processed_dts = get_dts_in_db()
+    already_processed_dts = get_done_dts()
     filtered = [
-        f_url for f_url in gkg_files
+        entry for entry in gkg_files
         if re.search(
-            r'(\d{14}).gkg.csv.zip$', f_url
+            r'(\d{14}).gkg.csv.zip$', entry.url
         ).group(1) not in already_processed_dts
     ]
     return filtered
     
 
-def get_loc_item(loc_item_str):
-    loc_dtypes = [int, str, str, str, float, float, str]
-    parts = loc_item_str.split('#')
-    converted_parts = [
-        new_dtype(item) if item != '' else None 
-        for item, new_dtype in zip(parts, loc_dtypes)
-    ]
-    loc_item = Loc_Item(*converted_parts)
-    return loc_item
-
-
 def get_gkg_files(update_master_list=True):
-    master_list_fpath = '../data/gdelt2_master.txt'
-    
+    """
+    Returns the MasterEntry (size, md5, url) of every GKG file, newest first.
+    """
+    master_list = MasterList('../data/gdelt2_master.txt')
     if update_master_list:
-        master_list = 'http://data.gdeltproject.org/gdeltv2/masterfilelist.txt'
-        r = requests.get(master_list, stream=True)
-        with open(master_list_fpath, mode='wb') as localfile:
-            for line in r.iter_lines():
-                if b'gkg.csv.zip' in line:
-                    localfile.write(line + b'\n')
-                    
-    with open(master_list_fpath) as f:
-        gkg_files = [line.split(' ')[2][:-1] for line in f]
+        # Only fetches the part of the master list added since the last run
+        master_list.update()
+    gkg_files = master_list.entries()
                     
     # flip order, so goes from most recent to least recent
     return gkg_files[::-1]
 
 
-def write_processed_to_db(processed):
-    num_columns = len(processed[0])
-    insert_query = (
-        "INSERT INTO gdelt_raw VALUES " +
-        ','.join(['%s'] * len(processed))
-    )
-    with psycopg2.connect(CONNECTION_DETAILS) as conn:
-        conn.autocommit = True
+def write_processed_to_db(processed, ledger_entries=(), skip_syndicated=False):
+    """
+    INSERTs the rows (a list, or a GkgBatch - see gkg_batch.py), skipping
+    any already in gdelt_raw, and records the ledger entries for the files
+    they came from in the same transaction. Syndicated copies are flagged,
+    or skipped if skip_syndicated (see syndication.py). Returns True if
+    committed.
+    """
+    with get_conn() as conn:
         with conn.cursor() as cur:
-            extras.register_composite('location_item', cur)
             try:
-                cur.execute(insert_query, processed)
+                processed = as_rows(processed)
+                ensure_partitions(cur, processed)
+                processed = mark_syndicated(cur, processed, skip_syndicated)
+                processed = add_source_countries(cur, processed)
+                processed = add_gcam_arrays(cur, processed)
+                if processed:
+                    columns = ', '.join(row_columns(cur))
+                    cur.execute(
+                        f"INSERT INTO gdelt_raw ({columns}) VALUES " +
+                        ','.join(['%s'] * len(processed)) +
+                        " ON CONFLICT DO NOTHING",
+                        encode_rows(cur, processed)
+                    )
+                write_article_themes(cur, processed)
+                record_entries(cur, ledger_entries)
             except Exception as e:
                 print(f"Exception executing Insert Query: {e}")
                 print(f"Exception type: {type(e)}")
+                conn.rollback()
+                forget_seen()
+                return False
+    return True
+
+
+def delete_file_rows(filename_dt, writer=None):
+    """
+    Deletes the rows of one GKG file from gdelt_raw (and gdelt_raw_themes),
+    eg. those written from a download which then failed its check, so that
+    the retry writes them again (the writers skip rows already in
+    gdelt_raw). The writer is flushed first if it buffers rows (see
+    batch_writer.py), so none of the file's rows are written after this.
+    Nothing is deleted if the ledger already records the file as done (eg.
+    a re-run of a file whose rows are complete). Returns the number of
+    gdelt_raw rows deleted.
+    """
+    if hasattr(writer, 'flush'):
+        writer.flush()
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT 1 FROM {LEDGER_TABLE}
+                WHERE file_dt = %s AND status = %s
+            """, (make_entry(filename_dt, STATUS_DONE).file_dt, STATUS_DONE))
+            if cur.fetchone():
+                return 0
+            params = {'gkg_ids': f'{filename_dt}-%'}
+            if has_themes_table(cur):
+                cur.execute(f"""
+                    DELETE FROM {THEMES_TABLE} WHERE gkg_id LIKE %(gkg_ids)s
+                """, params)
+            cur.execute(f"""
+                DELETE FROM {DB_TABLE} WHERE gkg_id LIKE %(gkg_ids)s
+            """, params)
+            num_deleted = cur.rowcount
+    # Their fingerprints may be in the seen sets
+    forget_seen()
+    return num_deleted
         
 
-def process_gkg(file_url, countries_of_interest):
+def process_gkg(gkg_file, parser, vectorized=False,
+                writer=write_processed_to_db, flush_rows=FLUSH_ROWS,
+                flush_bytes=FLUSH_BYTES, session=None):
     """
     NOTE:
     Some raw data files seem to have corrupted/non-unique GKGRECORDID field,
@@ -123,133 +173,220 @@ def process_gkg(file_url, countries_of_interest):
         20150219093000
         20150219003000
     
+    gkg_file: MasterEntry (see gkg_master_list.py), so the download can be
+        checked against its size and md5, or just the file url. The file is
+        inflated and parsed as it is downloaded, so it is checked once it
+        has been read, before its ledger entry is written. The rows written
+        from it are already committed by then, so if the download fails
+        (doesn't match, or breaks off) they are deleted again (see
+        `delete_file_rows`): the file isn't marked done, and is retried in
+        full.
+    parser: GkgParser, with the countries and GCAM codes of interest.
+    vectorized: if True, the whole file is loaded into memory and parsed with
+        the columnar parser in `gkg_vectorized.py` rather than line-by-line
+        as it streams in. Both give the same rows.
+    writer: function which loads the rows (and ledger entries) into the
+        database, eg. `write_processed_to_db` (INSERT) or
+        `gdelt_raw_copy.write_processed_to_db_copy` (COPY), or a
+        `batch_writer.BatchWriter` to combine the rows of several files.
+    flush_rows, flush_bytes: the rows are passed to the writer as they are
+        parsed, every flush_rows rows or flush_bytes bytes (see
+        gkg_parser.iter_row_chunks), so only one chunk of a file's rows is
+        held at a time. The file's ledger entry is written after its last
+        chunk, so a file whose write fails part way is retried in full (the
+        writers skip rows that are already in gdelt_raw).
+    session: optional requests.Session, so that calls for several files
+        reuse one keep-alive connection.
+    
     Returns
     - True if processed and uploaded to DB successfully
     - False if Exception thrown
     """
-    codes = [
-        'c3.1', 'c3.2',
-        *sorted(['c4.' + str(i) for i in range(1, 29)]),
-        'c41.1', 'c41.2', 'c41.3', 
-        'c6.4', 'c6.5', 'c6.6', 
-        'c7.1', 'c7.2', 
-        'v10.1', 'v10.2', 'v11.1'
-    ]
-    codes_l = len(codes)
-    
-    filename = file_url.split('/')[-1][:-4]
+    gkg_file = as_entry(gkg_file)
+    filename = gkg_file.url.split('/')[-1][:-4]
     print(filename)
     filename_dt = re.search(r'(\d{14}).gkg.csv$', filename).group(1)
-    id_regex_str = filename_dt + r'-(T?\d+)'
-    
-    r = requests.get(file_url, stream=True)
-    processed = []
     
+    def write_rows(rows):
+        """Returns the number of rows written, or None if a write failed."""
+        num_rows = 0
+        for chunk in iter_row_chunks(rows, flush_rows, flush_bytes):
+            if not writer(chunk):
+                return None
+            num_rows += len(chunk)
+        return num_rows
+
     try:
-        with zipfile.ZipFile(io.BytesIO(r.content)) as zf:
-            with zf.open(filename, 'r') as infile:
-                for article_num, raw in enumerate(io.TextIOWrapper(infile, encoding='latin-1')):
-                    line = raw.split('\t')
-                    if len(line) < 10: continue
-    
-                    # Keep stories which reference any *country of interest*
-                    locs = line[9].split(';')
-                    inc_nz = False
-                    if locs == ['']: 
-                        continue  # no locations detected by gdelt
-                    
-                    relevant_codes = []
-                    for loc in locs:
-                        country_code = loc.split('#')[3]
-                        if country_code in countries_of_interest:
-                            relevant_codes.append(country_code)
-                    if len(relevant_codes) == 0: 
-                        continue  # no countries of interest mentioned
-    
-                    # Extract the relevant codes
-                    gcam = line[17].split(',')
-                    code_i = 0
-                    code_v = codes[code_i]
-                    code_l = len(code_v)
-                    out = []
-                    # skip gcam[0] as is word count, not gcam code
-                    for el in gcam[1:]:
-                        gcode, val = el.split(':')
-    
-                        while code_v < gcode:
-                            out.append(None)
-                            code_i += 1
-                            if (code_i == codes_l - 1): break
-                            code_v = codes[code_i]
-    
-                        if code_v == gcode:
-                            out.append(val)
-                            code_i += 1
-                            if (code_i == codes_l - 1): break
-                            code_v = codes[code_i]
-    
-                    if (len(codes) == len(out) + 1): 
-                        out.append(None)
-                    
-                    # Construct ID field. 'T' in ID suffix should be preserved, 
-                    # as it indicates if an article is translated.
-                    raw_id = line[0]
-                    raw_id_suffix = re.search(id_regex_str, raw_id).group(1)
-                    synthetic_gkg_id = (
-                        f"{filename_dt}-T{article_num}" 
-                        if raw_id_suffix.startswith('T')
-                        else f"{filename_dt}-{article_num}"
-                    )
-                    # Construct row for database table
-                    row = [
-                        synthetic_gkg_id,
-                        *itemgetter(1,2,3,4,7,9,11,13)(line),  # article info.
-                        relevant_codes,                        # country codes
-                        *line[15].split(','),                  # V1.5TONE
-                        *out                                   # V2GCAM codes
-                    ]
-                    # Reshaping fields into appropriate data types
-                    row[1] = datetime.strptime(row[1], '%Y%m%d%H%M%S')
-                    row[5] = [x for x in row[5].split(';') if x] if row[5] else []
-                    row[6] = [
-                        get_loc_item(loc) for loc in row[6].split(';')
-                    ] if row[6] else []
-                    row[7] = [x for x in row[7].split(';') if x] if row[7] else []
-                    row[8] = [x for x in row[8].split(';') if x] if row[8] else []
-                    # Convert 'row' from list to tuple for psycopg2 function
-                    processed.append(tuple(row))
-                
-                if len(processed) > 0:
-                    write_processed_to_db(processed)
-        
-        return True
+        start = perf_counter()
+        if vectorized:
+            data = download_gkg_zip(gkg_file.url, session=session,
+                                    size=gkg_file.size, md5=gkg_file.md5)
+            num_bytes = len(data)
+            num_rows = write_rows(
+                parse_gkg_zip(data, filename_dt, parser, vectorized)
+            )
+        else:
+            try:
+                with stream_gkg_zip(gkg_file.url, session=session) as chunks:
+                    num_rows = write_rows(parser.iter_db_rows(
+                        iter_zip_lines(chunks), filename_dt
+                    ))
+                    if num_rows is None:
+                        return False
+                    chunks.check(gkg_file.url, gkg_file.size, gkg_file.md5)
+            except Exception:
+                # The rows came from a bad download, so they aren't kept
+                delete_file_rows(filename_dt, writer)
+                raise
+            num_bytes = chunks.num_bytes
+        if num_rows is None:
+            return False
+        entry = make_entry(filename_dt, STATUS_DONE, num_rows,
+                           perf_counter() - start, num_bytes)
+        # Files with no relevant articles are still recorded in the ledger
+        return writer([], ledger_entries=[entry])
     except Exception as e:
         print(f"{filename} EXCEPTION: {e}; {type(e)}")
+        record_failures([make_entry(filename_dt, STATUS_FAILED)])
         return False
-    
+
+
+def process_lake(parser, start=None, end=None, lake_dir=LAKE_DIR,
+                 writer=write_processed_to_db):
+    """
+    Loads the GKG files in the local lake (see Gdelt/gkg_lake.py) from start
+    to end which the ledger doesn't record as done, instead of downloading
+    them. Only the fields and articles the parser needs are read from the
+    lake. Returns the number of files written.
+    """
+    done_dts = get_done_dts()
+    num_written = 0
+    for filename_dt, lines in iter_lake_lines(start, end, parser.countries,
+                                              PARSER_FIELDS, lake_dir):
+        if filename_dt in done_dts:
+            continue
+        file_start = perf_counter()
+        processed = parser.db_rows(lines, filename_dt)
+        entry = make_entry(filename_dt, STATUS_DONE, len(processed),
+                           perf_counter() - file_start)
+        if writer(processed, ledger_entries=[entry]):
+            num_written += 1
+            print(f"{filename_dt}: {len(processed)} rows")
+    return num_written
+
+
+def follow(parser, writer=write_processed_to_db,
+           last_update_url=LAST_UPDATE_URL, poll_seconds=POLL_SECONDS,
+           refresh=True, max_catch_up=MAX_CATCH_UP, max_files=None):
+    """
+    Runs until interrupted (or max_files have been ingested), ingesting each
+    GKG file as it is published: lastupdate.txt is polled every poll_seconds
+    (see gkg_master_list.LastUpdatePoller), and a new file is processed
+    straight away, followed by an incremental refresh of "daily_tone" for
+    the dates it changed, including the current day (see daily_tone.py).
+
+    Files published since the newest one done in the ledger are ingested
+    first, up to max_catch_up of them (eg. after a restart); an older gap is
+    left to a batch run. A file which fails is retried on the next poll,
+    unless a later file has been ingested by then (the batch run retries it).
+
+    The files are processed one at a time in this thread, with their rows
+    streamed to the writer in chunks, and only the newest timestamp is kept
+    between them, so memory stays flat and every query uses one pooled
+    connection.
+
+    Returns the number of files ingested.
+    """
+    session = requests.Session()
+    poller = LastUpdatePoller(last_update_url, session=session)
+    last_dt = get_last_done_dt()
+    print(f"Following {last_update_url} from {last_dt}")
+    num_ingested = 0
+    refresh_pending = False
+    while max_files is None or num_ingested < max_files:
+        poll_start = perf_counter()
+        try:
+            latest = poller.poll()
+        except requests.RequestException as e:
+            print(f"Exception polling {last_update_url}: {e}; {type(e)}")
+            latest = None
+        if latest is not None and get_entry_dt(latest.url) > (last_dt or ''):
+            entries = catch_up_entries(latest, last_dt, max_catch_up)
+            if last_dt and len(entries) == max_catch_up:
+                print(f"Catching up from {get_entry_dt(entries[0].url)}; any "
+                      f"files after {last_dt} and before it need a batch run")
+            for entry in entries:
+                file_start = perf_counter()
+                if process_gkg(entry, parser, writer=writer, session=session):
+                    last_dt = get_entry_dt(entry.url)
+                    num_ingested += 1
+                    refresh_pending = refresh
+                    print(f"{last_dt}: ingested in "
+                          f"{perf_counter() - file_start:.1f}s")
+        if refresh_pending:
+            # Retried on the next poll if it fails, as the stale dates are
+            # kept until a refresh commits
+            try:
+                refresh_start = perf_counter()
+                num_pending = refresh_daily_tone(include_last_date=True)
+                refresh_pending = False
+                print(f"daily_tone: computed {num_pending} (date, theme) "
+                      f"pairs in {perf_counter() - refresh_start:.1f}s; "
+                      f"{get_pool().connections_opened} connections opened")
+            except Exception as e:
+                print(f"Exception refreshing daily_tone: {e}; {type(e)}")
+        if max_files is not None and num_ingested >= max_files:
+            break
+        sleep(max(poll_seconds - (perf_counter() - poll_start), 0))
+    return num_ingested
+
 
 if __name__ == '__main__':
-    countries_of_interest = ['NZ', 'AS', 'CA', 'UK']
-    
-    # Construct namedtuple that will be cast into location_item for database
-    Loc_Item = namedtuple(
-        'location_item',
-        'type full_name country_code ADM1_code lat long feature_id'
-    )
-    class Loc_Item_Adapter:
-        def __init__(self, x):
-            self.adapted = psycopg2.extensions.SQL_IN(x)
-        def prepare(self, conn):
-            self.adapted.prepare(conn)
-        def getquoted(self):
-            return self.adapted.getquoted() + b'::location_item'
-    psycopg2.extensions.register_adapter(Loc_Item, Loc_Item_Adapter)
-    
-    gkg_files = get_gkg_files()
-    filt_gkg_files = filter_gkg_files(gkg_files)
-    print(f"Processing up to {len(filt_gkg_files)} files.")
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--lake', nargs='?', const=LAKE_DIR,
+                            help="load the files in the GKG lake instead of "
+                                 "downloading them (see Gdelt/gkg_lake.py)")
+    arg_parser.add_argument('--follow', action='store_true',
+                            help="keep running, and ingest each new file as "
+                                 "it's published (see `follow`)")
+    arg_parser.add_argument('--last-update-url', default=LAST_UPDATE_URL,
+                            help="lastupdate.txt to follow, eg. from "
+                                 "Gdelt/gkg_replay.py")
+    arg_parser.add_argument('--poll-seconds', type=float,
+                            default=POLL_SECONDS)
+    args = arg_parser.parse_args()
+
+    parser = GkgParser(['NZ', 'AS', 'CA', 'UK'], full_gcam=True)
+    writer = partial(write_processed_to_db_copy, copy_format='text')
     
     start = datetime.now()
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        executor.map(process_gkg, filt_gkg_files, repeat(countries_of_interest))
+    if args.follow:
+        # One file at a time, so a single connection is kept warm
+        try:
+            follow(parser, writer=writer,
+                   last_update_url=args.last_update_url,
+                   poll_seconds=args.poll_seconds)
+        except KeyboardInterrupt:
+            pass
+    elif args.lake:
+        num_written = process_lake(parser, lake_dir=args.lake, writer=writer)
+        print(f"Wrote {num_written} files from {args.lake}")
+    else:
+        gkg_files = get_gkg_files()
+        filt_gkg_files = filter_gkg_files(gkg_files)
+        print(f"Processing up to {len(filt_gkg_files)} files.")
+
+        # Files are downloaded over a pool of keep-alive connections, parsed
+        # in a process pool and written in batches - see gkg_pipeline.py.
+        # (`process_gkg` does all of these steps for a single file.) The
+        # biggest files in each day are started first. The number of
+        # downloads at once adapts to the throughput and throttling.
+        fetch_controller = AimdController(NUM_FETCHERS, max_limit=MAX_FETCHERS,
+                                          name="GKG downloads")
+        stats = run_pipeline(schedule_by_size(filt_gkg_files), parser,
+                             writer=writer, async_fetch=True,
+                             fetch_controller=fetch_controller)
+        print(f"Wrote {stats['rows_written']} rows from "
+              f"{stats['files_written']} files; "
+              f"{len(stats['failed'])} failed.")
     print("Time taken:", datetime.now() - start)
@@ -0,0 +1,235 @@
+"""
+Columnar alternative to the line-by-line parser (`GkgParser.db_rows` in
+Gdelt/gkg_parser.py).
+
+The whole 15-minute GKG file is loaded into columnar arrays with pyarrow's
+multi-threaded CSV reader, and the country filter, V1.5TONE split and V2GCAM
+extraction are done with pyarrow's (C++) string kernels. Only the articles
+which reference a country of interest are turned into Python objects for the
+database.
+
+Running this script compares the throughput of the two parsers on local GKG
+zip files, and checks that they give the same rows:
+    python gkg_vectorized.py ../data/20210901000000.gkg.csv.zip
+"""
+import re
+import argparse
+from time import perf_counter
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv
+
+from Gdelt.gcam_sparse import parse_gcam
+from Gdelt.gdelt_utils import GCAM_CODES, get_loc_item
+from Gdelt.gkg_fetch import CHUNK_SIZE, iter_zip_lines, open_zip_member
+from Gdelt.gkg_parser import COUNTRY_FIELD, GkgParser
+
+GKG_NUM_FIELDS = 27
+GKG_COLUMNS = {
+    0: 'gkg_id', 1: 'date', 2: 'source', 3: 'source_name', 4: 'doc_id',
+    7: 'v1themes', 9: 'v1locations', 11: 'v1persons', 13: 'v1org',
+    15: 'tone', 17: 'gcam',
+}
+READ_OPTIONS = csv.ReadOptions(
+    column_names=[GKG_COLUMNS.get(i, f'f{i}') for i in range(GKG_NUM_FIELDS)],
+    encoding='latin1',
+)
+PARSE_OPTIONS = csv.ParseOptions(
+    delimiter='\t', quote_char=False, ignore_empty_lines=False,
+)
+CONVERT_OPTIONS = csv.ConvertOptions(
+    include_columns=list(GKG_COLUMNS.values()),
+    column_types={c: pa.string() for c in GKG_COLUMNS.values()},
+    strings_can_be_null=False,
+)
+
+
+def read_gkg_table(data):
+    """
+    Reads the bytes of a GKG CSV into a pyarrow Table of strings, with one row
+    per line of the file so the row number is the article number. Returns None
+    if any line doesn't have the full 27 fields.
+    """
+    try:
+        return csv.read_csv(pa.BufferReader(data), read_options=READ_OPTIONS,
+                            parse_options=PARSE_OPTIONS,
+                            convert_options=CONVERT_OPTIONS)
+    except pa.ArrowInvalid:
+        return None
+
+
+def split_flat(col, sep):
+    """
+    Splits a string column on sep. Returns the flattened parts and, for each
+    part, the (row) index of the string it came from.
+    """
+    parts = pc.split_pattern(col, sep)
+    return pc.list_flatten(parts), pc.list_parent_indices(parts)
+
+
+def get_relevant_codes(locations, countries_of_interest):
+    """
+    Returns the indices of the rows which reference any country of interest,
+    and the list of country codes (4th '#'-delimited field of each V1LOCATIONS
+    block) for each of those rows, in order and with repeats.
+    """
+    # Cheap pre-filter: any relevant block must contain "#<code>#" somewhere
+    candidates = pc.indices_nonzero(pc.match_substring_regex(
+        locations, '#(?:' + '|'.join(map(re.escape, countries_of_interest)) + ')#'
+    ))
+    locs, parents = split_flat(locations.take(candidates), ';')
+    country_code = pc.struct_field(pc.extract_regex(
+        locs, rf'^(?:[^#]*#){{{COUNTRY_FIELD}}}(?P<country_code>[^#]*)'
+    ), 0)
+    is_relevant = pc.fill_null(
+        pc.is_in(country_code, value_set=pa.array(countries_of_interest)), False
+    )
+    relevant_parents = pc.filter(parents, is_relevant).to_numpy()
+    relevant_codes = pc.filter(country_code, is_relevant).to_pylist()
+
+    parent_rows, starts = np.unique(relevant_parents, return_index=True)
+    codes_per_row = [
+        relevant_codes[start:end]
+        for start, end in zip(starts, [*starts[1:], len(relevant_codes)])
+    ]
+    return candidates.to_numpy()[parent_rows], codes_per_row
+
+
+def extract_gcam(gcam, codes=GCAM_CODES):
+    """
+    Returns a 2D object array with a column per GCAM code, holding the string
+    value of that code for each article or None if the code is absent.
+    """
+    entries, parents = split_flat(gcam, ',')
+    key_value = pc.extract_regex(entries, r'^(?P<key>[^:]*):(?P<value>.*)$')
+    code_idx = pc.index_in(pc.struct_field(key_value, 0),
+                           value_set=pa.array(codes))
+    is_code = pc.is_valid(code_idx)
+
+    out = np.full((len(gcam), len(codes)), None, dtype=object)
+    out[pc.filter(parents, is_code).to_numpy(),
+        pc.filter(code_idx, is_code).to_numpy()] = \
+        pc.filter(pc.struct_field(key_value, 1), is_code).to_numpy(
+            zero_copy_only=False
+        )
+    return out
+
+
+def split_list_column(col):
+    """Splits a ';'-delimited column into lists, dropping empty strings."""
+    return [[x for x in s.split(';') if x] if s else [] for s in col.to_pylist()]
+
+
+def parse_gkg_file(data, filename_dt, parser):
+    """
+    Columnar parser for the bytes of the GKG file published at filename_dt,
+    using the countries and GCAM codes of the given GkgParser. Returns the
+    same list of row tuples for the "gdelt_raw" table as `parser.db_rows`, or
+    None if the file isn't a regular 27-column table (in which case the
+    line-by-line parser should be used).
+    """
+    gkg = read_gkg_table(data)
+    if gkg is None:
+        return None
+
+    # Keep stories which reference any *country of interest*
+    rows, relevant_codes = get_relevant_codes(gkg['v1locations'],
+                                              sorted(parser.countries))
+    if len(rows) == 0:
+        return []
+    gkg = gkg.take(rows)
+
+    # Construct ID field. 'T' in ID suffix should be preserved, as it
+    # indicates if an article is translated.
+    is_translated = pc.match_substring(gkg['gkg_id'], f'{filename_dt}-T')
+    gkg_ids = [
+        f"{filename_dt}-T{article_num}" if translated
+        else f"{filename_dt}-{article_num}"
+        for article_num, translated in zip(rows, is_translated.to_pylist())
+    ]
+    dts = pc.strptime(gkg['date'], format='%Y%m%d%H%M%S', unit='s')
+    tone = pc.split_pattern(gkg['tone'], ',').to_pylist()
+    gcam = extract_gcam(gkg['gcam'], parser.gcam_codes)
+
+    processed = [
+        (gkg_id, dt, source, source_name, doc_id, themes,
+         [get_loc_item(loc) for loc in locs.split(';')],
+         persons, orgs, codes, *parser.tone_numbers(tone_i),
+         *parser.gcam_numbers(gcam_i))
+        for (gkg_id, dt, source, source_name, doc_id, themes, locs, persons,
+             orgs, codes, tone_i, gcam_i) in zip(
+            gkg_ids, dts.to_pylist(),
+            pc.cast(gkg['source'], pa.int64()).to_pylist(),
+            gkg['source_name'].to_pylist(),
+            gkg['doc_id'].to_pylist(),
+            split_list_column(gkg['v1themes']),
+            gkg['v1locations'].to_pylist(),
+            split_list_column(gkg['v1persons']),
+            split_list_column(gkg['v1org']),
+            relevant_codes, tone, gcam
+        )
+    ]
+    if parser.full_gcam:
+        processed = [
+            (*row, parse_gcam(gcam_str))
+            for row, gcam_str in zip(processed, gkg['gcam'].to_pylist())
+        ]
+    return processed
+
+
+def read_zip_chunks(fpath):
+    """
+    Reads a zip file into memory and returns a function which yields its
+    chunks, like a streamed download would.
+    """
+    with open(fpath, 'rb') as f:
+        archive = f.read()
+    return lambda: (archive[i:i + CHUNK_SIZE]
+                    for i in range(0, len(archive), CHUNK_SIZE))
+
+
+def compare_parsers(fpaths, countries_of_interest, repeats=3):
+    """
+    Prints the throughput (MB of uncompressed CSV per second) of the
+    line-by-line and columnar parsers for the given local GKG zip files, and
+    whether the two parsers give the same rows. The zip files are read into
+    memory first so only decompression and parsing are timed.
+    """
+    parser = GkgParser(countries_of_interest)
+    for fpath in fpaths:
+        filename_dt = re.search(r'(\d{14}).gkg.csv.zip$', fpath).group(1)
+        chunks = read_zip_chunks(fpath)
+        with open_zip_member(chunks()) as infile:
+            mb = len(infile.read()) / 1e6
+
+        parsers = {
+            'line-by-line': lambda: parser.db_rows(
+                iter_zip_lines(chunks()), filename_dt
+            ),
+            'columnar': lambda: parse_gkg_file(
+                open_zip_member(chunks()).read(), filename_dt, parser
+            ),
+        }
+        timings, rows = {}, {}
+        for name, parse in parsers.items():
+            timings[name] = float('inf')
+            for _ in range(repeats):
+                start = perf_counter()
+                rows[name] = parse()
+                timings[name] = min(timings[name], perf_counter() - start)
+
+        print(f"{fpath}: {mb:.1f} MB, {len(rows['columnar'])} rows, "
+              f"same rows: {rows['line-by-line'] == rows['columnar']}")
+        for name, seconds in timings.items():
+            print(f"  {name: <12}: {mb / seconds:6.1f} MB/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fpaths', nargs='+', help="local GKG .csv.zip files")
+    parser.add_argument('--countries', nargs='+',
+                        default=['NZ', 'AS', 'CA', 'UK'])
+    args = parser.parse_args()
+    compare_parsers(args.fpaths, args.countries)
@@ -0,0 +1,96 @@
+"""
+The "gkg_ingest_ledger" table (see create_gdelt_raw.sql) records each GKG file
+that has been ingested, with its status, row count, duration and size.
+
+Ledger entries are written in the same transaction as the file's rows (see the
+`ledger_entries` argument of the writers in gkg_raw_to_db.py and
+gdelt_raw_copy.py), so a file is only marked 'done' if its rows are committed.
+Checking which files are already done reads the ledger (one row per file)
+rather than scanning "gdelt_raw".
+"""
+from collections import namedtuple
+from datetime import datetime
+
+from psycopg2 import extras
+
+from Gdelt.process_v2.db_pool import get_conn
+
+LEDGER_TABLE = "gkg_ingest_ledger"
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+LedgerEntry = namedtuple(
+    'LedgerEntry', 'file_dt status num_rows duration num_bytes'
+)
+
+
+def make_entry(filename_dt, status, num_rows=None, duration=None,
+               num_bytes=None):
+    """filename_dt: the 'YYYYMMDDHHMMSS' timestamp in the GKG file name."""
+    return LedgerEntry(datetime.strptime(filename_dt, '%Y%m%d%H%M%S'), status,
+                       num_rows, duration, num_bytes)
+
+
+def record_entries(cur, entries):
+    """
+    Upserts ledger entries using the given cursor, ie. as part of the caller's
+    transaction. A 'done' entry is only replaced by another 'done' entry, so
+    a later failure for the same file (eg. from an overlapping run) doesn't
+    re-queue a file whose rows are complete.
+    """
+    if not entries:
+        return
+    # A file can only be upserted once per statement
+    entries = list({entry.file_dt: entry for entry in entries}.values())
+    extras.execute_values(cur, f"""
+        INSERT INTO {LEDGER_TABLE}
+            (file_dt, status, num_rows, duration, num_bytes)
+        VALUES %s
+        ON CONFLICT (file_dt) DO UPDATE SET
+            status = EXCLUDED.status,
+            num_rows = EXCLUDED.num_rows,
+            duration = EXCLUDED.duration,
+            num_bytes = EXCLUDED.num_bytes,
+            processed_at = now()
+        WHERE {LEDGER_TABLE}.status <> '{STATUS_DONE}' OR
+              EXCLUDED.status = '{STATUS_DONE}'
+    """, entries)
+
+
+def record_failures(entries):
+    """Records failed files in their own transaction."""
+    try:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                record_entries(cur, entries)
+    except Exception as e:
+        print(f"Exception recording failures in ledger: {e}")
+        print(f"Exception type: {type(e)}")
+
+
+def get_done_dts():
+    """
+    Returns the set of 'YYYYMMDDHHMMSS' file timestamps which have been
+    ingested successfully.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT to_char(file_dt, 'YYYYMMDDHH24MISS')
+                FROM {LEDGER_TABLE} WHERE status = %s
+            """, (STATUS_DONE,))
+            return {dt_str for dt_str, in cur}
+
+
+def get_last_done_dt():
+    """
+    Returns the newest 'YYYYMMDDHHMMSS' file timestamp which has been
+    ingested successfully, or None if there are none.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT to_char(Max(file_dt), 'YYYYMMDDHH24MISS')
+                FROM {LEDGER_TABLE} WHERE status = %s
+            """, (STATUS_DONE,))
+            return cur.fetchone()[0]
@@ -0,0 +1,194 @@
+"""
+Migrates an existing (version 1) "gdelt_raw" table to the version 2 schema,
+which is partitioned by month (see create_gdelt_raw_v2.sql).
+
+The old table is renamed to "gdelt_raw_v1" and its rows are copied into the
+new table one month at a time (converting the themes, persons and orgs to
+dictionary ids), each in its own transaction, so the migration can be
+stopped and run again (months already copied are skipped by the ON CONFLICT
+clause). The old table is only dropped if --drop-old is given and
+the row counts match.
+
+Stop the ingest (gkg_raw_to_db.py) while this is running.
+
+Usage:
+    python -m Gdelt.process_v2.migrate_gdelt_raw_v2 [--drop-old]
+"""
+import os
+import argparse
+from time import perf_counter
+
+from Gdelt.process_v2.db_pool import get_conn
+from Gdelt.process_v2.gcam_arrays import create_gcam_value
+from Gdelt.process_v2.gdelt_raw_partitions import add_partition
+from Gdelt.process_v2.gkg_dictionary import is_dictionary_encoded
+
+DB_TABLE = "gdelt_raw"
+OLD_TABLE = "gdelt_raw_v1"
+SCHEMA_FPATH = os.path.join(os.path.dirname(__file__),
+                            'create_gdelt_raw_v2.sql')
+# Dictionary-encoded columns: (dictionary table, function converting names)
+DICTIONARY_COLUMNS = {
+    'themes': ('gkg_themes', 'gkg_theme_ids'),
+    'persons': ('gkg_persons', 'gkg_person_ids'),
+    'orgs': ('gkg_orgs', 'gkg_org_ids'),
+}
+
+
+def get_relkind(cur, table):
+    """'r' for a plain table, 'p' for a partitioned table, None if missing."""
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)",
+                (table,))
+    result = cur.fetchone()
+    return result[0] if result else None
+
+
+def rename_indexes(cur):
+    """
+    Renames the indexes of the old table (including its primary key) from
+    gdelt_raw_* to gdelt_raw_v1_*, as the version 2 schema creates indexes
+    with the same names (eg. gdelt_raw_pkey, gdelt_raw_syndication_fp).
+    """
+    cur.execute("""
+        SELECT indexname FROM pg_indexes
+        WHERE schemaname = current_schema() AND tablename = %s
+    """, (OLD_TABLE,))
+    for index, in cur.fetchall():
+        if index.startswith(f'{OLD_TABLE}_'):
+            continue
+        suffix = (index[len(DB_TABLE) + 1:]
+                  if index.startswith(f'{DB_TABLE}_') else index)
+        # Renaming a primary key's index renames the constraint too
+        cur.execute(f'ALTER INDEX "{index}" RENAME TO "{OLD_TABLE}_{suffix}"')
+
+
+def create_v2_table():
+    """Renames the version 1 table and creates the version 2 table."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            relkind = get_relkind(cur, DB_TABLE)
+            if relkind == 'p':
+                return  # already done
+            if relkind == 'r':
+                if get_relkind(cur, OLD_TABLE) is not None:
+                    raise RuntimeError(f"Both {DB_TABLE} and {OLD_TABLE} "
+                                       "exist, so not migrating")
+                cur.execute(f"ALTER TABLE {DB_TABLE} RENAME TO {OLD_TABLE}")
+                rename_indexes(cur)
+            with open(SCHEMA_FPATH) as f:
+                cur.execute(f.read())
+            create_gcam_value(cur)
+
+
+def get_months(cur):
+    cur.execute(f"""
+        SELECT DISTINCT Date(date_trunc('month', datetime)) AS month
+        FROM {OLD_TABLE}
+        ORDER BY month
+    """)
+    return [month for month, in cur]
+
+
+def get_columns(cur, table):
+    cur.execute("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum
+    """, (table,))
+    return [column for column, in cur]
+
+
+def get_column_lists(cur):
+    """
+    The columns to copy, by name (the ones in both tables), as the list to
+    insert into the new table and the list to select from the old table,
+    converting the themes, persons and orgs to dictionary ids if needed.
+    The columns added to version 1 tables by ALTER TABLE (see syndication.py,
+    source_countries.py and gcam_arrays.py) can be in any order, so they
+    aren't matched by position.
+    """
+    new_columns = set(get_columns(cur, DB_TABLE))
+    columns = [column for column in get_columns(cur, OLD_TABLE)
+               if column in new_columns]
+    if not is_dictionary_encoded(cur):
+        return ', '.join(columns), ', '.join(columns)
+    return ', '.join(columns), ', '.join(
+        f"{DICTIONARY_COLUMNS[column][1]}({column})"
+        if column in DICTIONARY_COLUMNS else column
+        for column in columns
+    )
+
+
+def copy_month(month, insert_list, select_list):
+    """Copies the rows for one month, returning the number of rows added."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            add_partition(cur, month)
+            params = {'month': month}
+            month_filter = """
+                datetime >= %(month)s AND
+                datetime < %(month)s + INTERVAL '1 month'
+            """
+            if is_dictionary_encoded(cur):
+                for column, (table, _) in DICTIONARY_COLUMNS.items():
+                    cur.execute(f"""
+                        INSERT INTO {table} (name)
+                        SELECT DISTINCT Unnest({column}) AS name
+                        FROM {OLD_TABLE}
+                        WHERE {month_filter}
+                        ORDER BY name
+                        ON CONFLICT DO NOTHING
+                    """, params)
+            # Sorted so the BRIN index on "datetime" stays selective
+            cur.execute(f"""
+                INSERT INTO {DB_TABLE} ({insert_list})
+                SELECT {select_list} FROM {OLD_TABLE}
+                WHERE {month_filter}
+                ORDER BY datetime
+                ON CONFLICT DO NOTHING
+            """, params)
+            return cur.rowcount
+
+
+def count_rows(cur, table):
+    cur.execute(f"SELECT count(*) FROM {table}")
+    return cur.fetchone()[0]
+
+
+def migrate(drop_old=False):
+    create_v2_table()
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if get_relkind(cur, OLD_TABLE) is None:
+                print(f"No {OLD_TABLE} table, so nothing to migrate")
+                return
+            months = get_months(cur)
+            insert_list, select_list = get_column_lists(cur)
+
+    for month in months:
+        start = perf_counter()
+        num_rows = copy_month(month, insert_list, select_list)
+        print(f"{month:%Y-%m}: {num_rows} rows in "
+              f"{perf_counter() - start:.1f}s")
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            old_count = count_rows(cur, OLD_TABLE)
+            new_count = count_rows(cur, DB_TABLE)
+            print(f"{OLD_TABLE}: {old_count} rows, {DB_TABLE}: {new_count} rows")
+            cur.execute(f"ANALYZE {DB_TABLE}")
+            if not drop_old:
+                return
+            if old_count != new_count:
+                print(f"Row counts differ, so not dropping {OLD_TABLE}")
+                return
+            cur.execute(f"DROP TABLE {OLD_TABLE}")
+            print(f"Dropped {OLD_TABLE}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--drop-old', action='store_true',
+                        help=f"drop {OLD_TABLE} once migrated")
+    args = parser.parse_args()
+    migrate(args.drop_old)
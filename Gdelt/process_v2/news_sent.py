@@ -2,18 +2,11 @@
 Functions related to "News Sentiment" (Social - Life Satisfaction) on the 
 COVID-19 Data Portal. 
 """
+import argparse
 from datetime import timedelta
 
 import numpy as np
 import pandas as pd
-import psycopg2
-
-import postgres_config
-
-CONNECTION_DETAILS = (
-    f"host={postgres_config.HOST} dbname=gdelt user=postgres "
-    f"password={postgres_config.PASSWORD}"
-)
 
 
 def export_monthly_news_sent(daily_wide):
@@ -52,23 +45,29 @@ def export_rolling_avg_news_sent(daily_wide):
     daily_wide_rolling.to_csv("../data/rolling_7day_avg_news_sentiment.csv")
 
 
-def get_daily_wide():
+def get_daily_wide(parquet_fpath=None):
     """
     Extracts overall sentiment data from daily_tone table and pivots from long
-    to wide format.
-    """
-    select_query = """
-    SELECT date, country, from_onshore, avg_tone, num_articles
-    FROM daily_tone
-    WHERE theme = 'ALL'
-    ORDER BY date, country, from_onshore
+    to wide format. If parquet_fpath is given, daily_tone is read from that
+    file (see daily_tone_duckdb.py) rather than the database.
     """
     col_names = ['date', 'country', 'from_onshore', 'avg_tone', 'num_articles']
-    with psycopg2.connect(CONNECTION_DETAILS) as conn:
-        with conn.cursor() as cur:
-            cur.execute(select_query)
-            raw = cur.fetchall()
-    daily = pd.DataFrame(raw, columns=col_names)
+    if parquet_fpath:
+        from Gdelt.process_v2.daily_tone_duckdb import read_daily_tone
+        daily = read_daily_tone(parquet_fpath, theme='ALL')[col_names]
+    else:
+        from Gdelt.process_v2.db_pool import get_conn
+        select_query = """
+        SELECT date, country, from_onshore, avg_tone, num_articles
+        FROM daily_tone
+        WHERE theme = 'ALL'
+        ORDER BY date, country, from_onshore
+        """
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(select_query)
+                raw = cur.fetchall()
+        daily = pd.DataFrame(raw, columns=col_names)
     daily['date'] = pd.to_datetime(daily['date'], format='%Y-%m-%d')
     daily['avg_tone'] = daily['avg_tone'].astype('float')
     
@@ -86,14 +85,18 @@ def get_daily_wide():
     return daily_wide
 
 
-def export_news_sent():
+def export_news_sent(parquet_fpath=None):
     """
     Exports both News Sentiment data files.
     """
-    daily_wide = get_daily_wide()
+    daily_wide = get_daily_wide(parquet_fpath)
     export_monthly_news_sent(daily_wide)
     export_rolling_avg_news_sent(daily_wide)
     
 
 if __name__ == "__main__":
-    export_news_sent()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parquet',
+                        help="read daily_tone from this Parquet file")
+    args = parser.parse_args()
+    export_news_sent(args.parquet)
@@ -0,0 +1,121 @@
+"""
+The "source_country" column of "gdelt_raw": the FIPS code of the country of
+the domain each article was published on (see Gdelt/source_country.py), or
+NULL if the domain doesn't have a country-code TLD.
+
+The writers add it to each row with `add_source_countries`, so
+get_daily_averages.sql decides whether an article is "from_onshore" with
+`source_country = country` rather than a substring match on "source_name".
+
+The writers append it after "syndication_fp" and "is_syndicated" (see
+syndication.py), and name the columns they load (see gdelt_raw_columns.py),
+so it can be anywhere in the table. To add the columns to an existing table
+and fill them in (one month per transaction), run:
+    python -m Gdelt.process_v2.source_countries
+"""
+from time import perf_counter
+
+from psycopg2 import extras
+
+from Gdelt.source_country import source_country
+from Gdelt.process_v2.db_pool import get_conn
+from Gdelt.process_v2.gdelt_raw_columns import (
+    SOURCE_COUNTRY_COLUMNS, has_columns
+)
+from Gdelt.process_v2 import syndication
+
+DB_TABLE = "gdelt_raw"
+SOURCE_NAME_COLUMN = 3  # index of "source_name" in a gdelt_raw row
+
+
+def has_source_country(cur):
+    """True if gdelt_raw has the "source_country" column."""
+    return has_columns(cur, SOURCE_COUNTRY_COLUMNS, DB_TABLE)
+
+
+def add_source_countries(cur, processed):
+    """
+    Returns the gdelt_raw rows with their source_country appended, or the
+    rows unchanged if gdelt_raw doesn't have the column.
+    """
+    if not processed or not has_source_country(cur):
+        return processed
+    return [(*row, source_country(row[SOURCE_NAME_COLUMN]))
+            for row in processed]
+
+
+def get_months(cur):
+    cur.execute("""
+        SELECT DISTINCT Date(date_trunc('month', file_dt)) AS month
+        FROM gkg_ingest_ledger
+        WHERE status = 'done'
+        ORDER BY month
+    """)
+    return [month for month, in cur]
+
+
+def backfill_month(month):
+    """
+    Fills in source_country for one month of gdelt_raw, returning the number
+    of rows updated.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            params = {'month': month}
+            month_filter = """
+                datetime >= %(month)s AND
+                datetime < %(month)s + INTERVAL '1 month'
+            """
+            cur.execute(f"""
+                SELECT DISTINCT source_name FROM {DB_TABLE}
+                WHERE {month_filter} AND source_country IS NULL
+            """, params)
+            countries = [(name, source_country(name)) for name, in cur]
+            countries = [(name, c) for name, c in countries if c is not None]
+            if not countries:
+                return 0
+            cur.execute("""
+                CREATE TEMP TABLE source_name_countries (
+                    source_name TEXT PRIMARY KEY, country VARCHAR(2)
+                ) ON COMMIT DROP
+            """)
+            extras.execute_values(
+                cur, "INSERT INTO source_name_countries VALUES %s", countries,
+                page_size=10000
+            )
+            cur.execute(f"""
+                UPDATE {DB_TABLE}
+                SET    source_country = s.country
+                FROM   source_name_countries s
+                WHERE  {DB_TABLE}.source_name = s.source_name AND
+                       {DB_TABLE}.source_country IS NULL AND
+                       {month_filter}
+            """, params)
+            return cur.rowcount
+
+
+def backfill():
+    """
+    Adds the source_country column to gdelt_raw if needed (after the
+    syndication columns), and fills it in for the rows written without it.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            syndication.add_columns(cur)
+            cur.execute(f"""
+                ALTER TABLE {DB_TABLE}
+                ADD COLUMN IF NOT EXISTS source_country VARCHAR(2)
+            """)
+            months = get_months(cur)
+
+    for month in months:
+        start = perf_counter()
+        num_rows = backfill_month(month)
+        print(f"{month:%Y-%m}: {num_rows} rows in "
+              f"{perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    start = perf_counter()
+    backfill()
+    print(f"Time taken: {perf_counter() - start:.1f}s")
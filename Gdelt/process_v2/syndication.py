@@ -0,0 +1,244 @@
+"""
+Syndication fingerprints for "gdelt_raw" rows.
+
+A syndicated (republished) article has the same publish date, positive
+score, negative score and word count as the original, which is how
+get_daily_averages.sql has always recognised copies. The writers now hash
+those four values into "syndication_fp" (BIGINT, indexed) at ingest, so the
+aggregation groups on the one column, and set "is_syndicated" for every row
+whose fingerprint was already in gdelt_raw (or earlier in the batch), eg. for
+`WHERE NOT is_syndicated` when only one copy of each article is wanted.
+
+The fingerprints already written are kept in memory as an exact set per day,
+for the most recent MAX_DAYS days that were written to (a day is loaded from
+gdelt_raw the first time it is seen, using the BRIN index on datetime, which
+`add_columns` creates for version 1 tables). An exact set is small
+enough: a day of relevant articles is ~100k fingerprints, so there is no need
+for a Bloom filter and its false positives. If a write fails, the sets are
+cleared, since they may hold fingerprints that were rolled back.
+
+With `skip=True` the copies are dropped rather than flagged. NB: a copy can
+differ from the original in its countries and source_name, so this also drops
+it from the countries/from_onshore it would have been counted towards.
+
+The pos and neg scores are hashed as float32, the way they are stored, so a
+fingerprint computed from a row read back from the database is the same as
+the one computed at ingest. To add the columns to an existing table and
+fill them in (one day per transaction), run:
+    python -m Gdelt.process_v2.syndication
+"""
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from time import perf_counter
+
+from psycopg2 import extras
+
+from Gdelt.process_v2.db_pool import get_conn
+from Gdelt.process_v2.gdelt_raw_columns import SYNDICATION_COLUMNS, has_columns
+
+DB_TABLE = "gdelt_raw"
+# Index of each column in a gdelt_raw row
+DATETIME_COLUMN, POS_COLUMN, NEG_COLUMN, WC_COLUMN = 1, 11, 12, 16
+MAX_DAYS = 7  # days of fingerprints kept in memory
+
+
+def has_fingerprint(cur):
+    """True if gdelt_raw has the "syndication_fp" column."""
+    return has_columns(cur, SYNDICATION_COLUMNS, DB_TABLE)
+
+
+def fingerprint(date, pos, neg, wc):
+    """Signed 64-bit hash of an article's date, pos, neg and wc."""
+    data = struct.pack(
+        '>iffi', date.toordinal(),
+        float('nan') if pos is None else pos,
+        float('nan') if neg is None else neg,
+        -1 if wc is None else wc,
+    )
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          'big', signed=True)
+
+
+def row_fingerprint(row):
+    return fingerprint(row[DATETIME_COLUMN].date(), row[POS_COLUMN],
+                       row[NEG_COLUMN], row[WC_COLUMN])
+
+
+class SeenFingerprints:
+    """Rolling per-day sets of the fingerprints already in gdelt_raw."""
+    def __init__(self, max_days=MAX_DAYS):
+        self.max_days = max_days
+        self._days = OrderedDict()  # date -> set, least recently used first
+        self._lock = threading.Lock()
+
+    def _get_day(self, cur, date):
+        if date in self._days:
+            self._days.move_to_end(date)
+            return self._days[date]
+        cur.execute(f"""
+            SELECT syndication_fp FROM {DB_TABLE}
+            WHERE datetime >= %s AND datetime < %s AND
+                  syndication_fp IS NOT NULL
+        """, (date, date + timedelta(days=1)))
+        seen = self._days[date] = {fp for fp, in cur}
+        while len(self._days) > self.max_days:
+            self._days.popitem(last=False)
+        return seen
+
+    def check_and_add(self, cur, date_fps):
+        """
+        Takes a list of (date, fingerprint), and returns a list of whether
+        each was already seen, then adds them to the seen sets.
+        """
+        with self._lock:
+            flags = []
+            for date, fp in date_fps:
+                seen = self._get_day(cur, date)
+                flags.append(fp in seen)
+                seen.add(fp)
+            return flags
+
+    def clear(self):
+        with self._lock:
+            self._days.clear()
+
+
+_seen = SeenFingerprints()
+
+
+def mark_syndicated(cur, processed, skip=False):
+    """
+    Returns the gdelt_raw rows with their syndication_fp and is_syndicated
+    appended, or without the syndicated copies if skip. The rows are
+    unchanged if gdelt_raw doesn't have the columns.
+    """
+    if not processed or not has_fingerprint(cur):
+        return processed
+    fps = [row_fingerprint(row) for row in processed]
+    flags = _seen.check_and_add(cur, [
+        (row[DATETIME_COLUMN].date(), fp) for row, fp in zip(processed, fps)
+    ])
+    if skip:
+        return [(*row, fp, False)
+                for row, fp, flag in zip(processed, fps, flags) if not flag]
+    return [(*row, fp, flag) for row, fp, flag in zip(processed, fps, flags)]
+
+
+def forget_seen():
+    """Called by the writers when a transaction is rolled back."""
+    _seen.clear()
+
+
+def add_columns(cur):
+    cur.execute(f"""
+        ALTER TABLE {DB_TABLE}
+        ADD COLUMN IF NOT EXISTS syndication_fp BIGINT,
+        ADD COLUMN IF NOT EXISTS is_syndicated  BOOLEAN
+    """)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS {DB_TABLE}_syndication_fp
+        ON {DB_TABLE} (syndication_fp)
+    """)
+    # Version 2 tables already have it (create_gdelt_raw_v2.sql)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS {DB_TABLE}_datetime_brin
+        ON {DB_TABLE} USING BRIN (datetime)
+    """)
+
+
+def to_float(value):
+    """REAL columns are read as float, NUMERIC (version 1) as Decimal."""
+    return None if value is None else float(value)
+
+
+def get_dates(cur):
+    cur.execute("""
+        SELECT DISTINCT Date(file_dt) AS date
+        FROM gkg_ingest_ledger
+        WHERE status = 'done'
+        ORDER BY date
+    """)
+    return [date for date, in cur]
+
+
+def backfill_date(date):
+    """
+    Fills in the fingerprints of the rows for one date which don't have one,
+    then sets is_syndicated for all of the date's rows (the earliest row with
+    each fingerprint is the original). Returns the number of rows filled in.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            params = {'start': date, 'end': date + timedelta(days=1)}
+            cur.execute(f"""
+                SELECT gkg_id, datetime, pos, neg, wc FROM {DB_TABLE}
+                WHERE datetime >= %(start)s AND datetime < %(end)s AND
+                      syndication_fp IS NULL
+            """, params)
+            fps = [
+                (gkg_id, dt, fingerprint(dt.date(), to_float(pos),
+                                         to_float(neg), wc))
+                for gkg_id, dt, pos, neg, wc in cur
+            ]
+            if not fps:
+                return 0
+            cur.execute("""
+                CREATE TEMP TABLE syndication_fps (
+                    gkg_id VARCHAR(25), datetime TIMESTAMP, fp BIGINT
+                ) ON COMMIT DROP
+            """)
+            extras.execute_values(cur, "INSERT INTO syndication_fps VALUES %s",
+                                  fps, page_size=10000)
+            cur.execute(f"""
+                UPDATE {DB_TABLE}
+                SET    syndication_fp = fp
+                FROM   syndication_fps f
+                WHERE  {DB_TABLE}.gkg_id = f.gkg_id AND
+                       {DB_TABLE}.datetime = f.datetime
+            """)
+            cur.execute(f"""
+                UPDATE {DB_TABLE}
+                SET    is_syndicated = r.copy_num > 1
+                FROM   (
+                          SELECT gkg_id, datetime,
+                                 Row_number() OVER (
+                                     PARTITION BY syndication_fp
+                                     ORDER BY datetime, gkg_id
+                                 ) AS copy_num
+                          FROM {DB_TABLE}
+                          WHERE datetime >= %(start)s AND datetime < %(end)s
+                       ) r
+                WHERE  {DB_TABLE}.gkg_id = r.gkg_id AND
+                       {DB_TABLE}.datetime = r.datetime AND
+                       {DB_TABLE}.is_syndicated IS DISTINCT FROM r.copy_num > 1
+            """, params)
+            return len(fps)
+
+
+def backfill():
+    """
+    Adds the syndication_fp and is_syndicated columns to gdelt_raw if needed,
+    and fills them in for the rows which were written without them.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            add_columns(cur)
+            dates = get_dates(cur)
+
+    for date in dates:
+        start = perf_counter()
+        num_rows = backfill_date(date)
+        if num_rows:
+            print(f"{date}: {num_rows} rows in {perf_counter() - start:.1f}s")
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"ANALYZE {DB_TABLE}")
+
+
+if __name__ == '__main__':
+    start = perf_counter()
+    backfill()
+    print(f"Time taken: {perf_counter() - start:.1f}s")
@@ -2,16 +2,10 @@
 Functions related to "Weekly Economic Sentiment" (Economic - Confidence) on the 
 COVID-19 Data Portal. 
 """
+import argparse
+
 import numpy as np
 import pandas as pd
-import psycopg2
-
-import postgres_config
-
-CONNECTION_DETAILS = (
-    f"host={postgres_config.HOST} dbname=gdelt user=postgres "
-    f"password={postgres_config.PASSWORD}"
-)
 
 
 def make_economic_theme():
@@ -28,6 +22,8 @@ def make_economic_theme():
         this does not. From testing, using threshold=100 removes ~0.5% of the
         economic-articles so it doesn't make *much* difference.
     """
+    from Gdelt.process_v2.db_pool import get_conn
+
     substrs_to_search = ['ECON','UNEMPLOY','GOVERNOR','AUSTER','DISEASE',
                          'CORONA','COVID','FINANC','MARKET']
     lookup = pd.read_csv("../data/LOOKUP-GKGTHEMES.csv", sep = "\t")
@@ -37,27 +33,35 @@ def make_economic_theme():
     ]
     row = ('economic', low_level_themes)
     insert_query = f"INSERT INTO themes_ref VALUES %s;"
-    with psycopg2.connect(CONNECTION_DETAILS) as conn:
+    with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(insert_query, (row,))
             
             
-def export_nz_econ_sent():
-    """
-    Constructs the "Weekly Economic Sentiment" .csv data file.
+def export_nz_econ_sent(parquet_fpath=None):
     """
-    select_query = """
-    SELECT date, from_onshore, avg_tone, num_articles
-    FROM daily_tone
-    WHERE country = 'NZ' AND theme = 'economic'
-    ORDER BY date
+    Constructs the "Weekly Economic Sentiment" .csv data file. If
+    parquet_fpath is given, daily_tone is read from that file (see
+    daily_tone_duckdb.py) rather than the database.
     """
     col_names = ['date', 'from_onshore', 'avg_tone', 'num_articles']
-    with psycopg2.connect(CONNECTION_DETAILS) as conn:
-        with conn.cursor() as cur:
-            cur.execute(select_query)
-            raw = cur.fetchall()
-    econ = pd.DataFrame(raw, columns=col_names)
+    if parquet_fpath:
+        from Gdelt.process_v2.daily_tone_duckdb import read_daily_tone
+        econ = read_daily_tone(parquet_fpath, theme='economic',
+                               country='NZ')[col_names]
+    else:
+        from Gdelt.process_v2.db_pool import get_conn
+        select_query = """
+        SELECT date, from_onshore, avg_tone, num_articles
+        FROM daily_tone
+        WHERE country = 'NZ' AND theme = 'economic'
+        ORDER BY date
+        """
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(select_query)
+                raw = cur.fetchall()
+        econ = pd.DataFrame(raw, columns=col_names)
     econ['date'] = pd.to_datetime(econ['date'], format='%Y-%m-%d')
     econ['avg_tone'] = econ['avg_tone'].astype('float')
     
@@ -87,4 +91,8 @@ def export_nz_econ_sent():
 
 
 if __name__ == "__main__":
-    export_nz_econ_sent()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parquet',
+                        help="read daily_tone from this Parquet file")
+    args = parser.parse_args()
+    export_nz_econ_sent(args.parquet)
@@ -1,106 +1,76 @@
 import itertools
-from operator import itemgetter
-import requests, zipfile, io, csv
+import io, csv
+import argparse
 # from pathos.pools import ProcessPool
 import random
 import os.path
-import concurrent.futures
 from functools import partial
 import boto3
 import botocore
 
+from Gdelt.gkg_async_fetch import fetch_all
+from Gdelt.gkg_fetch import iter_zip_lines
+from Gdelt.gkg_lake import LAKE_DIR, PARSER_FIELDS, iter_lake_lines
+from Gdelt.gkg_master_list import (
+    MasterList, schedule_by_size, update_master_list
+)
+from Gdelt.gkg_parser import GkgParser
+from adaptive_concurrency import AimdController
+
 io.DEFAULT_BUFFER_SIZE = 8192*4
 
-master_list = 'http://data.gdeltproject.org/gdeltv2/masterfilelist.txt'
-r = requests.get(master_list, stream=True)#, proxies=proxies)
-with open('gdelt2_master.txt', mode='wb') as localfile:
-    for line in r.iter_lines():
-        if b'gkg.csv.zip' in line:
-            localfile.write(line + b'\n')
+# Only the new tail of the master list is downloaded - see gkg_master_list.py
+update_master_list('gdelt2_master.txt')
 
 
-# classification = ['c4.' + str(i) for i in range(1, 29)]
-# classification.sort()
-codes = ['c3.1', 'c3.2']#, 'c41.1', 'c41.2', 'c41.3',                                        # removed all features just to reduce the data size for processing
-#          'c6.4', 'c6.5', 'c6.6',
-#          'c7.1', 'c7.2', 'c8.1', 'c8.2', 'c8.3', 'c8.4', 'c8.5', 'c8.6', 'c8.7',
-#          'v10.1', 'v10.2', 'v11.1']
-# codes[2:2] = classification
-codes_l = len(codes)
+# Other GCAM codes removed just to reduce the data size for processing
+parser = GkgParser(['AS'], gcam_codes=['c3.1', 'c3.2'])            # add country of choice eg: for Australia it is 'AS'
 
 session = boto3.Session(profile_name='kandavar_processing')
 s3 = session.client('s3')
 bucket_name = 'statsnz-covid-kandavar'
     
 
-def process_gkg(file_name):
-
-    processed = []
+def is_processed(file_name):
     csv_file = file_name.split('/')[-1][:-4]
-    date = file_name.split('/')[-1][:4]
     Prefix='G_from_2015/au/'                                   # change the country accordingly 
-    
-    if is_s3_key_valid(bucket_name, Prefix+csv_file): return
-
-    r = requests.get(file_name, stream=True)
-    print(csv_file)
-
-
-    try:
-        with zipfile.ZipFile(io.BytesIO(r.content)) as zf:
-            with zf.open(csv_file, 'r') as infile:
-                for raw in io.TextIOWrapper(infile, encoding='latin-1'):
+    return is_s3_key_valid(bucket_name, Prefix+csv_file)
 
 
-                    line = raw.split('\t')
-                    if len(line) < 10: continue
+def process_gkg(file_name, chunks):
+    return process_lines(file_name, iter_zip_lines(chunks))
 
-                # Keep stories which reference NZ as a location
-                    locs = line[9].split(';')
-                    inc_nz = False
-                    if locs == ['']: continue
-                    for loc in locs:
-                        if loc.split('#')[3] == 'AS':             # add country of choice eg: for Australia it is 'AS'
-                            inc_nz = True
-                            break
-                    if not inc_nz: continue
 
-                # Extract the relevant codes
-                    gcam = line[17].split(',')
-                    code_i = 0
-                    code_v = codes[code_i]
-                    code_l = len(code_v)
-                    out = []
-                    for el in gcam[1:]:
-
-                        gcode, val = el.split(':')
+def process_lines(file_name, lines):
 
+    csv_file = file_name.split('/')[-1][:-4]
+    date = file_name.split('/')[-1][:4]
 
-                        while code_v < gcode:
-                            out.append('')
-                            code_i += 1
-                            if (code_i == codes_l - 1): break
-                            code_v = codes[code_i]
+    print(csv_file)
 
-                        if code_v == gcode:
-                            out.append(val)
-                            code_i += 1
-                            if (code_i == codes_l - 1): break
-                            code_v = codes[code_i]
 
-                    if (len(codes) == len(out) + 1): out.append('')
+    try:
+        processed = parser.csv_rows(lines)
+        if len(processed) > 0:
+            write_to_csv_s3(processed, "statsnz-covid-kandavar", csv_file)
 
+        return(True)
 
-                # Extract the important information
-                    out[0:0] = line[15].split(',')
-                    out[0:0] = itemgetter(0, 1, 2, 3, 4, 7, 9, 11, 13)(line)
-                    processed.append(out)
-                if len(processed) > 0:
-                     write_to_csv_s3(processed, "statsnz-covid-kandavar", csv_file)
+    except: return(False)
 
-                return(True)
 
-    except: return(False)
+def process_lake(lake_dir=LAKE_DIR):
+    """
+    Writes the CSV of each GKG file in the local lake (see Gdelt/gkg_lake.py)
+    which isn't in S3 yet, rather than downloading the file again. Only the
+    parser's fields and the articles which mention its countries are read.
+    """
+    for filename_dt, lines in iter_lake_lines(countries=parser.countries,
+                                              fields=PARSER_FIELDS,
+                                              lake_dir=lake_dir):
+        file_name = filename_dt + '.gkg.csv.zip'
+        if not is_processed(file_name):
+            process_lines(file_name, lines)
     
 
 def is_s3_key_valid(bucket, key):
@@ -142,17 +112,31 @@ def write_to_csv_s3(csv_list, bucket, csv_file):
 
     
 
-# Import the master list
-gkg_files = []
-with open('gdelt2_master.txt') as f:
-    for line in f:
-        gkg_files.append(line.split(' ')[2][:-1])
+# Import the master list, newest first but with the biggest files of each day
+# started first so one large file doesn't hold up the end of the run
+gkg_files = [
+    entry.url for entry in
+    schedule_by_size(MasterList('gdelt2_master.txt').entries()[::-1])
+]
 
 
 if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--lake', nargs='?', const=LAKE_DIR,
+                            help="read the files from the GKG lake instead "
+                                 "of downloading them (see Gdelt/gkg_lake.py)")
+    args = arg_parser.parse_args()
 
 #     for f in gkg_files[200000:200019]: process_gkg(f)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=35) as executor:
-        executor.map(process_gkg, gkg_files[::-1])
+    if args.lake:
+        process_lake(args.lake)
+    else:
+        # Downloads share a pool of keep-alive connections (and the already
+        # processed files are skipped before downloading) - see
+        # gkg_async_fetch.py. The number of downloads at once adapts to the
+        # throughput and throttling
+        controller = AimdController(35, max_limit=64, name="GKG downloads")
+        fetch_all(gkg_files, process_gkg, per_host=64, skip=is_processed,
+                  controller=controller)
 
 print('finished')
@@ -6,6 +6,8 @@ import glob
 from functools import reduce
 import time
 
+from Gdelt.source_country import CCTLD_COUNTRIES, source_countries
+
 session = boto3.Session(profile_name='kandavar_processing')
 s3 = session.client('s3')
 bucket_name = 'statsnz-covid-kandavar'
@@ -67,8 +69,8 @@ def read_from_s3(filename,c):
     
     d['source_name'].dropna(inplace=True)
     d.dropna(subset = ['themes'], inplace = True)
-    d['source_name'] = [x if f'.{c}' in str(x) else None for x in d.source_name]          # filtering only 'from country news' eg Newzealand '.nz' domains
-    d = d.mask(d['source_name'].eq('None')).dropna().reset_index(drop=True)
+    from_c = source_countries(d.source_name) == CCTLD_COUNTRIES[c]                       # filtering only 'from country news' eg Newzealand '.nz' domains
+    d = d[from_c].dropna().reset_index(drop=True)
     
     print(f"Read - {filename}")
     print(d.info())
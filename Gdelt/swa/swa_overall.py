@@ -14,6 +14,8 @@ import glob
 import numpy as np
 from datetime import datetime
 
+from Gdelt.source_country import CCTLD_COUNTRIES, source_countries
+
 def read_from_s3(filename,c):
     
     session = boto3.Session(profile_name='kandavar_processing')
@@ -33,14 +35,14 @@ def read_from_s3(filename,c):
 
     d['source_name'].dropna(inplace=True)
     d['themes'].dropna(inplace=True)
-    d['source_name'] = [x if f'.{c}' in str(x) else None for x in d.source_name]
-    d['tone_about_c']=[d.tone[x] if i == None else np.NAN for x,i in enumerate(d.source_name)]
-    d['tone_from_c']=[d.tone[x] if i != None else np.NAN for x,i in enumerate(d.source_name)]
+    from_c = source_countries(d.source_name) == CCTLD_COUNTRIES[c]      # eg. '.nz' domains, resolved once per domain
+    d['tone_about_c'] = d.tone.where(~from_c)
+    d['tone_from_c'] = d.tone.where(from_c)
     d.drop(['themes'], axis =1, inplace = True)
 
-    d['source_from_c']=[i if i != None else np.NAN for x,i in enumerate(d.source_name)]
+    d['source_from_c'] = d.source_name.where(from_c)
     
-    d['source_about_c']=['Other' if i == None else np.NAN for x,i in enumerate(d.source_name)]
+    d['source_about_c'] = pd.Series('Other', index=d.index).where(~from_c)
     
     
     print(f"Read - {filename}")
@@ -102,7 +104,7 @@ if __name__ == '__main__':
     
     Year = [i for i in range(2015, 2022)]
 
-    from swa_monthly_final import keyss,merge2                                   # importing this from swa_monthly_final script
+    from Gdelt.swa.swa_monthly_final import keyss,merge2                                   # importing this from swa_monthly_final script
     
     for c in ['nz','ca','uk','au']:
         for y in Year:
@@ -0,0 +1,284 @@
+"""
+AIMD (additive increase, multiplicative decrease) control of the number of
+tasks a pool runs at once, instead of hard-coding a worker count per script
+and per machine.
+
+An AimdController holds the current limit, and is told how long each task
+took and whether it succeeded, failed or was throttled (`record`). Every
+`limit` tasks (a "window", of at least MIN_WINDOW) it measures the throughput and mean latency, and:
+- halves the limit (`decrease`) as soon as a task is throttled - an HTTP 429
+  or 503, or an S3 SlowDown (see `is_throttle`) - at most once per window, as
+  the other tasks in flight at the time are likely to be throttled too,
+- shrinks it at the end of a window with too many failures, a mean latency
+  above `latency_target`, or less than `min_free_memory` available,
+- steps it back if the last increase made the throughput drop (eg. the
+  database or the network is already saturated), and
+- otherwise grows it by `increase`, up to `max_limit`.
+
+The pools use a controller through:
+- `adaptive_map(executor, func, items, controller=...)`: executor.map for a
+  Thread/ProcessPoolExecutor with `max_limit` workers, which keeps at most
+  `controller.limit` tasks in flight,
+- AimdLimiter / AsyncAimdLimiter: `with limiter.slot():` (or `async with`)
+  blocks while `limit` tasks are running, and records the task's outcome
+  (from its exception, if any).
+
+Usage:
+    controller = AimdController(10, max_limit=32, name='warc records')
+    with concurrent.futures.ProcessPoolExecutor(32) as executor:
+        results = adaptive_map(executor, process, items, controller=controller)
+    print(controller.stats())
+"""
+import asyncio
+import threading
+import concurrent.futures
+from contextlib import asynccontextmanager, contextmanager
+from time import perf_counter
+
+OK, FAILED, THROTTLED = 'ok', 'failed', 'throttled'
+THROTTLE_STATUSES = {429, 503}
+# Error codes of AWS throttling responses (eg. S3 "SlowDown")
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException',
+                  'RequestLimitExceeded', 'TooManyRequestsException',
+                  'ServiceUnavailable', 'RequestThrottled'}
+MAX_ERROR_RATE = 0.1  # of a window's tasks, before the limit is shrunk
+THROUGHPUT_TOLERANCE = 0.1  # drop in throughput that undoes an increase
+MIN_WINDOW = 20  # tasks, so a window's throughput isn't just noise
+
+
+def is_throttle(e):
+    """
+    True if the exception is a throttling response: HTTP 429/503 from
+    requests or aiohttp, or a botocore ClientError such as S3's SlowDown.
+    """
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):  # botocore ClientError
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        return (response.get('Error', {}).get('Code') in THROTTLE_CODES or
+                status in THROTTLE_STATUSES)
+    status = getattr(response, 'status_code', None)  # requests.HTTPError
+    if status is None:
+        status = getattr(e, 'status', None)  # aiohttp.ClientResponseError
+    return status in THROTTLE_STATUSES
+
+
+def outcome_of(e):
+    return THROTTLED if is_throttle(e) else FAILED
+
+
+def available_memory():
+    """Bytes of memory available to new processes, or None if unknown."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class AimdController:
+    """
+    The number of tasks to run at once, adjusted from their outcomes. Thread
+    safe.
+
+    initial: the limit to start at (eg. the old hard-coded worker count).
+    min_limit, max_limit: bounds of the limit (max_limit is also the size to
+        make the pool).
+    increase: added to the limit after a window without problems.
+    decrease: the limit is multiplied by this when throttled, or at the end
+        of a window with problems.
+    latency_target: optional seconds; a window with a higher mean latency
+        shrinks the limit.
+    min_free_memory: optional bytes; a window which ends with less memory
+        available shrinks the limit.
+    name: printed with each decrease of the limit.
+    """
+    def __init__(self, initial, min_limit=1, max_limit=None, increase=1,
+                 decrease=0.5, latency_target=None, min_free_memory=None,
+                 name=''):
+        self.min_limit = min_limit
+        self.max_limit = max_limit if max_limit is not None else initial * 4
+        self._limit = max(min_limit, min(initial, self.max_limit))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.min_free_memory = min_free_memory
+        self.name = name
+        self.counts = {OK: 0, FAILED: 0, THROTTLED: 0}
+        self._lock = threading.Lock()
+        self._last_throughput, self._increased = None, False
+        self._start_window(perf_counter())
+
+    @property
+    def limit(self):
+        return self._limit
+
+    def _start_window(self, now):
+        self._window_start = now
+        self._window = {OK: 0, FAILED: 0, THROTTLED: 0}
+        self._window_seconds = 0.0
+        self._window_cut = False  # the limit was cut for throttling
+
+    def _set_limit(self, limit, reason=None):
+        limit = max(self.min_limit, min(int(limit), self.max_limit))
+        if limit != self._limit:
+            if reason is not None:
+                print(f"{self.name}: concurrency {self._limit} -> {limit} "
+                      f"({reason})")
+            self._increased = limit > self._limit
+            self._limit = limit
+
+    def _shrink(self, reason):
+        self._set_limit(min(self._limit * self.decrease, self._limit - 1),
+                        reason)
+
+    def record(self, seconds, outcome=OK):
+        """Records a finished task, which took `seconds`."""
+        with self._lock:
+            now = perf_counter()
+            self.counts[outcome] += 1
+            self._window[outcome] += 1
+            self._window_seconds += seconds
+            if outcome == THROTTLED:
+                # Once per window, so that a burst of throttled responses
+                # (from the tasks already in flight) is one decrease
+                if not self._window_cut:
+                    self._shrink("throttled")
+                    self._window_cut = True
+                return
+
+            num_tasks = sum(self._window.values())
+            if num_tasks < max(self._limit, MIN_WINDOW):
+                return
+            throughput = num_tasks / max(now - self._window_start, 1e-9)
+            latency = self._window_seconds / num_tasks
+            memory = (available_memory() if self.min_free_memory is not None
+                      else None)
+            if self._window_cut:
+                pass
+            elif self._window[FAILED] > MAX_ERROR_RATE * num_tasks:
+                self._shrink(f"{self._window[FAILED]} of {num_tasks} failed")
+            elif memory is not None and memory < self.min_free_memory:
+                self._shrink(f"{memory / 2**20:.0f} MB available")
+            elif (self.latency_target is not None and
+                  latency > self.latency_target):
+                self._shrink(f"latency {latency:.2f}s")
+            elif (self._increased and self._last_throughput is not None and
+                  throughput < self._last_throughput *
+                  (1 - THROUGHPUT_TOLERANCE)):
+                self._set_limit(self._limit - self.increase)
+                self._increased = False
+            else:
+                self._set_limit(self._limit + self.increase)
+            self._last_throughput = throughput
+            self._start_window(now)
+
+    def stats(self):
+        return {'limit': self._limit, **self.counts}
+
+
+class AimdLimiter:
+    """Runs at most `controller.limit` tasks at once across threads."""
+    def __init__(self, controller):
+        self.controller = controller
+        self._active = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """
+        Blocks until the task can run, and records its duration and outcome
+        (failed or throttled if it raises).
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._active < self.controller.limit)
+            self._active += 1
+        start = perf_counter()
+        outcome = OK
+        try:
+            yield
+        except Exception as e:
+            outcome = outcome_of(e)
+            raise
+        finally:
+            self.controller.record(perf_counter() - start, outcome)
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+
+class AsyncAimdLimiter:
+    """AimdLimiter for the coroutines of one event loop."""
+    def __init__(self, controller):
+        self.controller = controller
+        self._active = 0
+        self._cond = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._cond:
+            await self._cond.wait_for(
+                lambda: self._active < self.controller.limit
+            )
+            self._active += 1
+        start = perf_counter()
+        outcome = OK
+        try:
+            yield
+        except Exception as e:
+            outcome = outcome_of(e)
+            raise
+        finally:
+            self.controller.record(perf_counter() - start, outcome)
+            async with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+
+def adaptive_map(executor, func, *iterables, controller, outcome=None,
+                 return_exceptions=False):
+    """
+    Like `list(executor.map(func, *iterables))`, but with at most
+    `controller.limit` calls in flight (so the executor should have
+    `controller.max_limit` workers), and each call's duration and outcome
+    recorded by the controller.
+
+    outcome: optional function of a result which returns OK, FAILED or
+        THROTTLED, for functions which handle their own errors (eg. return
+        None on failure).
+    return_exceptions: if True, an exception raised by func is returned in
+        place of its result, rather than raised.
+    """
+    args = enumerate(zip(*iterables))
+    results, in_flight = {}, {}
+    exhausted = False
+    while True:
+        while not exhausted and len(in_flight) < controller.limit:
+            try:
+                i, call_args = next(args)
+            except StopIteration:
+                exhausted = True
+                break
+            in_flight[executor.submit(func, *call_args)] = (i, perf_counter())
+        if not in_flight:
+            break
+        done, _ = concurrent.futures.wait(
+            in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            i, start = in_flight.pop(future)
+            seconds = perf_counter() - start
+            try:
+                result = future.result()
+            except Exception as e:
+                controller.record(seconds, outcome_of(e))
+                if not return_exceptions:
+                    raise
+                results[i] = e
+                continue
+            controller.record(seconds,
+                              outcome(result) if outcome is not None else OK)
+            results[i] = result
+    return [results[i] for i in range(len(results))]
@@ -10,6 +10,13 @@ from datetime import date, timedelta
 from pandas import date_range
 import pandas as pd
 
+from adaptive_concurrency import AimdController, adaptive_map
+
+# Processes at once start at NUM_WORKERS and adapt to the throughput and to
+# throttling (HTTP 429/503), up to MAX_WORKERS - see adaptive_concurrency.py
+NUM_WORKERS = 10
+MAX_WORKERS = 32
+
 
 def get_warc_urls(warc_paths_gz_url):
     """
@@ -111,6 +118,8 @@ def process_cc_file(url, mode):
         ['Datetime', 'URL', 'Text']
     ]
     r = requests.get(url, stream=True)
+    # So that throttling (429/503) is an error, rather than an empty CSV
+    r.raise_for_status()
     
     for record in warcio.archiveiterator.ArchiveIterator(r.raw):
         # rec_type='warcinfo' is metadata for the entire WARC batch
@@ -173,8 +182,13 @@ if __name__ == "__main__":
                           for date in dates if "CC-NEWS-" + date in url]
     
     print(f"Processing {len(ccnews_urls_subset)} CC-NEWS URLs")
-    with concurrent.futures.ProcessPoolExecutor(max_workers=10) as executor:
-        executor.map(process_cc_file, ccnews_urls_subset, itertools.repeat("ccnews"))
+    controller = AimdController(NUM_WORKERS, max_limit=MAX_WORKERS,
+                                name="CC-NEWS files")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        adaptive_map(executor, process_cc_file, ccnews_urls_subset,
+                     itertools.repeat("ccnews"), controller=controller,
+                     return_exceptions=True)
+    print(controller.stats())
     
 #     ## CC-MAIN
 #     years = ['2020', '2021']
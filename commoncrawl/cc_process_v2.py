@@ -1,17 +1,33 @@
 import os, shutil, subprocess
-import csv, json, gzip
-import concurrent.futures, itertools
+import io, csv, json, gzip
+import bisect, concurrent.futures, contextlib, itertools
 import math
 
 from functools import partial
 from multiprocessing import Pool, Value
 
 import botocore, boto3
+from boto3.s3.transfer import TransferConfig
+import numpy as np
 import warcio
 import newspaper
 
 from datetime import datetime
 
+from adaptive_concurrency import (
+    FAILED, OK, THROTTLED, AimdController, adaptive_map, is_throttle
+)
+from shm_transport import ShmHandle, attach_arrays, discard, put_arrays
+
+CHUNK_SIZE = 100  # webpages per process_index_chunk task
+# Processes at once start at NUM_WORKERS and adapt to the throughput and to
+# S3 throttling (SlowDown), up to MAX_WORKERS - see adaptive_concurrency.py
+NUM_WORKERS = 10
+MAX_WORKERS = 32
+# A bunch's CSV is uploaded in parts of multipart_chunksize (8 MB), with at
+# most max_concurrency parts copied out of the shared memory at a time
+TRANSFER_CONFIG = TransferConfig(max_concurrency=4)
+
 
 # S3 Functions
 def is_s3_key_valid(bucket, key):
@@ -48,16 +64,80 @@ def write_to_csv_s3(csv_list, bucket, key):
         the inner lists will then be joined by newlines.)
     """
     s3_client = boto3.Session(profile_name="xmiles_processing").client('s3') 
+    csv_str = ''.join(to_csv_line(row) for row in csv_list)
+    s3_client.put_object(Body=csv_str, Bucket=bucket, Key=key)
+
+
+def to_csv_line(row):
+    """
+    Joins the elements of the row by commas, and ends it with a newline.
+    """
     # double-quotes are used to enclose fields, so any double-quotes are 
     # changed to single-quotes
-    csvlist_str_elements = [
-        ['"' + str(x).replace('"', "'") + '"' for x in row]
-        for row in csv_list
-    ]
-    
-    csv_rows = [','.join(row) for row in csvlist_str_elements]
-    csv_str = '\n'.join(csv_rows) + '\n'
-    s3_client.put_object(Body=csv_str, Bucket=bucket, Key=key)
+    return ','.join('"' + str(x).replace('"', "'") + '"' for x in row) + '\n'
+
+
+class BuffersReader(io.RawIOBase):
+    """
+    Read-only, seekable file object over a list of bytes-like objects, as if
+    they were joined, without copying them into one bytes object first.
+    """
+    def __init__(self, buffers):
+        self._buffers = [memoryview(buffer).cast('B') for buffer in buffers]
+        self._starts = list(itertools.accumulate(
+            map(len, self._buffers), initial=0
+        ))
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos,
+                io.SEEK_END: self._starts[-1]}[whence]
+        self._pos = max(base + offset, 0)
+        return self._pos
+
+    def readinto(self, b):
+        out = memoryview(b).cast('B')
+        num_read = 0
+        i = bisect.bisect_right(self._starts, self._pos) - 1
+        while num_read < len(out) and i < len(self._buffers):
+            start = self._pos - self._starts[i]
+            count = min(len(self._buffers[i]) - start, len(out) - num_read)
+            out[num_read:num_read + count] = \
+                self._buffers[i][start:start + count]
+            num_read += count
+            self._pos += count
+            i += 1
+        return num_read
+
+    def close(self):
+        # Releases the views, so shared memory blocks under them can be closed
+        for buffer in self._buffers:
+            buffer.release()
+        self._buffers = []
+        super().close()
+
+
+def write_buffers_to_s3(buffers, bucket, key):
+    """
+    buffers: list of bytes-like objects (eg. the uint8 arrays from the
+        process_index_chunk workers), which are written one after another.
+        They are read a part at a time by a multipart upload (see
+        TRANSFER_CONFIG), rather than joined into one bytes object. (The
+        parts can't be one buffer each, as every part but the last must be
+        at least 5 MB.)
+    """
+    s3_client = boto3.Session(profile_name="xmiles_processing").client('s3')
+    with BuffersReader(buffers) as reader:
+        s3_client.upload_fileobj(reader, bucket, key, Config=TRANSFER_CONFIG)
     
     
 def read_txt_from_s3(bucket, key):
@@ -207,6 +287,9 @@ def process_index_str(crawl_batch, idx_ref_str):
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "InvalidRequestException":
             log(crawl_batch, "SSO Fail: " + idx_ref['url'])
+        elif is_throttle(e):
+            log(crawl_batch, "Throttled: " + idx_ref['url'])
+            return THROTTLED
         else:
             log(crawl_batch, f"{type(e).__name__}: {idx_ref['url']}")
         return
@@ -242,6 +325,31 @@ def process_index_str(crawl_batch, idx_ref_str):
         return
     
     return [fetch_time, url, text]
+
+
+def process_index_chunk(crawl_batch, idx_ref_strs):
+    """
+    Processes a chunk of index reference strings (in a worker process), and
+    puts the CSV lines of the webpages with text in shared memory, rather
+    than sending every webpage's text back to the parent through a pipe.
+    
+    Returns the ShmHandle (see shm_transport.py) of the uint8 array 'csv',
+    with (number of webpages with text, number failed, number of which were
+    throttled by S3) as its meta.
+    """
+    output = [process_index_str(crawl_batch, idx_ref_str)
+              for idx_ref_str in idx_ref_strs]
+    num_throttled = output.count(THROTTLED)
+    good_output = [row for row in output if row and row != THROTTLED]
+    csv_bytes = ''.join(to_csv_line(row) for row in good_output).encode()
+    return put_arrays({'csv': np.frombuffer(csv_bytes, dtype=np.uint8)},
+                      meta=(len(good_output), len(output) - len(good_output),
+                            num_throttled))
+
+
+def chunk_outcome(handle):
+    """Outcome of a process_index_chunk task, for the AimdController."""
+    return THROTTLED if handle.meta[2] else OK
     
 
 def process_batch(crawl_batch, bucket):
@@ -267,9 +375,13 @@ def process_batch(crawl_batch, bucket):
     else:
         num_parquet_keys = len(parquet_keys)
         print(f"Processing {num_parquet_keys} Parquet files")
-        with concurrent.futures.ProcessPoolExecutor(max_workers=10) as executor:
-            parquet_idxs = list(
-                executor.map(process_parquet_key, itertools.repeat(crawl_batch), parquet_keys)
+        controller = AimdController(NUM_WORKERS, max_limit=MAX_WORKERS,
+                                    name="S3 Select")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            parquet_idxs = adaptive_map(
+                executor, process_parquet_key, itertools.repeat(crawl_batch),
+                parquet_keys, controller=controller,
+                outcome=lambda idxs: FAILED if idxs is None else OK
             )
 
         # Remove empty lists and None elements
@@ -277,6 +389,7 @@ def process_batch(crawl_batch, bucket):
         # Flatten 2D list to 1D list
         valid_idxs_flat = list(itertools.chain.from_iterable(valid_idxs))
         write_to_txt_s3(valid_idxs_flat, bucket, unprocessed_idxs_key)
+        valid_parquet_idxs_flat = valid_idxs_flat
         
         processed_parquets_flag = True
     
@@ -287,6 +400,9 @@ def process_batch(crawl_batch, bucket):
     
     log(crawl_batch, f"\nProcessing {num_webpages} webpages in {num_bunches} bunches")
     start = datetime.now()
+    # Kept across bunches, so each bunch starts at the last one's concurrency
+    controller = AimdController(NUM_WORKERS, max_limit=MAX_WORKERS,
+                                name="WARC records")
     for i in range(num_bunches):
         bunch_key = f"commoncrawl/processed_ccmain_bunches/{crawl_batch}/" \
                     f"{crawl_batch}_NZ-{i + 1:04}.csv"
@@ -294,20 +410,44 @@ def process_batch(crawl_batch, bucket):
             continue # Do not overwrite existing output/bunches
         
         log(crawl_batch, f"Bunch number {i + 1:04}")
-        with concurrent.futures.ProcessPoolExecutor(max_workers=10) as executor:
-            output = list(
-                executor.map(process_index_str, itertools.repeat(crawl_batch), 
-                             valid_parquet_idxs_flat[(bunch_size*i):(bunch_size*(i+1)-1)])
+        bunch = valid_parquet_idxs_flat[(bunch_size*i):(bunch_size*(i+1))]
+        chunks = [bunch[j:j + CHUNK_SIZE]
+                  for j in range(0, len(bunch), CHUNK_SIZE)]
+        # The workers only send back shared memory handles, and the CSV
+        # lines are read from the shared memory by the upload, a part at a
+        # time. Every chunk is waited for, so that if one raises the blocks
+        # of the others can still be freed.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            results = adaptive_map(
+                executor, process_index_chunk, itertools.repeat(crawl_batch),
+                chunks, controller=controller, outcome=chunk_outcome,
+                return_exceptions=True
             )
+        handles = [result for result in results
+                   if isinstance(result, ShmHandle)]
         
         headers = ["Datetime", "URL", "Text"]
-        good_output = [headers] + list(filter(None, output))
-        num_fail_webpages += len(output) - (len(good_output) - 1)
-        
-        write_to_csv_s3(good_output, bucket, bunch_key)
+        with contextlib.ExitStack() as stack:
+            # Runs last, so frees any blocks which weren't attached below
+            # (attach_arrays frees the ones which were)
+            stack.callback(lambda: [discard(handle) for handle in handles])
+            errors = [result for result in results
+                      if isinstance(result, Exception)]
+            if errors:
+                raise errors[0]
+            num_fail_webpages += sum(handle.meta[1] for handle in handles)
+            buffers = [to_csv_line(headers).encode()] + [
+                stack.enter_context(attach_arrays(handle))['csv']
+                for handle in handles
+            ]
+            try:
+                write_buffers_to_s3(buffers, bucket, bunch_key)
+            finally:
+                del buffers  # release the views before the blocks are freed
         
     end = datetime.now()
     log(crawl_batch, "Processing took " + str(end - start))
+    log(crawl_batch, f"Final concurrency and chunk outcomes: {controller.stats()}")
     
     # Print out summary
     log(crawl_batch,
@@ -315,7 +455,7 @@ def process_batch(crawl_batch, bucket):
         f"Failed '.nz' webpages: {num_fail_webpages}\n"
         f"(Failed '.nz' webpages - no text extracted: {no_text_counter.value})")
     if processed_parquets_flag:
-        num_parquet_with_nz = len([x for x in valid_parquet_idxs if len(x) > 0])
+        num_parquet_with_nz = len([x for x in valid_idxs if len(x) > 0])
         num_fails = len([x for x in parquet_idxs if x is None])
         log(crawl_batch,
             f"\nNumber of Parquet files with '.nz' webpages: {num_parquet_with_nz} / {num_parquet_keys}\n"
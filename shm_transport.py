@@ -0,0 +1,117 @@
+"""
+Hands NumPy arrays from worker processes back to the parent through shared
+memory, rather than pickling them through the pool's result pipe.
+
+A worker copies its result arrays into one new shared memory block
+(`put_arrays`) and returns only the small ShmHandle: the block's name, and
+the dtype, shape and offset of each array in it. The parent then either
+maps the arrays in place (`attach_arrays`, for a consumer which is done with
+them by the end of the `with` block, eg. a write to S3 or the database), or
+copies them out and frees the block straight away (`take_arrays`, for a
+consumer which keeps them). Either way the parent doesn't deserialize
+anything, so it isn't the bottleneck for many workers.
+
+Each block is unlinked by the process which reads it. On Python < 3.13 the
+worker stops the resource tracker from unlinking the block when the worker
+exits, so a block is only leaked (in /dev/shm) if the parent dies before
+reading it; `discard` frees a block which won't be read.
+
+Usage:
+    # in the worker
+    return put_arrays({'text': text_bytes, 'offsets': offsets}, meta=counts)
+    # in the parent
+    with attach_arrays(handle) as arrays:
+        write(arrays['text'])
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from numpy.lib.format import descr_to_dtype, dtype_to_descr
+
+ALIGNMENT = 64  # bytes, so each array starts on a cache line
+
+# fields: list of (key, dtype descr, shape, offset); meta: anything small
+ShmHandle = namedtuple('ShmHandle', ['name', 'fields', 'meta'])
+
+
+def create_block(size):
+    """A new shared memory block, which the resource tracker won't unlink."""
+    try:
+        return SharedMemory(create=True, size=max(size, 1), track=False)
+    except TypeError:  # Python < 3.13
+        shm = SharedMemory(create=True, size=max(size, 1))
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def put_arrays(arrays, meta=None):
+    """
+    Copies a dict of arrays into a new shared memory block, and returns its
+    ShmHandle.
+    """
+    fields, size = [], 0
+    for key, array in arrays.items():
+        array = np.asarray(array)
+        fields.append((key, dtype_to_descr(array.dtype), array.shape, size))
+        size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    shm = create_block(size)
+    try:
+        for (_, _, shape, offset), array in zip(fields, arrays.values()):
+            array = np.asarray(array)
+            out = np.ndarray(shape, dtype=array.dtype, buffer=shm.buf,
+                             offset=offset)
+            out[...] = array
+            del out
+    except Exception:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return ShmHandle(shm.name, fields, meta)
+
+
+def _views(shm, handle):
+    return {
+        key: np.ndarray(shape, dtype=descr_to_dtype(descr), buffer=shm.buf,
+                        offset=offset)
+        for key, descr, shape, offset in handle.fields
+    }
+
+
+@contextmanager
+def attach_arrays(handle):
+    """
+    Yields the arrays of a handle as views of the shared memory (no copy),
+    and frees the block on exit, so the views mustn't be kept after the
+    `with` block.
+    """
+    shm = SharedMemory(name=handle.name)
+    arrays = _views(shm, handle)
+    try:
+        yield arrays
+    finally:
+        arrays.clear()
+        shm.close()
+        shm.unlink()
+
+
+def take_arrays(handle):
+    """Returns copies of the arrays of a handle, and frees the block."""
+    with attach_arrays(handle) as arrays:
+        return {key: array.copy() for key, array in arrays.items()}
+
+
+def discard(handle):
+    """
+    Frees the block of a handle without reading it. Does nothing if the block
+    has already been freed (eg. by attach_arrays).
+    """
+    try:
+        shm = SharedMemory(name=handle.name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()